@@ -0,0 +1,5 @@
+"""
+Load and benchmark harness for the payment processor import path.
+
+Run from services/paymentprocessor, see bench/README.md.
+"""
@@ -0,0 +1,126 @@
+"""
+Local stand-in for the gateway endpoints used by the import:
+
+- GET /api/v2/tenants
+- GET /api/v2/rents/tenant/{tenant_id}/{term}
+- PATCH /api/v2/rents/payment/{tenant_id}/{term}
+
+Latency (with jitter) and an error rate can be injected on the rent endpoints. The fake is
+used in-process through an httpx transport (see bench.run), or served over HTTP:
+
+    python -m bench.fake_gateway --tenants 5000 --latency 0.02 --error-rate 0.01 --port 8300
+"""
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+
+class FakeGateway:
+    """
+    In-memory tenants and rent payments of one organization.
+
+    Args:
+        tenants (int): Tenants 1..tenants, with references zero padded to six digits.
+        latency (float): Seconds added to every rent call.
+        jitter (float): Random extra seconds (0..jitter) added to every rent call.
+        error_rate (float): Share of rent calls answered with a 503.
+        tenants_latency (float): Seconds added to the tenant listing.
+        seed (int): Seed of the jitter and error draws.
+    """
+
+    def __init__(self, tenants: int = 1000, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 tenants_latency: float = 0.0, seed: Optional[int] = None):
+        self.tenants = [
+            {'_id': f'tenant{i}', 'reference': str(i).zfill(6), 'name': f'Tenant {i}'}
+            for i in range(1, tenants + 1)
+        ]
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tenants_latency = tenants_latency
+        self.payments: Dict[Tuple[str, str], List[dict]] = {}
+        self.calls: Counter = Counter()
+        self.errors = 0
+        self._rng = random.Random(seed)
+
+    async def _delay(self, seconds: float) -> None:
+        if self.jitter:
+            seconds += self._rng.random() * self.jitter
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def _fail(self) -> bool:
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def handle(self, method: str, path: str, body: bytes = b'') -> Tuple[int, object]:
+        """Answer a gateway call, returns the status code and the JSON body"""
+        parts = path.strip('/').split('/')
+        self.calls[(method, '/'.join(parts[:4]))] += 1
+
+        if method == 'GET' and parts[:3] == ['api', 'v2', 'tenants']:
+            await self._delay(self.tenants_latency)
+            has_payments = {tenant_id for tenant_id, _ in self.payments}
+            return 200, [dict(tenant, hasPayments=tenant['_id'] in has_payments) for tenant in self.tenants]
+
+        if len(parts) == 6 and parts[:3] == ['api', 'v2', 'rents']:
+            await self._delay(self.latency)
+            if self._fail():
+                return 503, {'error': 'injected failure'}
+            tenant_id, term = parts[4], parts[5]
+            if method == 'GET' and parts[3] == 'tenant':
+                # Terms are YYYYMMDDHH here and YYYY.MM in the PATCH
+                key = (tenant_id, f"{term[:4]}.{term[4:6]}")
+                return 200, {'term': int(term), 'payments': self.payments.get(key, [])}
+            if method == 'PATCH' and parts[3] == 'payment':
+                data = json.loads(body or b'{}')
+                self.payments[(tenant_id, term)] = data.get('payments', [])
+                return 200, {'_id': tenant_id, 'term': term}
+
+        return 404, {'error': f'{method} {path} is not faked'}
+
+    def transport(self) -> httpx.MockTransport:
+        """httpx transport answering from this fake, for in-process runs"""
+        async def handler(request: httpx.Request) -> httpx.Response:
+            status, body = await self.handle(request.method, request.url.path, request.content)
+            return httpx.Response(status, json=body)
+
+        return httpx.MockTransport(handler)
+
+    def app(self):
+        """ASGI application serving this fake over HTTP"""
+        from starlette.applications import Starlette
+        from starlette.requests import Request
+        from starlette.responses import JSONResponse
+        from starlette.routing import Route
+
+        async def endpoint(request: Request):
+            status, body = await self.handle(request.method, request.url.path, await request.body())
+            return JSONResponse(body, status_code=status)
+
+        return Starlette(routes=[Route('/{path:path}', endpoint, methods=['GET', 'PATCH'])])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tenants', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per rent call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds per rent call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of rent calls failing with 503')
+    parser.add_argument('--port', type=int, default=8300)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    gateway = FakeGateway(args.tenants, args.latency, args.jitter, args.error_rate)
+    uvicorn.run(gateway.app(), host='127.0.0.1', port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Synthetic payment CSV files.
+
+    python -m bench.generate --rows 100000 --tenants 5000 --repeat-share 0.3 \
+        --duplicate-rate 0.01 --output payments.csv
+
+Tenant ids are 1..tenants (the fake gateway serves the same tenants). repeat-share is
+the share of rows paying for a tenant already seen in the file, duplicate-rate the share
+of rows reusing the reference of an earlier row. occupant_documents gives the matching
+occupants of the direct backend (PAYMENT_BACKEND=direct), seeded by bench.run.
+"""
+import argparse
+import csv
+import random
+import sys
+from datetime import date, timedelta
+from typing import Iterator, List, Optional, TextIO
+
+COLUMNS = ['tenant_id', 'payment_date', 'payment_type', 'payment_reference', 'amount', 'description']
+PAYMENT_TYPES = ['cash', 'bank', 'mpesa', 'cheque']
+
+
+def generate_rows(rows: int, tenants: int, repeat_share: float = 0.0, duplicate_rate: float = 0.0,
+                  seed: Optional[int] = None, start: date = date(2024, 1, 1)) -> Iterator[List[str]]:
+    """Yield the data rows of a payment file (see the module docstring for the parameters)"""
+    rng = random.Random(seed)
+    seen_tenants: List[int] = []
+    next_tenant = 0
+    for index in range(rows):
+        if seen_tenants and rng.random() < repeat_share:
+            tenant = rng.choice(seen_tenants)
+        else:
+            tenant = next_tenant % tenants + 1
+            next_tenant += 1
+            if len(seen_tenants) < tenants:
+                seen_tenants.append(tenant)
+        if index and rng.random() < duplicate_rate:
+            reference = f"BENCH{rng.randrange(index):08d}"
+        else:
+            reference = f"BENCH{index:08d}"
+        payment_date = start + timedelta(days=rng.randrange(28))
+        yield [
+            str(tenant),
+            payment_date.strftime('%d/%m/%Y'),
+            rng.choice(PAYMENT_TYPES),
+            reference,
+            f"{rng.randrange(500, 50000)}.00",
+            f"Benchmark payment {index + 1}",
+        ]
+
+
+def occupant_documents(tenants: int, organization_id: str, rent_term: int) -> Iterator[dict]:
+    """
+    Occupants of tenants 1..tenants, with the ids and references of the fake gateway and an
+    empty rent of rent_term (YYYYMMDDHH), for the direct backend
+    """
+    for i in range(1, tenants + 1):
+        yield {
+            '_id': f'tenant{i}',
+            'realmId': organization_id,
+            'reference': str(i).zfill(6),
+            'name': f'Tenant {i}',
+            'rents': [{'term': rent_term, 'payments': []}],
+        }
+
+
+def write_csv(out: TextIO, rows: int, tenants: int, repeat_share: float = 0.0, duplicate_rate: float = 0.0,
+              seed: Optional[int] = None) -> None:
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    writer.writerows(generate_rows(rows, tenants, repeat_share, duplicate_rate, seed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help='data rows (1k to 1M)')
+    parser.add_argument('--tenants', type=int, default=1000, help='distinct tenants available')
+    parser.add_argument('--repeat-share', type=float, default=0.0, help='share of rows of a tenant already seen')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='share of rows reusing an earlier reference')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='file to write, stdout by default')
+    args = parser.parse_args(argv)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            write_csv(out, args.rows, args.tenants, args.repeat_share, args.duplicate_rate, args.seed)
+    else:
+        write_csv(sys.stdout, args.rows, args.tenants, args.repeat_share, args.duplicate_rate, args.seed)
+
+
+if __name__ == '__main__':
+    main()
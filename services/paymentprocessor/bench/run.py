@@ -0,0 +1,199 @@
+"""
+Benchmark of POST /process-payments.
+
+Generates a payment file, runs the service in-process against the fake gateway and an
+in-memory MongoDB (mongomock-motor), and reports the rows/sec, the p50/p99 latency of a
+row and the peak RSS of the process:
+
+    python -m bench.run --rows 50000 --tenants 5000 --repeat-share 0.3 --latency 0.02
+
+Use --mongo-url to run against a local MongoDB (database MONGO_DB_NAME, "bench" by default,
+dropped before the run) and --gateway-url to use a gateway served by bench.fake_gateway
+or a real one. Service settings (PAYMENT_CONCURRENCY, ...) are read from the environment
+as usual; --concurrency is a shortcut.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help='data rows (1k to 1M)')
+    parser.add_argument('--tenants', type=int, default=1000, help='tenants of the fake gateway')
+    parser.add_argument('--repeat-share', type=float, default=0.0, help='share of rows of a tenant already seen')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='share of rows reusing an earlier reference')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--csv', help='use this file instead of generating one')
+    parser.add_argument('--term', default='2024.01')
+    parser.add_argument('--aggregate', action='store_true', help='one rent update per tenant')
+    parser.add_argument('--concurrency', type=int, help='PAYMENT_CONCURRENCY')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per fake rent call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds per fake rent call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake rent calls failing')
+    parser.add_argument('--mongo-url', help='local MongoDB instead of the in-memory stand-in')
+    parser.add_argument('--gateway-url', help='gateway served over HTTP instead of the in-process fake')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args) -> None:
+    """Service settings, set before the service modules are imported"""
+    # Failed rows are logged as errors, keep them out of the report
+    os.environ.setdefault('LOGGER_LEVEL', 'critical')
+    os.environ.setdefault('MONGO_DB_NAME', 'bench')
+    # Every run imports the same file, checkpoints would skip it
+    os.environ.setdefault('IMPORT_CHECKPOINTS', 'false')
+    os.environ.setdefault('MONGO_ENSURE_INDEXES', 'true' if args.mongo_url else 'false')
+    if args.concurrency:
+        os.environ['PAYMENT_CONCURRENCY'] = str(args.concurrency)
+    if args.mongo_url:
+        os.environ['MONGO_URL'] = args.mongo_url
+    if args.gateway_url:
+        os.environ['GATEWAY_URL'] = args.gateway_url
+
+
+async def benchmark(args, csv_path: str) -> dict:
+    import httpx
+
+    import database
+    import direct
+    import http_client
+    import main
+    from bench.fake_gateway import FakeGateway
+    from bench.generate import occupant_documents
+
+    gateway = None
+    if args.gateway_url is None:
+        gateway = FakeGateway(args.tenants, args.latency, args.jitter, args.error_rate, seed=args.seed)
+        http_client._client = httpx.AsyncClient(transport=gateway.transport())
+    if args.mongo_url is None:
+        from mongomock_motor import AsyncMongoMockClient
+        database._client = AsyncMongoMockClient()
+    else:
+        await database.get_mongo_client().drop_database(database.get_database().name)
+        await database.ensure_indexes()
+    # Tenants of the direct backend, the same as the ones of the fake gateway
+    await database.get_database()[database.OCCUPANTS_COLLECTION].insert_many(
+        list(occupant_documents(args.tenants, 'bench', direct.rent_term(args.term)))
+    )
+
+    # Time every call of the per-tenant processing, each of its rows gets the call duration
+    latencies: List[float] = []
+    process_tenant_payments = main.process_tenant_payments
+
+    async def timed_process_tenant_payments(payments, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await process_tenant_payments(payments, *args, **kwargs)
+        finally:
+            latencies.extend([time.perf_counter() - started] * len(payments))
+
+    main.process_tenant_payments = timed_process_tenant_payments
+
+    # Direct backend: the rows of a chunk get the duration of its write
+    post = direct.DirectPaymentWriter.post
+
+    async def timed_post(writer, tenants):
+        started = time.perf_counter()
+        try:
+            return await post(writer, tenants)
+        finally:
+            latencies.extend([time.perf_counter() - started] * sum(len(tenant.payments) for tenant in tenants))
+
+    direct.DirectPaymentWriter.post = timed_post
+
+    rss_before = peak_rss_mb()
+    complete = {}
+    errors = 0
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://paymentprocessor', timeout=None) as client:
+        with open(csv_path, 'rb') as csv_file:
+            started = time.perf_counter()
+            async with client.stream(
+                'POST', '/process-payments',
+                files={'file': ('bench.csv', csv_file, 'text/csv')},
+                data={'term': args.term, 'aggregate': str(args.aggregate).lower()},
+                headers={'organizationid': 'bench'},
+            ) as response:
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[6:])
+                    if event['status'] == 'result':
+                        continue
+                    if event['status'] == 'error':
+                        errors += 1
+                    elif event['status'] == 'complete':
+                        complete = event
+            elapsed = time.perf_counter() - started
+
+    main.process_tenant_payments = process_tenant_payments
+    direct.DirectPaymentWriter.post = post
+    rows = complete.get('total', 0)
+    return dict(
+        rows=rows,
+        successful=complete.get('successful', 0),
+        failed=complete.get('failed', 0),
+        error_events=errors,
+        elapsed_seconds=round(elapsed, 3),
+        rows_per_second=round(rows / elapsed, 1) if elapsed else 0.0,
+        row_latency_p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        row_latency_p99_ms=round(percentile(latencies, 99) * 1000, 2),
+        row_latency_mean_ms=round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        rss_before_mb=round(rss_before, 1),
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        gateway_calls={f"{method} {path}": count for (method, path), count in gateway.calls.items()} if gateway else None,
+        gateway_errors=gateway.errors if gateway else None,
+    )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+
+    from bench.generate import write_csv
+
+    csv_path = args.csv
+    generated = None
+    if csv_path is None:
+        generated = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='')
+        with generated:
+            write_csv(generated, args.rows, args.tenants, args.repeat_share, args.duplicate_rate, args.seed)
+        csv_path = generated.name
+    try:
+        report = asyncio.run(benchmark(args, csv_path))
+    finally:
+        if generated is not None:
+            os.unlink(generated.name)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>22}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Buffered bulk writer for MongoDB collections.
+
+Documents are not inserted one by one: they are buffered and written with
+insert_many(ordered=False) when the buffer is full or when the flush interval
+elapses, and whatever is left is flushed on close. Write failures are kept so
+the caller can report them. Subclasses override _write to buffer other kinds of
+writes (e.g. bulk_write updates).
+"""
+import asyncio
+import logging
+from typing import List, Optional
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from database import get_database
+from metrics import observe_mongo
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """
+    Buffer documents of a collection and write them in batches.
+
+    Args:
+        collection_name (str): The MongoDB collection written to.
+        batch_size (int): Flush as soon as the buffer holds this many documents.
+        flush_interval (float): Flush buffered documents at least this often (seconds).
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+        label (str): What the documents are, used in the error messages.
+    """
+
+    def __init__(self, collection_name: str, batch_size: int, flush_interval: float,
+                 db_name: Optional[str] = None, label: str = 'documents'):
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.db_name = db_name
+        self.label = label
+        self.written = 0
+        self.failed = 0
+        self._buffer: List[dict] = []
+        self._errors: List[str] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def add(self, document: dict) -> None:
+        """Buffer one document, flushing when the batch is full"""
+        if self._closed:
+            raise RuntimeError(f"{type(self).__name__} is closed")
+        self._buffer.append(document)
+        if self._timer is None and self.flush_interval > 0:
+            self._timer = asyncio.ensure_future(self._flush_periodically())
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def _flush_periodically(self) -> None:
+        while not self._closed:
+            await asyncio.sleep(self.flush_interval)
+            # Shielded so that close() cancelling the timer never interrupts a write in progress
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        """Write the buffered documents"""
+        async with self._lock:
+            if not self._buffer:
+                return
+            documents, self._buffer = self._buffer, []
+            collection = get_database(self.db_name)[self.collection_name]
+            try:
+                self.written += await self._write(collection, documents)
+            except BulkWriteError as e:
+                # With ordered=False every document without a write error was written
+                write_errors = e.details.get('writeErrors', [])
+                self.written += len(documents) - len(write_errors)
+                self.failed += len(write_errors) or len(documents)
+                message = f"Failed to log {len(write_errors) or len(documents)} {self.label}: {str(e)}"
+                logger.error(message)
+                self._errors.append(message)
+            except PyMongoError as e:
+                self.failed += len(documents)
+                message = f"Failed to log {len(documents)} {self.label}: {str(e)}"
+                logger.error(message)
+                self._errors.append(message)
+            else:
+                logger.debug(f"Logged {len(documents)} {self.label}")
+
+    async def _write(self, collection, documents: list) -> int:
+        """Write a batch, returns the number of documents written"""
+        with observe_mongo(f"insert_many.{self.collection_name}"):
+            result = await collection.insert_many(documents, ordered=False)
+        return len(result.inserted_ids)
+
+    def drain_errors(self) -> List[str]:
+        """Return the write failures not reported yet"""
+        errors, self._errors = self._errors, []
+        return errors
+
+    async def close(self) -> None:
+        """Stop the periodic flush and write everything still buffered"""
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+            self._timer = None
+        await self.flush()
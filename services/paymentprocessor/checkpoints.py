@@ -0,0 +1,167 @@
+"""
+Checkpoints of imported files.
+
+An import is identified by the organization, the term and the SHA-256 of the uploaded
+file. Every row whose payment was posted is recorded as committed; when the same file
+is uploaded again for the same term, the committed rows are skipped and only the rest
+of the file is processed.
+
+While an import runs it holds a lease on its key (renewed in the background), so the
+same file is never imported twice at the same time. A lease left by a stopped instance
+expires after IMPORT_LEASE_TTL seconds.
+
+Committed rows are written in batches: a row posted right before the service stopped
+may not be recorded, a re-run then reports it as an existing payment reference.
+"""
+import asyncio
+import hashlib
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Set
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from bulk_writer import BulkWriter
+from config import IMPORT_LEASE_TTL, PENDING_PAYMENTS_BATCH_SIZE, PENDING_PAYMENTS_FLUSH_INTERVAL
+from database import IMPORT_CHECKPOINTS_COLLECTION, IMPORT_RUNS_COLLECTION, get_database
+
+logger = logging.getLogger(__name__)
+
+
+class ImportInProgressError(Exception):
+    """The same file is already being imported for the term"""
+
+    def __init__(self, term: str):
+        self.term = term
+        super().__init__(f"This file is already being imported for term {term}")
+
+
+def import_key(organization_id: Optional[str], term: str, content_hash: str) -> str:
+    """Identifier of the import of a file for a term by an organization"""
+    return hashlib.sha256(f"{organization_id or ''}\n{term}\n{content_hash}".encode()).hexdigest()
+
+
+class CheckpointWriter(BulkWriter):
+    """Committed rows of an import, written in batches"""
+
+    def __init__(self, key: str, db_name: Optional[str] = None):
+        super().__init__(IMPORT_CHECKPOINTS_COLLECTION, PENDING_PAYMENTS_BATCH_SIZE, PENDING_PAYMENTS_FLUSH_INTERVAL,
+                         db_name, label='import checkpoints')
+        self.key = key
+
+
+class ImportCheckpoint:
+    """
+    Committed rows of an imported file, and the lease of the running import.
+
+    Usage:
+        checkpoint = ImportCheckpoint(organization_id, term, content_hash)
+        committed = await checkpoint.open()  # raises ImportInProgressError
+        ...
+        await checkpoint.commit(row_number)
+        ...
+        await checkpoint.close(summary)
+
+    Args:
+        organization_id (str): Organization importing the file.
+        term (str): Term the payments are posted to.
+        content_hash (str): SHA-256 of the uploaded file.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+    """
+
+    def __init__(self, organization_id: Optional[str], term: str, content_hash: str,
+                 db_name: Optional[str] = None, lease_ttl: float = IMPORT_LEASE_TTL):
+        self.organization_id = organization_id
+        self.term = term
+        self.content_hash = content_hash
+        self.db_name = db_name
+        self.lease_ttl = lease_ttl
+        self.key = import_key(organization_id, term, content_hash)
+        self.committed: Set[int] = set()
+        self._owner = uuid.uuid4().hex
+        self._writer = CheckpointWriter(self.key, db_name)
+        self._renewal: Optional[asyncio.Task] = None
+
+    def _runs(self):
+        return get_database(self.db_name)[IMPORT_RUNS_COLLECTION]
+
+    async def _acquire(self) -> None:
+        now = datetime.utcnow()
+        try:
+            await self._runs().update_one(
+                # No lease, or an expired one
+                {'_id': self.key, 'leaseUntil': {'$not': {'$gt': now}}},
+                {
+                    '$set': {
+                        'leaseOwner': self._owner,
+                        'leaseUntil': now + timedelta(seconds=self.lease_ttl),
+                        'updatedAt': now,
+                    },
+                    '$setOnInsert': {
+                        'organizationId': self.organization_id,
+                        'term': self.term,
+                        'contentHash': self.content_hash,
+                        'createdAt': now,
+                    },
+                    '$inc': {'runs': 1},
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The document exists with a lease that has not expired
+            raise ImportInProgressError(self.term)
+
+    async def _renew_lease(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                now = datetime.utcnow()
+                await self._runs().update_one(
+                    {'_id': self.key, 'leaseOwner': self._owner},
+                    {'$set': {'leaseUntil': now + timedelta(seconds=self.lease_ttl), 'updatedAt': now}},
+                )
+            except PyMongoError as e:
+                logger.warning(f"Could not renew the lease of import {self.key}: {str(e)}")
+
+    async def open(self) -> Set[int]:
+        """
+        Take the lease of the import and load its committed rows.
+
+        Returns:
+            Set[int]: Row numbers committed by the previous runs.
+        """
+        await self._acquire()
+        self._renewal = asyncio.ensure_future(self._renew_lease())
+        self.committed = await self.load_committed()
+        if self.committed:
+            logger.info(f"Resuming import {self.key}: {len(self.committed)} rows already committed")
+        return self.committed
+
+    async def load_committed(self) -> Set[int]:
+        """Row numbers committed by the previous runs, read without taking the lease (dry runs)"""
+        cursor = get_database(self.db_name)[IMPORT_CHECKPOINTS_COLLECTION].find(
+            {'importKey': self.key}, projection={'_id': 0, 'row': 1}
+        )
+        return {document['row'] async for document in cursor}
+
+    async def commit(self, row: int) -> None:
+        """Record a row whose payment was posted"""
+        if row in self.committed:
+            return
+        self.committed.add(row)
+        await self._writer.add(dict(importKey=self.key, row=row, createdAt=datetime.utcnow()))
+
+    async def close(self, summary: Optional[dict] = None) -> None:
+        """Write the remaining committed rows and release the lease, with the summary of the run"""
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+        await self._writer.close()
+        fields = dict(leaseUntil=None, updatedAt=datetime.utcnow(), committedRows=len(self.committed))
+        if summary is not None:
+            fields['lastRun'] = summary
+        try:
+            await self._runs().update_one({'_id': self.key, 'leaseOwner': self._owner}, {'$set': fields})
+        except PyMongoError as e:
+            logger.warning(f"Could not release the lease of import {self.key}: {str(e)}")
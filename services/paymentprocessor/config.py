@@ -0,0 +1,151 @@
+"""
+Environment driven configuration for the payment processor service.
+
+Every setting can be overridden with an environment variable of the same name.
+"""
+import os
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    """Read a boolean flag from the environment ("1", "true", "yes", "on" are truthy)"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# API configuration
+API_BASE_URL = os.getenv('API_BASE_URL', 'http://api:8200')
+GATEWAY_URL = os.getenv('GATEWAY_URL', 'http://gateway:80')
+# Get the MongoDB connection string from the environment variable
+MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost:27017')  # Default to localhost
+
+# Gateway HTTP client: connection pool limits
+GATEWAY_MAX_CONNECTIONS = int(os.getenv('GATEWAY_MAX_CONNECTIONS', '100'))
+GATEWAY_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('GATEWAY_MAX_KEEPALIVE_CONNECTIONS', '20'))
+GATEWAY_KEEPALIVE_EXPIRY = float(os.getenv('GATEWAY_KEEPALIVE_EXPIRY', '30'))  # seconds
+# HTTP/2 needs the optional "h2" package (httpx[http2])
+GATEWAY_HTTP2 = _env_bool('GATEWAY_HTTP2', False)
+
+# Gateway HTTP client: per-phase timeouts (seconds)
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv('GATEWAY_CONNECT_TIMEOUT', '5'))
+GATEWAY_READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', '30'))
+GATEWAY_WRITE_TIMEOUT = float(os.getenv('GATEWAY_WRITE_TIMEOUT', '30'))
+GATEWAY_POOL_TIMEOUT = float(os.getenv('GATEWAY_POOL_TIMEOUT', '10'))
+
+# Gateway calls: retries of transient failures (attempts include the first call) and circuit breaker
+GATEWAY_RETRY_ATTEMPTS = max(1, int(os.getenv('GATEWAY_RETRY_ATTEMPTS', '4')))
+GATEWAY_RETRY_BASE_DELAY = float(os.getenv('GATEWAY_RETRY_BASE_DELAY', '0.5'))  # seconds
+GATEWAY_RETRY_MAX_DELAY = float(os.getenv('GATEWAY_RETRY_MAX_DELAY', '10'))  # seconds
+GATEWAY_BREAKER_FAILURE_THRESHOLD = max(1, int(os.getenv('GATEWAY_BREAKER_FAILURE_THRESHOLD', '5')))
+GATEWAY_BREAKER_RESET_TIMEOUT = float(os.getenv('GATEWAY_BREAKER_RESET_TIMEOUT', '15'))  # seconds
+GATEWAY_BREAKER_MAX_WAIT = float(os.getenv('GATEWAY_BREAKER_MAX_WAIT', '300'))  # seconds
+
+# Gateway calls: service-wide AIMD flow control shared by every import (see flow_control.py). The limit of
+# calls in flight grows while the gateway answers in time and is multiplied by GATEWAY_FLOW_DECREASE on
+# errors, or when the smoothed latency exceeds both GATEWAY_FLOW_LATENCY_TARGET and GATEWAY_FLOW_LATENCY_TOLERANCE
+# times the lowest latency seen. The calls waiting for a slot are served fairly between organizations.
+GATEWAY_FLOW_CONTROL = _env_bool('GATEWAY_FLOW_CONTROL', True)
+GATEWAY_FLOW_INITIAL_LIMIT = max(1, int(os.getenv('GATEWAY_FLOW_INITIAL_LIMIT', '16')))
+GATEWAY_FLOW_MIN_LIMIT = max(1, int(os.getenv('GATEWAY_FLOW_MIN_LIMIT', '2')))
+GATEWAY_FLOW_MAX_LIMIT = max(1, int(os.getenv('GATEWAY_FLOW_MAX_LIMIT', str(GATEWAY_MAX_CONNECTIONS))))
+GATEWAY_FLOW_LATENCY_TARGET = float(os.getenv('GATEWAY_FLOW_LATENCY_TARGET', '0.25'))  # seconds
+GATEWAY_FLOW_LATENCY_TOLERANCE = max(1.0, float(os.getenv('GATEWAY_FLOW_LATENCY_TOLERANCE', '3')))
+GATEWAY_FLOW_DECREASE = min(0.95, max(0.1, float(os.getenv('GATEWAY_FLOW_DECREASE', '0.7'))))
+
+# MongoDB client
+MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'bomatech')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+# Create the indexes used by the duplicate checks and pendingPayments lookups on startup
+MONGO_ENSURE_INDEXES = _env_bool('MONGO_ENSURE_INDEXES', True)
+
+# Import execution: number of CSV rows processed concurrently
+PAYMENT_CONCURRENCY = max(1, int(os.getenv('PAYMENT_CONCURRENCY', '8')))
+# Number of rows scheduled ahead of the oldest unfinished row (defaults to 4x the concurrency)
+PAYMENT_WINDOW = max(PAYMENT_CONCURRENCY, int(os.getenv('PAYMENT_WINDOW', str(PAYMENT_CONCURRENCY * 4))))
+# How payments are posted: 'gateway' (rent API PATCH per row) or 'direct' (bulk_write to occupants, see direct.py)
+PAYMENT_BACKEND = os.getenv('PAYMENT_BACKEND', 'gateway').strip().lower()
+# Direct backend: how long an import (appending payments) or a recompute holds the lock of a rent.
+# Locks are released when done, the lock of a stopped instance expires after this time.
+RENT_LOCK_TTL = float(os.getenv('RENT_LOCK_TTL', '120'))  # seconds
+
+# Redis, shared with the other services (the password can also be part of the URL)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis')
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', '')
+
+# Work queue: the rows of an import are processed by every replica through Redis (see workqueue.py).
+# Rows are partitioned by tenant (WORK_QUEUE_PARTITIONS must be the same on every replica), a replica
+# consumes up to WORK_QUEUE_WORKER_PARTITIONS partitions at a time and lets a partition go after
+# WORK_QUEUE_IDLE_TIMEOUT seconds without tasks. The importing instance publishes up to WORK_QUEUE_WINDOW
+# chunks ahead of the oldest unfinished one; after WORK_QUEUE_RESULT_TIMEOUT seconds without outcome, the
+# rows no worker took fail (the rows a worker took are still waited for).
+WORK_QUEUE = _env_bool('WORK_QUEUE', False)
+WORK_QUEUE_PREFIX = os.getenv('WORK_QUEUE_PREFIX', 'paymentprocessor')
+WORK_QUEUE_PARTITIONS = max(1, int(os.getenv('WORK_QUEUE_PARTITIONS', '16')))
+WORK_QUEUE_WORKER_PARTITIONS = max(1, int(os.getenv('WORK_QUEUE_WORKER_PARTITIONS', '4')))
+WORK_QUEUE_LEASE_TTL = float(os.getenv('WORK_QUEUE_LEASE_TTL', '30'))  # seconds
+WORK_QUEUE_IDLE_TIMEOUT = float(os.getenv('WORK_QUEUE_IDLE_TIMEOUT', '5'))  # seconds
+WORK_QUEUE_POLL_INTERVAL = float(os.getenv('WORK_QUEUE_POLL_INTERVAL', '1'))  # seconds
+WORK_QUEUE_WINDOW = max(1, int(os.getenv('WORK_QUEUE_WINDOW', '4')))
+WORK_QUEUE_RESULT_TIMEOUT = float(os.getenv('WORK_QUEUE_RESULT_TIMEOUT', '900'))  # seconds
+
+# Startup warm-up (see warmup.py): connections opened to the gateway and to MongoDB before the instance
+# reports ready (0 disables the priming), the gateway path requested to open them and to check that the
+# gateway is reachable, and the timeout of each dependency check of /readyz
+WARMUP_CONNECTIONS = max(0, int(os.getenv('WARMUP_CONNECTIONS', str(PAYMENT_CONCURRENCY))))
+GATEWAY_HEALTH_PATH = os.getenv('GATEWAY_HEALTH_PATH', '/')
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', '2'))  # seconds
+
+# Batch duplicate detection: number of references per $in query
+DUPLICATE_CHECK_CHUNK_SIZE = max(1, int(os.getenv('DUPLICATE_CHECK_CHUNK_SIZE', '1000')))
+
+# Tenant resolution cache: reference -> tenant id / hasPayments, per organization
+TENANT_CACHE_MAX_SIZE = int(os.getenv('TENANT_CACHE_MAX_SIZE', '50000'))
+TENANT_CACHE_TTL = float(os.getenv('TENANT_CACHE_TTL', '300'))  # seconds
+# Unknown references are cached for a shorter time so that newly created tenants show up quickly
+TENANT_CACHE_NEGATIVE_TTL = float(os.getenv('TENANT_CACHE_NEGATIVE_TTL', '60'))  # seconds
+
+# pendingPayments buffered writer: flush when the buffer holds this many documents or after this many seconds
+PENDING_PAYMENTS_BATCH_SIZE = max(1, int(os.getenv('PENDING_PAYMENTS_BATCH_SIZE', '500')))
+PENDING_PAYMENTS_FLUSH_INTERVAL = float(os.getenv('PENDING_PAYMENTS_FLUSH_INTERVAL', '1.0'))  # seconds
+# Replay of pendingPayments: how long a replay holds the documents it is processing
+PENDING_REPLAY_CLAIM_TTL = float(os.getenv('PENDING_REPLAY_CLAIM_TTL', '600'))  # seconds
+
+# Streaming CSV ingestion: rows parsed (and held in memory) at a time, and the file encoding
+CSV_CHUNK_ROWS = max(1, int(os.getenv('CSV_CHUNK_ROWS', '1000')))
+CSV_ENCODING = os.getenv('CSV_ENCODING', 'utf-8')
+
+# Date parsing: maximum number of memoized raw date strings per parser
+DATE_CACHE_SIZE = max(1, int(os.getenv('DATE_CACHE_SIZE', '10000')))
+
+# Background import jobs: imports running at the same time, heartbeat of a running job (a job
+# without heartbeat for IMPORT_JOB_STALE_AFTER seconds is reported as interrupted), how often
+# job events and results are written and polled by the event streams, and how long jobs are kept
+IMPORT_JOB_CONCURRENCY = max(1, int(os.getenv('IMPORT_JOB_CONCURRENCY', '2')))
+IMPORT_JOB_HEARTBEAT_INTERVAL = float(os.getenv('IMPORT_JOB_HEARTBEAT_INTERVAL', '10'))  # seconds
+IMPORT_JOB_STALE_AFTER = float(os.getenv('IMPORT_JOB_STALE_AFTER', '60'))  # seconds
+IMPORT_JOB_FLUSH_INTERVAL = float(os.getenv('IMPORT_JOB_FLUSH_INTERVAL', '0.5'))  # seconds
+IMPORT_JOB_POLL_INTERVAL = float(os.getenv('IMPORT_JOB_POLL_INTERVAL', '1'))  # seconds
+IMPORT_JOB_RETENTION = int(os.getenv('IMPORT_JOB_RETENTION', str(7 * 24 * 3600)))  # seconds
+
+# Checkpointed imports: rows committed by an import are recorded per file (content hash),
+# term and organization, so that uploading the same file again only processes the rest.
+# An import holds a lease on its file while it runs, the same file cannot be imported twice at once.
+# The checkpoint is keyed by the hash of the file, read once before the first row; without checkpoints
+# the rows are counted while the file is parsed instead.
+IMPORT_CHECKPOINTS = _env_bool('IMPORT_CHECKPOINTS', True)
+IMPORT_LEASE_TTL = float(os.getenv('IMPORT_LEASE_TTL', '60'))  # seconds
+IMPORT_CHECKPOINT_RETENTION = int(os.getenv('IMPORT_CHECKPOINT_RETENTION', str(30 * 24 * 3600)))  # seconds
+
+# Import reports: per-row results of every import, stored in MongoDB (any instance serves them)
+# and kept for IMPORT_REPORT_RETENTION seconds
+IMPORT_REPORT_RETENTION = int(os.getenv('IMPORT_REPORT_RETENTION', str(7 * 24 * 3600)))  # seconds
+
+# Logging: level (debug, info, warning, error), output format (text or json) and the fraction of
+# per-row debug records that are kept (1 keeps all of them, 0.01 keeps one in a hundred)
+LOGGER_LEVEL = os.getenv('LOGGER_LEVEL', 'info')
+LOGGER_FORMAT = os.getenv('LOGGER_FORMAT', 'text')
+LOGGER_ROW_SAMPLE_RATE = min(1.0, max(0.0, float(os.getenv('LOGGER_ROW_SAMPLE_RATE', '1'))))
@@ -0,0 +1,157 @@
+"""
+Process-wide MongoDB client.
+
+A single AsyncIOMotorClient is created when the application starts and shared by
+every request, so all queries reuse the same connection pool. The indexes backing
+the duplicate payment check, the pendingPayments lookups, the background import
+jobs, the import checkpoints and the import reports are created by the startup warm-up (see warmup).
+"""
+import logging
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+from config import (
+    IMPORT_CHECKPOINT_RETENTION,
+    IMPORT_JOB_RETENTION,
+    IMPORT_REPORT_RETENTION,
+    MONGO_DB_NAME,
+    MONGO_MAX_IDLE_TIME_MS,
+    MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_URL,
+)
+from metrics import MongoPoolListener
+
+logger = logging.getLogger(__name__)
+
+OCCUPANTS_COLLECTION = 'occupants'
+PENDING_PAYMENTS_COLLECTION = 'pendingPayments'
+IMPORT_JOBS_COLLECTION = 'paymentImportJobs'
+IMPORT_EVENTS_COLLECTION = 'paymentImportEvents'
+IMPORT_RESULTS_COLLECTION = 'paymentImportResults'
+IMPORT_RUNS_COLLECTION = 'paymentImportRuns'
+IMPORT_CHECKPOINTS_COLLECTION = 'paymentImportCheckpoints'
+RENT_RECOMPUTES_COLLECTION = 'paymentRecomputes'
+IMPORT_REPORTS_COLLECTION = 'paymentImportReports'
+IMPORT_REPORT_ROWS_COLLECTION = 'paymentImportReportRows'
+
+# Indexes created on startup, per collection
+INDEXES = {
+    OCCUPANTS_COLLECTION: [
+        IndexModel([("rents.payments.reference", ASCENDING)], name="rents_payments_reference"),
+    ],
+    PENDING_PAYMENTS_COLLECTION: [
+        IndexModel([("paymentReference", ASCENDING)], name="paymentReference"),
+        IndexModel([("tenantId", ASCENDING), ("dateCreated", ASCENDING)], name="tenantId_dateCreated"),
+        IndexModel([("dateCreated", ASCENDING)], name="dateCreated"),
+        IndexModel([("status", ASCENDING), ("dateCreated", ASCENDING)], name="status_dateCreated"),
+    ],
+    # Background import jobs, removed IMPORT_JOB_RETENTION seconds after their creation
+    IMPORT_JOBS_COLLECTION: [
+        IndexModel([("organizationId", ASCENDING), ("createdAt", ASCENDING)], name="organizationId_createdAt"),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=IMPORT_JOB_RETENTION),
+    ],
+    IMPORT_EVENTS_COLLECTION: [
+        IndexModel([("jobId", ASCENDING), ("seq", ASCENDING)], name="jobId_seq", unique=True),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=IMPORT_JOB_RETENTION),
+    ],
+    IMPORT_RESULTS_COLLECTION: [
+        IndexModel([("jobId", ASCENDING), ("row", ASCENDING)], name="jobId_row"),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=IMPORT_JOB_RETENTION),
+    ],
+    # Checkpointed imports, removed IMPORT_CHECKPOINT_RETENTION seconds after their last run
+    IMPORT_RUNS_COLLECTION: [
+        IndexModel([("updatedAt", ASCENDING)], name="updatedAt_ttl", expireAfterSeconds=IMPORT_CHECKPOINT_RETENTION),
+    ],
+    IMPORT_CHECKPOINTS_COLLECTION: [
+        IndexModel([("importKey", ASCENDING), ("row", ASCENDING)], name="importKey_row", unique=True),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=IMPORT_CHECKPOINT_RETENTION),
+    ],
+    # Rent recomputes queued by the direct write path, removed once sent
+    RENT_RECOMPUTES_COLLECTION: [
+        IndexModel([("organizationId", ASCENDING)], name="organizationId"),
+    ],
+    # Import reports, served by any instance and removed after IMPORT_REPORT_RETENTION
+    IMPORT_REPORTS_COLLECTION: [
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=IMPORT_REPORT_RETENTION),
+    ],
+    IMPORT_REPORT_ROWS_COLLECTION: [
+        IndexModel([("importId", ASCENDING), ("block", ASCENDING)], name="importId_block", unique=True),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=IMPORT_REPORT_RETENTION),
+    ],
+}
+
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def create_mongo_client() -> AsyncIOMotorClient:
+    """Build a Motor client configured from the MONGO_* settings"""
+    return AsyncIOMotorClient(
+        MONGO_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        # Pool usage is exported as metrics
+        event_listeners=[MongoPoolListener()],
+    )
+
+
+def get_mongo_client() -> AsyncIOMotorClient:
+    """
+    Return the shared Motor client.
+
+    The client is normally created by the application lifespan; it is created
+    lazily here so that the database helpers also work outside of a running
+    application.
+    """
+    global _client
+    if _client is None:
+        _client = create_mongo_client()
+    return _client
+
+
+def get_database(db_name: Optional[str] = None) -> AsyncIOMotorDatabase:
+    """Return a database handle from the shared client (defaults to MONGO_DB_NAME)"""
+    return get_mongo_client()[db_name or MONGO_DB_NAME]
+
+
+async def ensure_indexes(db_name: Optional[str] = None) -> None:
+    """
+    Create the indexes used by the payment processor if they do not exist yet.
+
+    Failures are logged and not raised: a missing index slows the service down
+    but must not prevent it from starting (e.g. when the user lacks createIndex rights).
+    """
+    db = get_database(db_name)
+    for collection_name, indexes in INDEXES.items():
+        try:
+            names = await db[collection_name].create_indexes(indexes)
+            logger.info(f"Ensured indexes on {collection_name}: {', '.join(names)}")
+        except PyMongoError as e:
+            logger.warning(f"Could not create indexes on {collection_name}: {str(e)}")
+
+
+async def start_mongo_client() -> AsyncIOMotorClient:
+    """
+    Create the shared Motor client (called from the application lifespan).
+
+    No connection is made here, the indexes are created and the pool is primed by the
+    warm-up (see warmup) so that the service starts listening even while MongoDB is down.
+    """
+    client = get_mongo_client()
+    logger.info(f"MongoDB client started (maxPoolSize={MONGO_MAX_POOL_SIZE}, minPoolSize={MONGO_MIN_POOL_SIZE})")
+    return client
+
+
+async def close_mongo_client() -> None:
+    """Close the shared Motor client"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+        logger.info("MongoDB client closed")
@@ -0,0 +1,154 @@
+"""
+Payment date parsing.
+
+Bank exports nearly always use one date format and repeat a small set of dates,
+so a DateParser:
+- detects the dominant format of a file from a sample of its values,
+- parses values with a strict strptime of that format (the fast path),
+- memoizes raw string -> normalized DD/MM/YYYY,
+- falls back to the other known formats, then to dateutil (day first) for outliers.
+
+A value that only dateutil understands and that reads as a different date
+day-first and month-first is reported as ambiguous instead of being guessed.
+"""
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple
+
+from dateutil import parser as dateutil_parser
+
+from config import DATE_CACHE_SIZE
+
+if TYPE_CHECKING:
+    # Only the columns of the pipeline are pandas objects, the service does not load pandas for single dates
+    import pandas as pd
+
+# Normalized output format, the one expected by the rents API
+OUTPUT_FORMAT = '%d/%m/%Y'
+
+# Formats tried by the detection and the strict fallback, day first before year first
+KNOWN_FORMATS = (
+    '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y', '%d-%m-%y', '%d.%m.%y',
+    '%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d',
+    '%d %b %Y', '%d-%b-%Y', '%d %B %Y', '%d-%b-%y',
+    '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+)
+
+# Years outside of this range mean the format did not really match (e.g. '24' read by %Y)
+MIN_YEAR = 1900
+MAX_YEAR = 2100
+
+
+class AmbiguousDateError(ValueError):
+    """The date reads differently day first and month first"""
+
+
+def _strptime(value: str, date_format: str) -> Optional[datetime]:
+    try:
+        parsed = datetime.strptime(value, date_format)
+    except ValueError:
+        return None
+    if not MIN_YEAR <= parsed.year <= MAX_YEAR:
+        return None
+    return parsed
+
+
+class DateParser:
+    """
+    Parse and normalize the payment dates of a file.
+
+    Args:
+        date_format (str): Format to use for the fast path, None to detect it with detect().
+        cache_size (int): Maximum number of memoized raw values.
+    """
+
+    def __init__(self, date_format: Optional[str] = None, cache_size: int = DATE_CACHE_SIZE):
+        self.format = date_format
+        self.cache_size = cache_size
+        # raw value -> (normalized date, None) or (None, error)
+        self._cache: Dict[str, Tuple[Optional[str], Optional[ValueError]]] = {}
+
+    def detect(self, values: Iterable[str], sample_size: int = 500) -> Optional[str]:
+        """
+        Pick the known format matching the most values of a sample (None when none matches).
+        The detected format is used by the following calls to parse().
+        """
+        sample = []
+        for value in values:
+            value = str(value).strip()
+            if value and value not in sample:
+                sample.append(value)
+                if len(sample) >= sample_size:
+                    break
+
+        best_format, best_count = None, 0
+        for date_format in KNOWN_FORMATS:
+            count = sum(1 for value in sample if _strptime(value, date_format) is not None)
+            if count > best_count:
+                best_format, best_count = date_format, count
+
+        if best_format != self.format:
+            self._cache.clear()
+        self.format = best_format
+        return best_format
+
+    def _parse_uncached(self, value: str) -> datetime:
+        # Fast path: the dominant format of the file
+        if self.format:
+            parsed = _strptime(value, self.format)
+            if parsed is not None:
+                return parsed
+
+        # Outliers: the other known formats, then dateutil
+        for date_format in KNOWN_FORMATS:
+            if date_format != self.format:
+                parsed = _strptime(value, date_format)
+                if parsed is not None:
+                    return parsed
+
+        try:
+            day_first = dateutil_parser.parse(value, dayfirst=True)
+            month_first = dateutil_parser.parse(value, dayfirst=False)
+        except (ValueError, TypeError, OverflowError):
+            raise ValueError(f"Invalid date format: {value}. Please use DD/MM/YYYY format.")
+        if day_first.date() != month_first.date():
+            raise AmbiguousDateError(
+                f"Ambiguous date: {value} could be {day_first.strftime(OUTPUT_FORMAT)} "
+                f"or {month_first.strftime(OUTPUT_FORMAT)}. Please use DD/MM/YYYY format."
+            )
+        return day_first
+
+    def _lookup(self, value: str) -> Tuple[Optional[str], Optional[ValueError]]:
+        cached = self._cache.get(value)
+        if cached is None:
+            try:
+                cached = (self._parse_uncached(value).strftime(OUTPUT_FORMAT), None)
+            except ValueError as e:
+                cached = (None, e)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[value] = cached
+        return cached
+
+    def parse(self, value: str) -> str:
+        """Normalize one date to DD/MM/YYYY, raises ValueError (AmbiguousDateError) when it cannot"""
+        normalized, error = self._lookup(str(value).strip())
+        if error is not None:
+            raise type(error)(str(error))
+        return normalized
+
+    def parse_series(self, values: 'pd.Series') -> Tuple['pd.Series', 'pd.Series']:
+        """
+        Normalize a column of dates, parsing each distinct value once.
+
+        Returns (dates, errors): the DD/MM/YYYY dates (None when invalid) and the
+        ValueError (or AmbiguousDateError) of each invalid value (None when valid).
+        """
+        outcomes = {value: self._lookup(value) for value in values.unique() if value != ''}
+        outcomes[''] = (None, ValueError('Missing date'))
+        dates = values.map(lambda value: outcomes[value][0])
+        errors = values.map(lambda value: outcomes[value][1])
+        return dates, errors
+
+
+# Parser of already normalized dates (DD/MM/YYYY fast path), shared by the whole service
+payment_date_parser = DateParser(OUTPUT_FORMAT)
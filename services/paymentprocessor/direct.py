@@ -0,0 +1,418 @@
+"""
+Direct MongoDB write path for imported payments (PAYMENT_BACKEND=direct).
+
+The gateway path reads the payments of the tenant's rent and sends the whole array
+back with a PATCH, for every row: two or three HTTP hops through the gateway and the
+API, and a read-modify-write race on the payments array. The direct path instead:
+
+- resolves tenants from the occupants collection (see MongoTenantResolver),
+- appends the payments of a chunk of rows with one bulk_write, one atomic $push
+  per tenant onto the payments of the rent of the term,
+- queues a recompute of each touched rent: the rent totals and balances (of the term
+  and of the following ones) are computed by the API, so the recompute is one PATCH
+  per tenant and term, sent when the import has appended all its payments, with the
+  payments now stored and the settlement fields (description, promo, extra charge) of
+  the tenant's last row.
+
+Recomputes are recorded in the paymentRecomputes collection before they are sent and
+removed once the API accepted them. An import only sends the recomputes it queued, and the
+failed ones of the organization. They are also sent when the import stops early (disconnected
+client, error); only a recompute that a stopped instance did not send waits for the next
+import touching the rent.
+
+The recompute PATCH sends the payments read from the rent, and the API rewrites the whole
+occupant document: a payment pushed between the read and the PATCH would be lost. The
+recompute document of a rent is therefore also its lock (lockId, lockedUntil): an import
+holds it while it appends payments to the rent and queues its recompute, a recompute while
+it reads the payments and sends them. Neither waits for a lock while holding another one.
+Every queued recompute increments the version of the document, which is only removed when
+its version is the one that was sent.
+"""
+import asyncio
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from config import GATEWAY_URL, PAYMENT_CONCURRENCY, RENT_LOCK_TTL
+from database import OCCUPANTS_COLLECTION, RENT_RECOMPUTES_COLLECTION, get_database
+from http_client import get_gateway_client
+from metrics import observe_mongo, observe_stage
+from resilience import gateway_request
+from tenants import TenantRecord, TenantResolver
+
+logger = logging.getLogger(__name__)
+
+RECOMPUTE_PENDING = 'pending'
+RECOMPUTE_FAILED = 'failed'
+
+# Seconds between two attempts to take the lock of a rent held by another import or recompute
+LOCK_POLL_INTERVAL = 0.05
+# Recomputes of a rent whose payments changed while it was recomputed (its lock expired)
+RECOMPUTE_ATTEMPTS = 3
+
+
+def occupant_id(tenant_id: str):
+    """_id of an occupant document from the tenant id returned by the API"""
+    return ObjectId(tenant_id) if ObjectId.is_valid(tenant_id) else tenant_id
+
+
+def rent_term(term: str) -> int:
+    """Term of a rent document (YYYYMMDDHH) from an import term (YYYY.MM)"""
+    year, month = term.split('.')
+    return int(f"{year}{month.zfill(2)}0100")
+
+
+class MongoTenantResolver(TenantResolver):
+    """
+    Tenant resolver reading the occupants collection instead of calling the gateway.
+
+    Records only hold the tenant id and reference, like the records of the gateway lookups.
+    """
+
+    def __init__(self, db_name: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.db_name = db_name
+
+    async def _fetch(self, organization_id: str, headers: dict, reference: Optional[str] = None) -> Dict[str, TenantRecord]:
+        query = {'realmId': organization_id}
+        if reference:
+            query['reference'] = reference
+        cursor = get_database(self.db_name)[OCCUPANTS_COLLECTION].find(query, projection={'_id': 1, 'reference': 1})
+        records: Dict[str, TenantRecord] = {}
+        with observe_mongo('find_tenants'):
+            async for occupant in cursor:
+                tenant_reference = str(occupant.get('reference') or '').strip()
+                if tenant_reference:
+                    records[tenant_reference] = TenantRecord(id=str(occupant['_id']), reference=tenant_reference)
+        return records
+
+
+@dataclass
+class TenantPayments:
+    """New payments of a tenant within a chunk, with the settlement fields of its last row"""
+    tenant_id: str
+    payments: List[dict]
+    settlement: dict
+
+
+class RentRecomputeQueue:
+    """
+    Recompute rents through the API, one PATCH per tenant and term.
+
+    The API rewrites the whole occupant document, so the recomputes are only sent once
+    every payment of the import was appended (send), and each one under the lock of its
+    rent (see lock): no payment is appended to the rent while it is recomputed.
+
+    Args:
+        organization_id (str): Organization of the rents.
+        term (str): Term of the rents, as YYYY.MM.
+        headers (dict): Gateway headers of the import.
+        concurrency (int): Recomputes sent at the same time.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+        lock_ttl (float): Seconds after which a lock that was not released expires.
+    """
+
+    def __init__(self, organization_id: str, term: str, headers: dict,
+                 concurrency: int = PAYMENT_CONCURRENCY, db_name: Optional[str] = None,
+                 lock_ttl: float = RENT_LOCK_TTL):
+        self.organization_id = organization_id
+        self.term = term
+        self.headers = headers
+        self.concurrency = max(1, concurrency)
+        self.db_name = db_name
+        self.lock_ttl = lock_ttl
+        self.lock_id = uuid.uuid4().hex  # Owner of the locks taken by this import
+        self.sent = 0
+        self._keys: Dict[str, None] = {}
+        self._errors: List[str] = []
+
+    @property
+    def queued(self) -> int:
+        """Recomputes queued by the import and not sent yet"""
+        return len(self._keys)
+
+    def _collection(self):
+        return get_database(self.db_name)[RENT_RECOMPUTES_COLLECTION]
+
+    def _key(self, tenant_id: str) -> str:
+        return f"{self.organization_id}:{tenant_id}:{self.term}"
+
+    def _lock_fields(self) -> dict:
+        return {'lockId': self.lock_id, 'lockedUntil': datetime.utcnow() + timedelta(seconds=self.lock_ttl)}
+
+    async def lock(self, tenant_ids: List[str]) -> List[str]:
+        """
+        Lock the rents of the tenants that no other import or recompute holds, without waiting.
+        Returns the tenant ids whose rent is locked, to be released with unlock.
+        """
+        keys = {self._key(tenant_id): tenant_id for tenant_id in tenant_ids}
+        now = datetime.utcnow()
+        collection = self._collection()
+        # The recompute document of the rent holds the lock, created (with nothing queued) when missing
+        operations = [
+            UpdateOne(
+                {'_id': key},
+                {'$setOnInsert': {'organizationId': self.organization_id, 'tenantId': tenant_id,
+                                  'term': self.term, 'createdAt': now}},
+                upsert=True,
+            )
+            for key, tenant_id in keys.items()
+        ]
+        with observe_mongo('lock_rents'):
+            try:
+                await collection.bulk_write(operations, ordered=False)
+            except BulkWriteError:
+                # Created at the same time by another import, the document exists either way
+                pass
+            await collection.update_many(
+                {'_id': {'$in': list(keys)}, 'lockedUntil': {'$not': {'$gt': now}}},
+                {'$set': self._lock_fields()},
+            )
+            locked = await collection.find(
+                {'_id': {'$in': list(keys)}, 'lockId': self.lock_id}, projection={'_id': 1}
+            ).to_list(length=None)
+        return [keys[document['_id']] for document in locked]
+
+    async def unlock(self, tenant_ids: List[str]) -> None:
+        """Release the locks of this import on the rents of the tenants"""
+        await self._unlock([self._key(tenant_id) for tenant_id in tenant_ids])
+
+    async def _unlock(self, keys: List[str]) -> None:
+        collection = self._collection()
+        try:
+            with observe_mongo('unlock_rents'):
+                # Documents created for the lock only: no recompute was queued (the payments were not recorded)
+                await collection.delete_many({'_id': {'$in': keys}, 'lockId': self.lock_id, 'status': {'$exists': False}})
+                await collection.update_many({'_id': {'$in': keys}, 'lockId': self.lock_id},
+                                             {'$unset': {'lockId': '', 'lockedUntil': ''}})
+        except PyMongoError as e:
+            logger.warning(f"Could not unlock {len(keys)} rents, their locks expire after {self.lock_ttl}s: {str(e)}")
+
+    async def add(self, tenants: List[TenantPayments]) -> None:
+        """
+        Record the recomputes of the tenants (their rents locked by this import), the settlement
+        fields of a later chunk win
+        """
+        if not tenants:
+            return
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {'_id': self._key(tenant.tenant_id)},
+                {
+                    '$set': {'settlement': tenant.settlement, 'status': RECOMPUTE_PENDING, 'updatedAt': now},
+                    '$inc': {'version': 1},
+                    '$setOnInsert': {'organizationId': self.organization_id, 'tenantId': tenant.tenant_id,
+                                     'term': self.term, 'createdAt': now},
+                },
+                upsert=True,
+            )
+            for tenant in tenants
+        ]
+        try:
+            with observe_mongo(f"bulk_write.{RENT_RECOMPUTES_COLLECTION}"):
+                await self._collection().bulk_write(operations, ordered=False)
+        except PyMongoError as e:
+            # The payments are recorded, only the totals of their rents stay stale
+            message = f"Failed to queue the recompute of {len(tenants)} rents: {str(e)}"
+            logger.error(message)
+            self._errors.append(message)
+            return
+        for tenant in tenants:
+            self._keys[self._key(tenant.tenant_id)] = None
+
+    async def send(self) -> int:
+        """
+        Send the recomputes queued by the import, and the failed ones of the organization.
+        Returns the number of recomputes sent.
+        """
+        try:
+            # Failed recomputes are not sent by any running import (queued again, they are pending)
+            async for document in self._collection().find(
+                    {'organizationId': self.organization_id, 'status': RECOMPUTE_FAILED}, projection={'_id': 1}):
+                self._keys.setdefault(document['_id'], None)
+        except PyMongoError as e:
+            logger.warning(f"Could not load the failed rent recomputes: {str(e)}")
+
+        keys, self._keys = list(self._keys), {}
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(key: str) -> None:
+            async with slots:
+                try:
+                    await self._recompute(key)
+                except Exception as e:
+                    message = f"Failed to recompute rent {key}: {str(e)}"
+                    logger.error(message)
+                    self._errors.append(message)
+
+        await asyncio.gather(*(send_one(key) for key in keys))
+        return self.sent
+
+    async def _claim(self, key: str) -> Optional[dict]:
+        """Lock the rent of a recompute, waiting while it is locked. None when there is nothing to recompute."""
+        while True:
+            now = datetime.utcnow()
+            with observe_mongo('lock_rents'):
+                recompute = await self._collection().find_one_and_update(
+                    {'_id': key, 'lockedUntil': {'$not': {'$gt': now}}},
+                    {'$set': self._lock_fields()},
+                    return_document=ReturnDocument.AFTER,
+                )
+                if recompute is None and await self._collection().count_documents({'_id': key}, limit=1) == 0:
+                    # Sent meanwhile by another import, with the payments appended by this one
+                    return None
+            if recompute is not None:
+                return recompute
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+    async def _recompute(self, key: str) -> None:
+        for _ in range(RECOMPUTE_ATTEMPTS):
+            recompute = await self._claim(key)
+            if recompute is None:
+                return
+            try:
+                if 'status' not in recompute or await self._send(key, recompute):
+                    return
+            finally:
+                await self._unlock([key])
+        raise RuntimeError("the payments of the rent kept changing while it was recomputed")
+
+    async def _send(self, key: str, recompute: dict) -> bool:
+        """
+        Send a recompute with the payments as stored (the rent locked by this import).
+        Returns False when the recompute was queued again meanwhile and must be sent again.
+        """
+        tenant_id, term = recompute['tenantId'], recompute['term']
+        with observe_mongo('find_rent_payments'):
+            occupant = await get_database(self.db_name)[OCCUPANTS_COLLECTION].find_one(
+                {'_id': occupant_id(tenant_id)}, projection={'rents': {'$elemMatch': {'term': rent_term(term)}}}
+            )
+        if not occupant or not occupant.get('rents'):
+            await self._collection().delete_one({'_id': key, 'lockId': self.lock_id})
+            return True
+
+        # Sent with the payments as stored, the API recomputes the rent and the following ones
+        payment_data = dict(
+            _id=tenant_id,
+            payments=occupant['rents'][0].get('payments') or [],
+            term=term,
+            **recompute.get('settlement', {}),
+        )
+        url = f"{GATEWAY_URL}/api/v2/rents/payment/{tenant_id}/{term}"
+        with observe_stage('rent_recompute'):
+            response = await gateway_request(get_gateway_client(), 'PATCH', url, headers=self.headers, json=payment_data)
+        if response.status_code != 200:
+            await self._collection().update_one(
+                {'_id': key, 'lockId': self.lock_id},
+                {'$set': {'status': RECOMPUTE_FAILED, 'lastError': response.text, 'updatedAt': datetime.utcnow()}},
+            )
+            raise RuntimeError(f"status {response.status_code}: {response.text}")
+        self.sent += 1
+        # Compare-and-swap on the version: a recompute queued since (once the lock expired) is kept
+        result = await self._collection().delete_one(
+            {'_id': key, 'lockId': self.lock_id, 'version': recompute.get('version')}
+        )
+        return result.deleted_count == 1
+
+    def drain_errors(self) -> List[str]:
+        """Return the recompute failures not reported yet"""
+        errors, self._errors = self._errors, []
+        return errors
+
+
+class DirectPaymentWriter:
+    """
+    Append the payments of an import directly to the rents of the occupants collection.
+
+    Args:
+        organization_id (str): Organization (realm) of the tenants.
+        term (str): Term the payments are posted to, as YYYY.MM.
+        recomputes (RentRecomputeQueue): Queue of the recomputes of the touched rents.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+    """
+
+    def __init__(self, organization_id: str, term: str, recomputes: RentRecomputeQueue,
+                 db_name: Optional[str] = None):
+        self.organization_id = organization_id
+        self.term = term
+        self.rent_term = rent_term(term)
+        self.recomputes = recomputes
+        self.db_name = db_name
+
+    async def post(self, tenants: List[TenantPayments]) -> List[Optional[str]]:
+        """
+        Append the payments of each tenant with one bulk_write per round of locked rents, then
+        queue their recomputes.
+
+        Returns:
+            List[Optional[str]]: Per tenant, None when its payments were recorded, else why they were not.
+        """
+        collection = get_database(self.db_name)[OCCUPANTS_COLLECTION]
+        ids = [occupant_id(tenant.tenant_id) for tenant in tenants]
+
+        # Payments can only be appended to an existing rent of the term (the API rejects them otherwise)
+        with observe_mongo('find_term_rents'):
+            with_rent = {
+                occupant['_id'] async for occupant in collection.find(
+                    {'_id': {'$in': ids}, 'realmId': self.organization_id, 'rents.term': self.rent_term},
+                    projection={'_id': 1}
+                )
+            }
+        errors: List[Optional[str]] = [
+            None if _id in with_rent else f"Tenant {tenant.tenant_id} has no rent for term {self.term}"
+            for tenant, _id in zip(tenants, ids)
+        ]
+
+        # Each rent is locked while its payments are appended and its recompute queued, the rents
+        # locked by another import or a recompute are appended once released
+        pending = [position for position, error in enumerate(errors) if error is None]
+        while pending:
+            try:
+                locked = set(await self.recomputes.lock([tenants[position].tenant_id for position in pending]))
+            except PyMongoError as e:
+                for position in pending:
+                    errors[position] = f"Failed to record the payments of tenant {tenants[position].tenant_id}: {str(e)}"
+                break
+            positions = [position for position in pending if tenants[position].tenant_id in locked]
+            pending = [position for position in pending if tenants[position].tenant_id not in locked]
+            if positions:
+                try:
+                    await self._push(collection, tenants, ids, positions, errors)
+                    await self.recomputes.add([tenants[position] for position in positions if errors[position] is None])
+                finally:
+                    await self.recomputes.unlock([tenants[position].tenant_id for position in positions])
+            if pending:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+        return errors
+
+    async def _push(self, collection, tenants: List[TenantPayments], ids: list, positions: List[int],
+                    errors: List[Optional[str]]) -> None:
+        """Append the payments of the tenants at positions with one bulk_write, recording the failures in errors"""
+        operations = [
+            UpdateOne(
+                {'_id': ids[position], 'realmId': self.organization_id, 'rents': {'$elemMatch': {'term': self.rent_term}}},
+                {'$push': {'rents.$.payments': {'$each': tenants[position].payments}}},
+            )
+            for position in positions
+        ]
+        try:
+            with observe_mongo(f"bulk_write.{OCCUPANTS_COLLECTION}"):
+                await collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # With ordered=False every operation without a write error was applied
+            for write_error in e.details.get('writeErrors', []):
+                position = positions[write_error['index']]
+                errors[position] = f"Failed to record the payments of tenant {tenants[position].tenant_id}: {write_error.get('errmsg')}"
+        except PyMongoError as e:
+            for position in positions:
+                errors[position] = f"Failed to record the payments of tenant {tenants[position].tenant_id}: {str(e)}"
+
+
+direct_tenant_resolver = MongoTenantResolver()
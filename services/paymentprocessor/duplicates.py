@@ -0,0 +1,120 @@
+"""
+Batch duplicate detection for uploaded payment files.
+
+All payment references of a file are resolved against occupants.rents.payments.reference
+with a few chunked $in queries instead of one query per row. References repeated inside
+the uploaded file itself are flagged as well: the first occurrence is processed and the
+following ones are reported as duplicates.
+"""
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+
+from pymongo.errors import PyMongoError
+
+from config import DUPLICATE_CHECK_CHUNK_SIZE
+from database import OCCUPANTS_COLLECTION, get_database
+from metrics import observe_mongo
+
+logger = logging.getLogger(__name__)
+
+# Values produced by empty CSV cells, such references cannot identify a payment
+BLANK_REFERENCES = {'', 'nan', 'none', 'null'}
+
+
+def is_blank_reference(reference) -> bool:
+    """Return True when the reference is empty (empty cell, NaN, None)"""
+    return reference is None or str(reference).strip().lower() in BLANK_REFERENCES
+
+
+async def find_existing_references(references: Iterable[str], chunk_size: int = DUPLICATE_CHECK_CHUNK_SIZE,
+                                   db_name: Optional[str] = None,
+                                   collection_name: str = OCCUPANTS_COLLECTION) -> Set[str]:
+    """
+    Return the subset of references already recorded in occupants.rents.payments.reference.
+
+    Args:
+        references (Iterable[str]): The payment references to look up.
+        chunk_size (int): Number of references sent in each $in query.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+        collection_name (str): The name of the MongoDB collection. Defaults to 'occupants'.
+
+    Returns:
+        Set[str]: The references found in the collection.
+    """
+    wanted = sorted({str(reference) for reference in references if not is_blank_reference(reference)})
+    collection = get_database(db_name)[collection_name]
+    found: Set[str] = set()
+
+    try:
+        for start in range(0, len(wanted), chunk_size):
+            chunk = wanted[start:start + chunk_size]
+            chunk_set = set(chunk)
+            cursor = collection.find(
+                {"rents.payments.reference": {"$in": chunk}},
+                projection={"_id": 0, "rents.payments.reference": 1}
+            )
+            with observe_mongo('find_existing_references'):
+                occupants = await cursor.to_list(length=None)
+            for occupant in occupants:
+                # The projection keeps every payment reference of the occupant, only keep the requested ones
+                for rent in occupant.get('rents') or []:
+                    for payment in rent.get('payments') or []:
+                        reference = payment.get('reference')
+                        if reference in chunk_set:
+                            found.add(reference)
+    except PyMongoError as e:
+        logger.error(f"Error checking existing payment references: {str(e)}")
+        raise
+
+    logger.debug(f"Found {len(found)} existing payment references out of {len(wanted)}")
+    return found
+
+
+class DuplicateChecker:
+    """
+    Classify the payment references of an upload as new, already recorded, or repeated in the file.
+
+    Usage:
+        checker = DuplicateChecker()
+        await checker.load(all_references)
+        message = checker.check(reference, row_number)
+    """
+
+    def __init__(self, chunk_size: int = DUPLICATE_CHECK_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        # References already recorded in the database
+        self.existing: Set[str] = set()
+        # References already looked up in the database
+        self._loaded: Set[str] = set()
+        # First row number of each reference seen in the file
+        self._first_rows: Dict[str, int] = {}
+
+    async def load(self, references: Iterable[str]) -> None:
+        """Resolve the references not looked up yet against the database"""
+        to_load: List[str] = [
+            reference for reference in {str(reference) for reference in references}
+            if reference not in self._loaded and not is_blank_reference(reference)
+        ]
+        if not to_load:
+            return
+        self.existing |= await find_existing_references(to_load, chunk_size=self.chunk_size)
+        self._loaded.update(to_load)
+
+    def check(self, reference: str, row_number: int) -> Optional[str]:
+        """
+        Register the reference of a row and return why it is a duplicate, or None.
+
+        Rows must be checked in file order: the first row carrying a reference is
+        the one processed, the next ones are reported as duplicates within the file.
+        Blank references are never reported as duplicates.
+        """
+        if is_blank_reference(reference):
+            return None
+
+        if reference in self.existing:
+            return f"Payment with reference {reference} already exists in the database"
+
+        first_row = self._first_rows.setdefault(reference, row_number)
+        if first_row != row_number:
+            return f"Payment with reference {reference} is duplicated in the uploaded file (first seen on row {first_row})"
+        return None
@@ -0,0 +1,103 @@
+"""
+Bounded-concurrency execution engine for import rows.
+
+Rows are processed concurrently up to a configurable limit, with two guarantees:
+- rows sharing the same key (tenant and term) run one after the other, in the
+  order they were submitted, because processing a row is a read-modify-write
+  of the tenant's payments for that term;
+- results are yielded in submission order, so progress events stay ordered.
+
+Only a bounded window of rows is scheduled ahead of the oldest unfinished row,
+so memory does not grow with the size of the input.
+"""
+import asyncio
+from collections import deque
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+async def _aiter(items: Union[Iterable[T], AsyncIterable[T]]) -> AsyncIterator[T]:
+    """Iterate over a sync or async iterable"""
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class OrderedExecutor:
+    """
+    Run an async worker over a stream of items with bounded concurrency,
+    per-key serialization and ordered results.
+
+    Args:
+        concurrency (int): Maximum number of workers running at the same time.
+        window (int): Maximum number of items scheduled but not yet yielded.
+            Defaults to four times the concurrency.
+    """
+
+    def __init__(self, concurrency: int, window: Optional[int] = None):
+        self.concurrency = max(1, concurrency)
+        self.window = max(self.concurrency, window or self.concurrency * 4)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Last scheduled task per key, new tasks for the same key wait for it
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+
+    async def _run(self, previous: Optional[asyncio.Future], worker: Callable[[T], Awaitable[R]], item: T) -> R:
+        if previous is not None:
+            # Wait for the previous item with the same key, whatever its outcome
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            return await worker(item)
+
+    def _release_tail(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    def submit(self, key: Hashable, worker: Callable[[T], Awaitable[R]], item: T) -> asyncio.Future:
+        """Schedule one item, after any previously submitted item with the same key"""
+        task = asyncio.ensure_future(self._run(self._tails.get(key), worker, item))
+        self._tails[key] = task
+        task.add_done_callback(lambda done, key=key: self._release_tail(key, done))
+        return task
+
+    async def map(self, items: Union[Iterable[T], AsyncIterable[T]], worker: Callable[[T], Awaitable[R]],
+                  key: Callable[[T], Hashable]) -> AsyncIterator[Tuple[T, R]]:
+        """
+        Process every item with the worker and yield (item, result) pairs in input order.
+
+        An exception raised by a worker is re-raised when its result is reached;
+        the remaining scheduled items are cancelled.
+        """
+        pending: Deque[Tuple[T, asyncio.Future]] = deque()
+        try:
+            async for item in _aiter(items):
+                pending.append((item, self.submit(key(item), worker, item)))
+                while len(pending) >= self.window:
+                    head, task = pending.popleft()
+                    yield head, await task
+            while pending:
+                head, task = pending.popleft()
+                yield head, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+
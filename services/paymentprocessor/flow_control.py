@@ -0,0 +1,193 @@
+"""
+Service-wide flow control of the gateway calls.
+
+Every import calls the gateway on its own (PAYMENT_CONCURRENCY rows at a time), and many
+imports at once overload the API behind the gateway. All gateway calls of the instance go
+through one FlowController (see resilience.gateway_request) that bounds the calls in flight
+and adapts the bound AIMD-style, like TCP congestion control:
+
+- additive increase: every call answered in time adds 1/limit, about one more call per
+  round trip, as long as the limit is what holds the calls back,
+- multiplicative decrease: an overload sign (transport error, 429/502/503/504 answer, or a
+  smoothed latency above GATEWAY_FLOW_LATENCY_TOLERANCE times the lowest latency seen and
+  above GATEWAY_FLOW_LATENCY_TARGET) multiplies the limit by GATEWAY_FLOW_DECREASE, at most
+  once per round trip: signs of calls started before the last decrease are ignored.
+
+The calls waiting for a slot are grouped by organization. A freed slot goes to the waiting
+organization with the fewest calls in flight (round-robin between equals), so concurrent
+imports share the capacity evenly whatever their size. Each instance adapts on its own,
+the replicas converge to their share of the gateway the same way.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from config import (
+    GATEWAY_FLOW_DECREASE,
+    GATEWAY_FLOW_INITIAL_LIMIT,
+    GATEWAY_FLOW_LATENCY_TARGET,
+    GATEWAY_FLOW_LATENCY_TOLERANCE,
+    GATEWAY_FLOW_MAX_LIMIT,
+    GATEWAY_FLOW_MIN_LIMIT,
+)
+from metrics import GATEWAY_FLOW_IN_FLIGHT, GATEWAY_FLOW_LIMIT, GATEWAY_FLOW_WAITING
+
+logger = logging.getLogger(__name__)
+
+# Weight of the last call in the smoothed latency
+LATENCY_SMOOTHING = 0.2
+# The lowest latency seen follows the latencies above it over this many seconds (whatever the call
+# rate), so that one very fast call does not stick and a slower gateway becomes the new normal
+BASELINE_WINDOW = 300.0
+
+
+class FlowController:
+    """
+    AIMD limit of the gateway calls in flight, shared fairly between organizations.
+
+    Args:
+        initial_limit (float): Calls in flight allowed at first.
+        min_limit (int): Lowest limit, however overloaded the gateway is.
+        max_limit (int): Highest limit (no more than the connections of the gateway client).
+        latency_target (float): Smoothed latency (seconds) under which the gateway is never seen as overloaded.
+        latency_tolerance (float): Overloaded when the smoothed latency is above this many times the lowest one.
+        decrease (float): Factor applied to the limit on overload.
+    """
+
+    def __init__(self, initial_limit: float = GATEWAY_FLOW_INITIAL_LIMIT, min_limit: int = GATEWAY_FLOW_MIN_LIMIT,
+                 max_limit: int = GATEWAY_FLOW_MAX_LIMIT, latency_target: float = GATEWAY_FLOW_LATENCY_TARGET,
+                 latency_tolerance: float = GATEWAY_FLOW_LATENCY_TOLERANCE, decrease: float = GATEWAY_FLOW_DECREASE):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_target = latency_target
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial_limit)))
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency: Optional[float] = None  # Smoothed latency
+        self.baseline: Optional[float] = None  # Lowest latency seen (drifting)
+        self._active: Dict[str, int] = {}  # Calls in flight per organization
+        self._queues: Dict[str, Deque[asyncio.Future]] = {}  # Waiting calls per organization, in turn order
+        self._decreased_at = 0.0
+        self._observed_at = time.monotonic()
+        GATEWAY_FLOW_LIMIT.set(self.limit)
+
+    @property
+    def capacity(self) -> int:
+        return int(self.limit)
+
+    def _grant(self, key: str) -> None:
+        self.in_flight += 1
+        self._active[key] = self._active.get(key, 0) + 1
+        GATEWAY_FLOW_IN_FLIGHT.set(self.in_flight)
+
+    def _give_back(self, key: str) -> None:
+        self.in_flight -= 1
+        remaining = self._active[key] - 1
+        if remaining:
+            self._active[key] = remaining
+        else:
+            del self._active[key]
+        GATEWAY_FLOW_IN_FLIGHT.set(self.in_flight)
+
+    async def acquire(self, key: Optional[str]) -> float:
+        """
+        Wait for a slot for a call of the organization key, returns when the slot was granted
+        (time.monotonic), to be passed to release.
+        """
+        key = key or ''
+        if self.in_flight < self.capacity and not self._queues:
+            self._grant(key)
+            return time.monotonic()
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self.waiting += 1
+        GATEWAY_FLOW_WAITING.set(self.waiting)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted while the call was being cancelled
+                self._give_back(key)
+                self._dispatch()
+            else:
+                self._forget(key, future)
+            raise
+        return time.monotonic()
+
+    def _forget(self, key: str, future: asyncio.Future) -> None:
+        queue = self._queues.get(key)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        if not queue:
+            del self._queues[key]
+        self.waiting -= 1
+        GATEWAY_FLOW_WAITING.set(self.waiting)
+
+    def _dispatch(self) -> None:
+        """Hand the free slots out, each one to the waiting organization with the fewest calls in flight"""
+        while self._queues and self.in_flight < self.capacity:
+            # Dicts keep their insertion order: between equals, the organization served the longest ago
+            key = min(self._queues, key=lambda organization: self._active.get(organization, 0))
+            queue = self._queues.pop(key)
+            future = queue.popleft()
+            if queue:
+                self._queues[key] = queue
+            self.waiting -= 1
+            GATEWAY_FLOW_WAITING.set(self.waiting)
+            if future.cancelled():
+                continue
+            self._grant(key)
+            future.set_result(None)
+
+    def release(self, key: Optional[str], started: float, overloaded: Optional[bool]) -> None:
+        """
+        Give a slot back and adapt the limit to the outcome of the call: overloaded is True for an
+        overload sign, False for an answer (its latency is taken into account), None when the call
+        tells nothing about the gateway (e.g. cancelled).
+        """
+        self._give_back(key or '')
+        if overloaded:
+            self._reduce(started, 'overload')
+        elif overloaded is not None:
+            self._observe(time.monotonic() - started, started)
+        self._dispatch()
+
+    def _observe(self, latency: float, started: float) -> None:
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        now = time.monotonic()
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline += min(1.0, (now - self._observed_at) / BASELINE_WINDOW) * (latency - self.baseline)
+        self._observed_at = now
+
+        if self.latency > max(self.latency_target, self.baseline * self.latency_tolerance):
+            self._reduce(started, f"latency {self.latency * 1000:.0f}ms")
+        elif self.waiting or self.in_flight + 1 >= self.capacity:
+            # Only grown while the limit holds calls back, an idle limit says nothing about the gateway
+            self._set_limit(self.limit + 1 / self.limit)
+
+    def _reduce(self, started: float, reason: str) -> None:
+        if started < self._decreased_at:
+            # Sent before the last decrease: the limit was already reduced for this overload
+            return
+        self._decreased_at = time.monotonic()
+        previous = self.limit
+        self._set_limit(self.limit * self.decrease)
+        logger.info(f"Gateway flow limit {previous:.1f} -> {self.limit:.1f} ({reason})")
+
+    def _set_limit(self, limit: float) -> None:
+        self.limit = min(float(self.max_limit), max(float(self.min_limit), limit))
+        GATEWAY_FLOW_LIMIT.set(self.limit)
+
+
+gateway_flow = FlowController()
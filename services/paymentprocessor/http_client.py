@@ -0,0 +1,107 @@
+"""
+Process-wide HTTP client used for every call to the gateway.
+
+A single httpx.AsyncClient is created when the application starts and closed
+when it shuts down, so all imports share the same pool of warm keep-alive
+connections instead of opening a new connection per request.
+"""
+import logging
+from typing import Optional
+
+import httpx
+
+from config import (
+    GATEWAY_CONNECT_TIMEOUT,
+    GATEWAY_HTTP2,
+    GATEWAY_KEEPALIVE_EXPIRY,
+    GATEWAY_MAX_CONNECTIONS,
+    GATEWAY_MAX_KEEPALIVE_CONNECTIONS,
+    GATEWAY_POOL_TIMEOUT,
+    GATEWAY_READ_TIMEOUT,
+    GATEWAY_WRITE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_enabled() -> bool:
+    """HTTP/2 is only used when requested and the h2 package is installed"""
+    if not GATEWAY_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("GATEWAY_HTTP2 is enabled but the 'h2' package is not installed, falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def create_gateway_client(http2: Optional[bool] = None) -> httpx.AsyncClient:
+    """Build an AsyncClient configured from the GATEWAY_* settings"""
+    if http2 is None:
+        http2 = _http2_enabled()
+    limits = httpx.Limits(
+        max_connections=GATEWAY_MAX_CONNECTIONS,
+        max_keepalive_connections=GATEWAY_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=GATEWAY_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=GATEWAY_CONNECT_TIMEOUT,
+        read=GATEWAY_READ_TIMEOUT,
+        write=GATEWAY_WRITE_TIMEOUT,
+        pool=GATEWAY_POOL_TIMEOUT,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+async def start_gateway_client() -> httpx.AsyncClient:
+    """Create the shared gateway client (called from the application lifespan)"""
+    global _client
+    if _client is None or _client.is_closed:
+        http2 = _http2_enabled()
+        _client = create_gateway_client(http2=http2)
+        logger.info(
+            f"Gateway client started (max_connections={GATEWAY_MAX_CONNECTIONS}, "
+            f"max_keepalive={GATEWAY_MAX_KEEPALIVE_CONNECTIONS}, http2={http2})"
+        )
+    return _client
+
+
+async def close_gateway_client() -> None:
+    """Close the shared gateway client and release its pooled connections"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info("Gateway client closed")
+
+
+def get_gateway_client() -> httpx.AsyncClient:
+    """
+    Return the shared gateway client.
+
+    The client is normally created by the application lifespan; it is created
+    lazily here so that the processing functions can also be used outside of
+    a running application (scripts, benchmarks).
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_gateway_client()
+    return _client
+
+
+def build_gateway_headers(organization_id: Optional[str], auth_token: Optional[str] = None) -> dict:
+    """Headers sent with every gateway call made on behalf of an organization"""
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Accept-Language": "en",
+        "organizationId": organization_id,
+    }
+
+    # Add authorization header if token is provided
+    if auth_token:
+        headers["Authorization"] = auth_token
+    return headers
@@ -0,0 +1,133 @@
+"""
+Streaming ingestion of uploaded CSV files.
+
+The upload is parsed in chunks of rows while it is read (the parser pulls the file
+in small blocks and decodes it incrementally), so only one chunk of rows is held in
+memory at a time and the first rows can be processed before the whole file is parsed.
+"""
+import hashlib
+import io
+import logging
+from typing import AsyncIterator, Optional, Tuple
+
+import anyio
+import pandas as pd
+from fastapi import UploadFile
+
+from config import CSV_CHUNK_ROWS, CSV_ENCODING
+
+logger = logging.getLogger(__name__)
+
+
+def _data_rows(lines: int, last: bytes) -> int:
+    """Data rows of a file from its line breaks and its last block"""
+    # A last line without a trailing newline is a row too, the first line is the header
+    if last and not last.endswith(b'\n'):
+        lines += 1
+    return max(0, lines - 1)
+
+
+def _scan_rows(file_obj, block_size: int = 1024 * 1024) -> Tuple[int, str]:
+    """Count the data rows of a CSV file by counting its lines and hash its content, reading it block by block"""
+    file_obj.seek(0)
+    digest = hashlib.sha256()
+    lines = 0
+    last = b''
+    while True:
+        block = file_obj.read(block_size)
+        if not block:
+            break
+        digest.update(block)
+        lines += block.count(b'\n')
+        last = block
+    file_obj.seek(0)
+    return _data_rows(lines, last), digest.hexdigest()
+
+
+class ScannedFile:
+    """
+    Uploaded file whose rows are counted and content hashed while the parser reads it,
+    instead of in a pass over the whole file before the import (see scan_csv).
+
+    rows and content_hash are set once the end of the file was read. Until then,
+    estimate_rows extrapolates the number of rows from the share of the file read.
+    """
+
+    def __init__(self, file_obj):
+        self._file = file_obj
+        self._digest = hashlib.sha256()
+        self._lines = 0
+        self._last = b''
+        self._read = 0
+        file_obj.seek(0, io.SEEK_END)
+        self.size = file_obj.tell()
+        file_obj.seek(0)
+        self.rows: Optional[int] = None
+        self.content_hash: Optional[str] = None
+
+    def _scan(self, block: bytes) -> bytes:
+        if block:
+            self._digest.update(block)
+            self._lines += block.count(b'\n')
+            self._read += len(block)
+            self._last = block
+        if self.rows is None and (not block or self._read >= self.size):
+            self.rows, self.content_hash = _data_rows(self._lines, self._last), self._digest.hexdigest()
+        return block
+
+    def read(self, size: int = -1) -> bytes:
+        return self._scan(self._file.read(size))
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._scan(self._file.readline(size))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def estimate_rows(self) -> int:
+        """Number of data rows, exact once the end of the file was read"""
+        if self.rows is not None:
+            return self.rows
+        if not self._read:
+            return 0
+        return max(0, round(self._lines * self.size / self._read) - 1)
+
+
+async def scan_csv(file: UploadFile) -> Tuple[int, str]:
+    """
+    Number of data rows of an uploaded CSV file and SHA-256 of its content, in one pass.
+
+    The count is used to report progress. It is based on line breaks, so quoted values
+    spanning several lines make it an over-estimate. The hash identifies the file when
+    it is uploaded again (see checkpoints). The file is read once more by the parser, use
+    a ScannedFile when the hash is not needed before the first row.
+    """
+    return await anyio.to_thread.run_sync(_scan_rows, file.file)
+
+
+async def iter_csv_chunks(file: UploadFile, chunk_rows: int = CSV_CHUNK_ROWS, encoding: str = CSV_ENCODING,
+                          scan: Optional[ScannedFile] = None) -> AsyncIterator[pd.DataFrame]:
+    """
+    Parse an uploaded CSV file chunk by chunk.
+
+    Yields DataFrames of at most chunk_rows rows, indexed by row position in the file.
+    Every value is read as text (empty cells as ''), typing is left to the normalization
+    stage so that values such as references or zero-padded ids are not altered.
+    Parsing runs in a worker thread so the event loop keeps serving other requests.
+    When scan is given (a ScannedFile of the upload), the file is read through it.
+    """
+    file_obj = file.file
+
+    def open_reader():
+        file_obj.seek(0)
+        return pd.read_csv(scan or file_obj, chunksize=chunk_rows, encoding=encoding, dtype=str, keep_default_na=False)
+
+    reader = await anyio.to_thread.run_sync(open_reader)
+    try:
+        while True:
+            frame = await anyio.to_thread.run_sync(next, reader, None)
+            if frame is None:
+                return
+            yield frame
+    finally:
+        reader.close()
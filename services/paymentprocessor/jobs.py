@@ -0,0 +1,280 @@
+"""
+Background import jobs.
+
+An upload submitted as a job is imported by a background task instead of inside the
+HTTP response, so the import no longer depends on the client connection. The job
+state, every event of the import and the per-row results are stored in MongoDB:
+the status can be polled and the event stream can be (re)attached from any offset,
+also from another instance of the service.
+
+A running job updates its heartbeat regularly; a job whose heartbeat stopped (the
+service was restarted while it was running) is reported as interrupted.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from bulk_writer import BulkWriter
+from config import (
+    IMPORT_JOB_CONCURRENCY,
+    IMPORT_JOB_FLUSH_INTERVAL,
+    IMPORT_JOB_HEARTBEAT_INTERVAL,
+    IMPORT_JOB_POLL_INTERVAL,
+    IMPORT_JOB_STALE_AFTER,
+    PENDING_PAYMENTS_BATCH_SIZE,
+)
+from database import IMPORT_EVENTS_COLLECTION, IMPORT_JOBS_COLLECTION, IMPORT_RESULTS_COLLECTION, get_database
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETE = 'complete'
+JOB_ERROR = 'error'
+JOB_INTERRUPTED = 'interrupted'
+FINISHED_STATUSES = frozenset({JOB_COMPLETE, JOB_ERROR, JOB_INTERRUPTED})
+
+# Called with the row number and the result of every processed row
+ResultSink = Callable[[int, dict], Awaitable[None]]
+# Runs the import of a job: called with the job id and the result sink, yields the import events
+ImportRun = Callable[[str, ResultSink], AsyncIterator[dict]]
+
+
+class JobEventLog(BulkWriter):
+    """Numbered events of a job, written in batches"""
+
+    def __init__(self, job_id: str, db_name: Optional[str] = None):
+        super().__init__(IMPORT_EVENTS_COLLECTION, PENDING_PAYMENTS_BATCH_SIZE, IMPORT_JOB_FLUSH_INTERVAL,
+                         db_name, label='import job events')
+        self.job_id = job_id
+        self.count = 0
+
+    async def append(self, event: dict) -> None:
+        document = dict(jobId=self.job_id, seq=self.count, event=event, createdAt=datetime.utcnow())
+        self.count += 1
+        await self.add(document)
+
+
+class JobResultWriter(BulkWriter):
+    """Per-row results of a job, written in batches"""
+
+    def __init__(self, job_id: str, db_name: Optional[str] = None):
+        super().__init__(IMPORT_RESULTS_COLLECTION, PENDING_PAYMENTS_BATCH_SIZE, IMPORT_JOB_FLUSH_INTERVAL,
+                         db_name, label='import job results')
+        self.job_id = job_id
+
+    async def add_result(self, row: int, result: dict) -> None:
+        await self.add(dict(jobId=self.job_id, row=row, createdAt=datetime.utcnow(), **result))
+
+
+def job_status(job: dict, now: Optional[datetime] = None) -> str:
+    """Status of a job document, unfinished jobs without a recent heartbeat are interrupted"""
+    status = job['status']
+    if status in FINISHED_STATUSES:
+        return status
+    heartbeat = job.get('heartbeatAt') or job['createdAt']
+    if (now or datetime.utcnow()) - heartbeat > timedelta(seconds=IMPORT_JOB_STALE_AFTER):
+        return JOB_INTERRUPTED
+    return status
+
+
+def public_job(job: dict) -> dict:
+    """JSON view of a job document"""
+    def iso(value: Optional[datetime]) -> Optional[str]:
+        return value.isoformat() + 'Z' if value else None
+
+    return dict(
+        jobId=job['_id'],
+        status=job_status(job),
+        term=job['term'],
+        filename=job.get('filename'),
+        aggregate=job.get('aggregate', False),
+        progress=job.get('progress', 0),
+        message=job.get('message'),
+        eventCount=job.get('eventCount'),
+        processed=job.get('processed', 0),
+        successful=job.get('successful', 0),
+        createdAt=iso(job['createdAt']),
+        startedAt=iso(job.get('startedAt')),
+        finishedAt=iso(job.get('finishedAt')),
+    )
+
+
+class JobManager:
+    """
+    Run imports as background jobs and serve their state from MongoDB.
+
+    Args:
+        concurrency (int): Number of jobs imported at the same time, the others wait their turn.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+    """
+
+    def __init__(self, concurrency: int = IMPORT_JOB_CONCURRENCY, db_name: Optional[str] = None):
+        self.db_name = db_name
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def _collection(self, name: str):
+        return get_database(self.db_name)[name]
+
+    async def _update(self, job_id: str, **fields) -> None:
+        fields['updatedAt'] = datetime.utcnow()
+        await self._collection(IMPORT_JOBS_COLLECTION).update_one({'_id': job_id}, {'$set': fields})
+
+    async def submit(self, organization_id: str, term: str, run: ImportRun,
+                     filename: Optional[str] = None, aggregate: bool = False) -> dict:
+        """
+        Record a new job and start its import in the background.
+
+        The import itself (and the credentials it uses) only lives in this process,
+        the job document never holds the authorization token.
+
+        Returns:
+            dict: The job document.
+        """
+        now = datetime.utcnow()
+        job = dict(
+            _id=uuid.uuid4().hex,
+            organizationId=organization_id,
+            term=term,
+            filename=filename,
+            aggregate=aggregate,
+            status=JOB_QUEUED,
+            progress=0,
+            message='Waiting to be processed',
+            eventCount=None,
+            processed=0,
+            successful=0,
+            createdAt=now,
+            updatedAt=now,
+            heartbeatAt=now,
+            startedAt=None,
+            finishedAt=None,
+        )
+        await self._collection(IMPORT_JOBS_COLLECTION).insert_one(job)
+
+        job_id = job['_id']
+        task = asyncio.ensure_future(self._run(job_id, run))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        logger.info(f"Import job {job_id} submitted for term {term}")
+        return job
+
+    async def _heartbeat(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(IMPORT_JOB_HEARTBEAT_INTERVAL)
+            try:
+                await self._update(job_id, heartbeatAt=datetime.utcnow())
+            except PyMongoError as e:
+                logger.warning(f"Could not update the heartbeat of import job {job_id}: {str(e)}")
+
+    async def _run(self, job_id: str, run: ImportRun) -> None:
+        """Import a job, recording its events, results and state"""
+        events = JobEventLog(job_id, self.db_name)
+        results = JobResultWriter(job_id, self.db_name)
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+        state = dict(status=JOB_INTERRUPTED, message='Import interrupted', progress=0, processed=0, successful=0)
+
+        async def on_result(row: int, result: dict) -> None:
+            state['processed'] += 1
+            state['successful'] += bool(result.get('success'))
+            await results.add_result(row, result)
+
+        try:
+            async with self._slots:
+                await self._update(job_id, status=JOB_RUNNING, startedAt=datetime.utcnow(), message='Processing')
+                state.update(status=JOB_ERROR, message='Import ended without completing')
+                async for event in run(job_id, on_result):
+                    status = event.get('status')
+                    if status == 'complete':
+                        state.update(status=JOB_COMPLETE, message=event.get('message'), progress=100)
+                    elif status == 'processing':
+                        state.update(progress=event.get('progress', state['progress']), message=event.get('message'))
+                        await self._update(job_id, progress=state['progress'], message=state['message'],
+                                           processed=state['processed'], successful=state['successful'])
+                    elif status == 'error' and state['status'] != JOB_COMPLETE:
+                        state['message'] = event.get('message')
+                    await events.append(event)
+        except asyncio.CancelledError:
+            state.update(status=JOB_INTERRUPTED, message='Import interrupted')
+            raise
+        except Exception as e:
+            logger.exception(f"Import job {job_id} failed")
+            state.update(status=JOB_ERROR, message=f"Error in bulk payment processing: {str(e)}")
+            await events.append(dict(status='error', message=state['message'], error=str(e)))
+        finally:
+            # Shielded so that the final state is recorded also when the job is cancelled (shutdown)
+            await asyncio.shield(self._finish(job_id, heartbeat, events, results, state))
+
+    async def _finish(self, job_id: str, heartbeat: asyncio.Task, events: JobEventLog,
+                      results: JobResultWriter, state: dict) -> None:
+        heartbeat.cancel()
+        # The events are all written before the job is marked as finished, see stream()
+        await events.close()
+        await results.close()
+        try:
+            await self._update(job_id, eventCount=events.count, finishedAt=datetime.utcnow(), **state)
+        except PyMongoError as e:
+            logger.error(f"Could not record the state of import job {job_id}: {str(e)}")
+        logger.info(f"Import job {job_id} finished: {state['status']} ({state['message']})")
+
+    async def get(self, job_id: str, organization_id: str) -> Optional[dict]:
+        """Return the job document, None when it does not exist or belongs to another organization"""
+        return await self._collection(IMPORT_JOBS_COLLECTION).find_one(
+            {'_id': job_id, 'organizationId': organization_id}
+        )
+
+    async def stream(self, job_id: str, organization_id: str, offset: int = 0) -> AsyncIterator[Tuple[Optional[int], dict]]:
+        """
+        Yield the (sequence number, event) of a job from the given offset, following the job until it finishes.
+
+        Events are read from MongoDB, so a job can be followed from any instance. An interrupted
+        job ends with an error event that has no sequence number.
+        """
+        next_seq = max(0, offset)
+        while True:
+            job = await self.get(job_id, organization_id)
+            if job is None:
+                return
+            status = job_status(job)
+            finished = status in FINISHED_STATUSES
+
+            cursor = self._collection(IMPORT_EVENTS_COLLECTION).find(
+                {'jobId': job_id, 'seq': {'$gte': next_seq}}
+            ).sort('seq', ASCENDING)
+            async for document in cursor:
+                # While the job runs, wait for a batch still being written rather than skip an event
+                if not finished and document['seq'] != next_seq:
+                    break
+                yield document['seq'], document['event']
+                next_seq = document['seq'] + 1
+
+            if finished:
+                if status == JOB_INTERRUPTED:
+                    message = job.get('message') if job['status'] == JOB_INTERRUPTED else 'Import interrupted'
+                    yield None, dict(status='error', message=message)
+                return
+            await asyncio.sleep(IMPORT_JOB_POLL_INTERVAL)
+
+    async def results(self, job_id: str, skip: int = 0, limit: int = 1000) -> List[dict]:
+        """Return the per-row results of a job, by row number"""
+        cursor = self._collection(IMPORT_RESULTS_COLLECTION).find(
+            {'jobId': job_id}, projection={'_id': 0, 'jobId': 0, 'createdAt': 0}
+        ).sort('row', ASCENDING).skip(skip).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def shutdown(self) -> None:
+        """Cancel the running jobs, they are recorded as interrupted"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+job_manager = JobManager()
@@ -0,0 +1,142 @@
+"""
+Logging setup for the payment processor service.
+
+The level and the output format come from the environment (LOGGER_LEVEL, LOGGER_FORMAT).
+Per-row debug records go through a dedicated "<module>.rows" logger that keeps only a
+sample of them (LOGGER_ROW_SAMPLE_RATE). Large payloads are wrapped in LazyJson and passed
+as logging arguments so that they are only serialized when the record is actually emitted.
+"""
+import json
+import logging
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Mapping, Optional
+
+from config import LOGGER_FORMAT, LOGGER_LEVEL, LOGGER_ROW_SAMPLE_RATE
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Header values never written to the logs
+REDACTED_HEADERS = frozenset({
+    'authorization',
+    'proxy-authorization',
+    'cookie',
+    'set-cookie',
+    'x-api-key',
+})
+REDACTED = '[REDACTED]'
+
+# Attributes of every LogRecord, anything else was passed with extra= and is added to the JSON output
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class LazyJson:
+    """Serialize a value to JSON only when the log record is formatted"""
+
+    __slots__ = ('value', 'indent')
+
+    def __init__(self, value, indent: Optional[int] = None):
+        self.value = value
+        self.indent = indent
+
+    def __str__(self) -> str:
+        try:
+            return json.dumps(self.value, indent=self.indent, default=str)
+        except (TypeError, ValueError):
+            return repr(self.value)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Keep a random fraction of the records (filters run before any formatting)"""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1 or random.random() < self.rate
+
+
+_row_filter = SampleFilter(LOGGER_ROW_SAMPLE_RATE)
+
+
+def get_row_logger(name: str) -> logging.Logger:
+    """
+    Logger for per-row debug records, only a sample of them is kept.
+
+    Errors should still go to the module logger, the sampling applies to every record
+    of this logger.
+    """
+    row_logger = logging.getLogger(f"{name}.rows")
+    if _row_filter not in row_logger.filters:
+        row_logger.addFilter(_row_filter)
+    return row_logger
+
+
+def redact_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    """Copy of the headers with credentials replaced by a placeholder"""
+    return {
+        key: REDACTED if key.lower() in REDACTED_HEADERS else value
+        for key, value in headers.items()
+    }
+
+
+def parse_level(level) -> int:
+    """Logging level from a name ("debug", "INFO", ...) or a number, defaults to INFO"""
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).strip().upper())
+    return value if isinstance(value, int) else logging.INFO
+
+
+def configure_logging(level=None, fmt: Optional[str] = None, row_sample_rate: Optional[float] = None):
+    """
+    Configure the root logger with a single stdout handler.
+
+    Args:
+        level: Logging level name or number. Defaults to LOGGER_LEVEL.
+        fmt (str): "text" or "json". Defaults to LOGGER_FORMAT.
+        row_sample_rate (float): Fraction of the per-row debug records kept. Defaults to LOGGER_ROW_SAMPLE_RATE.
+    """
+    level = parse_level(LOGGER_LEVEL if level is None else level)
+    fmt = (LOGGER_FORMAT if fmt is None else fmt).strip().lower()
+
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+
+    root = logging.getLogger()
+    # Replace the handlers (ours from a previous call included) so every line is written once
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    # httpx logs every request at INFO, keep the per-row gateway calls out of the logs unless debugging
+    for name in ('httpx', 'httpcore'):
+        logging.getLogger(name).setLevel(max(level, logging.WARNING) if level > logging.DEBUG else level)
+
+    if row_sample_rate is not None:
+        _row_filter.rate = min(1.0, max(0.0, row_sample_rate))
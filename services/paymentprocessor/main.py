@@ -1,46 +1,91 @@
-from fastapi import FastAPI, UploadFile, HTTPException, Form, File, Request, Response
+from collections import deque
+from contextlib import asynccontextmanager
+import anyio
+from fastapi import FastAPI, UploadFile, HTTPException, Form, File, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
-from io import StringIO
-from typing import List, Dict
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, AsyncGenerator, AsyncIterator, Awaitable, Callable, Deque, Iterable, Iterator, List, Dict, Optional, Tuple
+import shutil
+import tempfile
+import uuid
 import json
-import httpx
 import logging
-from starlette.responses import StreamingResponse
-import os
-from dateutil import parser
+from starlette.responses import JSONResponse, StreamingResponse
 from datetime import datetime
 from pydantic import BaseModel
-import pymongo
 from pymongo.errors import PyMongoError
-from motor.motor_asyncio import AsyncIOMotorClient  # Use motor for async MongoDB
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG for more detailed logs
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%dT%H:%M:%S'
+from redis.exceptions import RedisError
+
+from checkpoints import ImportCheckpoint, ImportInProgressError
+from config import (
+    API_BASE_URL,
+    GATEWAY_URL,
+    IMPORT_CHECKPOINTS,
+    PAYMENT_BACKEND,
+    PAYMENT_CONCURRENCY,
+    PAYMENT_WINDOW,
+    WORK_QUEUE,
+)
+from database import (
+    PENDING_PAYMENTS_COLLECTION,
+    close_mongo_client,
+    get_database,
+    start_mongo_client,
 )
+from dates import DateParser, payment_date_parser
+from direct import DirectPaymentWriter, RentRecomputeQueue, TenantPayments, direct_tenant_resolver, rent_term
+from duplicates import DuplicateChecker, find_existing_references
+from executor import OrderedExecutor
+from pending import PENDING_STATUS, PendingPaymentWriter, get_pending_writer, set_pending_writer
+from reports import ReportWriter, iter_report_csv, iter_report_ndjson, read_report_meta
+from jobs import job_manager, public_job
+from metrics import IMPORTS_IN_PROGRESS, count_rows, observe_mongo, observe_stage, render_metrics
+from http_client import build_gateway_headers, close_gateway_client, get_gateway_client, start_gateway_client
+from resilience import gateway_request
+from logging_config import LazyJson, configure_logging, get_row_logger, redact_headers
+from tenants import TenantLookupError, tenant_resolver
+from warmup import readiness
+from workqueue import QueuedImport, work_queue
+
+if TYPE_CHECKING:
+    from replay import PendingReplay
+
+# Configure logging (LOGGER_LEVEL, LOGGER_FORMAT and LOGGER_ROW_SAMPLE_RATE environment variables)
+configure_logging()
 logger = logging.getLogger(__name__)
-
-# Add console handler to ensure logs are printed to stdout
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+# Per-row debug records, sampled
+row_logger = get_row_logger(__name__)
 
 # Log startup message
 logger.info("Payment Processor Service starting up...")
-
-# API configuration
-API_BASE_URL = os.getenv('API_BASE_URL', 'http://api:8200')
-GATEWAY_URL = os.getenv('GATEWAY_URL', 'http://gateway:80')
-# Get the MongoDB connection string from the environment variable
-MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost:27017')  # Default to localhost
 logger.info(f"API Base URL: {API_BASE_URL}")
 
-app = FastAPI(title="Payment Processor Service")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the shared resources on startup and release them on shutdown"""
+    await start_gateway_client()
+    await start_mongo_client()
+    if WORK_QUEUE:
+        try:
+            await work_queue.start(process_queued_task)
+        except RedisError as e:
+            logger.error(f"Work queue unavailable, imports are processed by the receiving instance only: {str(e)}")
+    # The pipeline, the indexes and the connection pools are warmed up while the probes are already answered
+    readiness.start()
+    try:
+        yield
+    finally:
+        # Not ready anymore: no new upload is routed to a stopping instance
+        await readiness.stop()
+        # Running import jobs are recorded as interrupted before the clients go away
+        await job_manager.shutdown()
+        await work_queue.close()
+        await close_mongo_client()
+        await close_gateway_client()
+
+
+app = FastAPI(title="Payment Processor Service", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -55,8 +100,9 @@ app.add_middleware(
 # Add logging middleware
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    logger.debug(f"Incoming request: {request.method} {request.url}")
-    logger.debug(f"Headers: {dict(request.headers)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Incoming request: %s %s", request.method, request.url)
+        logger.debug("Headers: %s", redact_headers(request.headers))
 
     # Convert the request's path to modify the URL
     modified_url_path = request.url.path.replace(
@@ -69,7 +115,7 @@ async def log_requests(request: Request, call_next):
         request.scope["path"] = modified_url_path
 
     response = await call_next(request)
-    logger.info(f"Response status: {response.status_code}")
+    logger.debug("Response status: %s", response.status_code)
     return response
 
 class Payment(BaseModel):
@@ -90,6 +136,16 @@ class PaymentResult(BaseModel):
     message: str
     details: Dict = {}
 
+@dataclass
+class RowJob:
+    """A CSV row scheduled for processing"""
+    index: int
+    tenant_reference: str  # Padded tenant reference (raw tenant_id of invalid rows)
+    payment: Optional[Payment] = None
+    invalid: Optional[str] = None  # Set (to the reason) when the row was rejected by the normalization
+    raw: Optional[Dict] = None  # Trimmed raw values of a rejected row
+    duplicate: Optional[str] = None  # Set (to the reason) when the payment reference is a duplicate
+
 async def pad_tenant_id(tenant_id: str) -> str:
     """Pad tenant_id with leading zeros to ensure it's six digits"""
     # Convert to integer first to remove any decimal points, then to string and pad
@@ -98,16 +154,16 @@ async def pad_tenant_id(tenant_id: str) -> str:
 async def parse_payment_date(date_str: str) -> str:
     """
     Parse payment date from various formats and return in DD/MM/YYYY format.
-    Handles common formats like DD/MM/YYYY, DD-MM-YYYY, etc.
+    Handles common formats like DD/MM/YYYY, DD-MM-YYYY, etc. Dates that read
+    differently day first and month first are rejected as ambiguous.
     """
     try:
-        # Parse the date string
-        parsed_date = parser.parse(date_str, dayfirst=True)  # Assume DD/MM/YYYY format if ambiguous
-        # Return in DD/MM/YYYY format
-        return parsed_date.strftime('%d/%m/%Y')
-    except (ValueError, TypeError) as e:
+        # Strict DD/MM/YYYY first (memoized), other formats and dateutil (day first) for the rest
+        with observe_stage('date_parsing'):
+            return payment_date_parser.parse(date_str)
+    except ValueError as e:
         logger.error(f"Error parsing date {date_str}: {str(e)}")
-        raise ValueError(f"Invalid date format: {date_str}. Please use DD/MM/YYYY format.")
+        raise
 
 # Constants for frequency
 PAYMENT_FREQUENCY = 'months'  # Monthly payments are standard for rental contracts
@@ -128,12 +184,6 @@ async def log_pending_payment(tenant_id, payment_date, payment_type, payment_ref
         None
     """
 
-    # Initialize MongoDB client using the connection string
-    client = AsyncIOMotorClient(MONGO_URL)
-
-    # Select the database (replace 'database_name' with your actual database name)
-    db = client['bomatech']
-
     try:
         # Define the document to be inserted
         pending_payment = {
@@ -144,312 +194,291 @@ async def log_pending_payment(tenant_id, payment_date, payment_type, payment_ref
             "amount": amount,
             "dateCreated": datetime.utcnow(),  # Automatically log creation date
             "dateUpdated": datetime.utcnow(),  # Automatically log the last update date
-            "narration": narration
+            "narration": narration,
+            "status": PENDING_STATUS  # Set to resolved once replayed successfully
         }
 
+        # During an import the document is buffered and written in batches by the import's writer
+        writer = get_pending_writer()
+        if writer is not None and not writer.closed:
+            await writer.add(pending_payment)
+            return
+
         # Insert the document into the 'pendingPayments' collection
-        db['pendingPayments'].insert_one(pending_payment)
-        print(f"Pending payment logged successfully for tenantId: {tenant_id}")
+        with observe_mongo('log_pending_payment'):
+            await get_database()[PENDING_PAYMENTS_COLLECTION].insert_one(pending_payment)
+        row_logger.debug("Pending payment logged successfully for tenantId: %s", tenant_id)
     except Exception as e:
-        # Log an error if the operation fails (logger is assumed to be defined)
+        # Log an error if the operation fails
         logger.error(f"Failed to log pending payment for tenantId: {tenant_id}. Error: {e}")
 
 
-async def check_payment_exists(payment_reference, db_name='bomatech', collection_name='occupants'):
-    """
-    Check if a payment with the given reference exists in the occupants collection.
-
-    Args:
-        payment_reference (str): The payment reference to check.
-        db_name (str): The name of the MongoDB database. Defaults to 'bomatech'.
-        collection_name (str): The name of the MongoDB collection. Defaults to 'occupants'.
+async def log_pending_payments(payments: List[Payment], narration: str):
+    """Log every payment of a failed group into the 'pendingPayments' collection"""
+    for payment in payments:
+        await log_pending_payment(
+            tenant_id=payment.tenant_id,
+            payment_date=payment.payment_date,
+            payment_type=payment.payment_type,
+            payment_reference=payment.reference,
+            amount=payment.amount,
+            narration=narration  # Explanation of failure
+        )
 
-    Returns:
-        bool: True if the payment exists, False otherwise.
-    """
-    try:
-        # Connect to MongoDB
-        client = AsyncIOMotorClient(MONGO_URL)
 
-        # Select the database
-        db = client[db_name]
+def payment_entry(payment: Payment, formatted_date: str) -> dict:
+    """Entry of the payments array of a rent for a payment"""
+    return {
+        "type": payment.payment_type.lower() if payment.payment_type else "cash",
+        "date": formatted_date,
+        "reference": payment.reference,
+        "amount": float(payment.amount)  # Ensure amount is float
+    }
 
-        # Select the collection
-        collection = db[collection_name]
 
-        # Define the filter to find the payment
-        filter = {"rents.payments.reference": payment_reference}
+def settlement_fields(payment: Payment) -> dict:
+    """Settlement fields of a rent update (description, promo, extra charge), taken from the payment"""
+    return {
+        "description": payment.description or "",  # Ensure empty string if None
+        "promo": float(payment.promo_amount or 0),  # Ensure float and default to 0
+        "notepromo": payment.promo_note if payment.promo_amount and payment.promo_amount > 0 else "",
+        "extracharge": float(payment.extra_charge or 0),  # Ensure float and default to 0
+        "noteextracharge": payment.extra_charge_note if payment.extra_charge and payment.extra_charge > 0 else "",
+    }
 
-        # Find the payment in the occupants collection
-        payment = await collection.find_one(filter)
 
-        # Return True if the payment exists, False otherwise
-        return payment is not None
+def failed_results(payments: List[Payment], tenant_id: Optional[str], message: str) -> List[PaymentResult]:
+    """One failed result per payment (tenant_id defaults to each payment's tenant id)"""
+    return [
+        PaymentResult(success=False, tenant_id=tenant_id or payment.tenant_id, message=message)
+        for payment in payments
+    ]
 
-    except PyMongoError as e:
-        # Log the error and handle it appropriately
-        logger.error(f"Error checking payment existence for reference {payment_reference}: {str(e)}")
-        raise  # Re-raise the exception for the caller to handle
 
-    except Exception as e:
-        # Handle any other unexpected errors
-        logger.error(f"Unexpected error in check_payment_exists: {str(e)}")
-        raise
+async def process_tenant_payments(payments: List[Payment], term: str, organization_id: str,
+                                  auth_token: str = None) -> List[PaymentResult]:
+    """
+    Post payments of one tenant for a term with a single rent API update.
 
-async def process_single_payment(payment: Payment, term: str, organization_id: str,
-                                 auth_token: str = None) -> PaymentResult:
-    """Process a single payment by calling the rent API endpoint."""
+    The tenant's existing payments for the term are fetched once, all the new payments
+    are appended and the whole array is sent back with one PATCH. The settlement fields
+    (description, promo, extra charge) are taken from the last payment, as they would be
+    after posting the payments one by one. Returns one result per payment, in order.
+    """
     try:
         # Pad the tenant reference with leading zeros
-        padded_reference = await pad_tenant_id(payment.tenant_id)
-        logger.debug(f"Looking up tenant with reference: {padded_reference}")
-
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Accept-Language": "en",
-            "organizationId": organization_id,
-        }
+        padded_reference = await pad_tenant_id(payments[0].tenant_id)
+        row_logger.debug("Looking up tenant with reference: %s", padded_reference)
 
-        # Add authorization header if token is provided
-        if auth_token:
-            headers["Authorization"] = auth_token
+        headers = build_gateway_headers(organization_id, auth_token)
 
-        # Get tenant by reference number using the reference field
-        tenant_url = f"{GATEWAY_URL}/api/v2/tenants?reference={padded_reference}"
-        logger.debug(f"Looking up tenant with reference {padded_reference} at URL: {tenant_url}")
+        # Resolve the tenant by reference, from the tenant cache when possible
+        try:
+            with observe_stage('tenant_lookup'):
+                tenant = await tenant_resolver.resolve(organization_id, padded_reference, headers)
+        except TenantLookupError as e:
+            error_msg = str(e)
+            logger.error(error_msg)
+            return failed_results(payments, None, error_msg)
 
-        # Use a separate client for tenant lookup
-        async with httpx.AsyncClient(timeout=30.0) as lookup_client:
-            tenant_response = await lookup_client.get(tenant_url, headers=headers)
-            logger.debug(f"Tenant lookup response status: {tenant_response.status_code}")
+        if tenant is None:
+            error_msg = f"No tenant found with reference {padded_reference}"
 
-            if tenant_response.status_code != 200:
-                error_msg = f"Failed to find tenant with reference {padded_reference}: {tenant_response.text}"
-                logger.error(error_msg)
-                return PaymentResult(
-                    success=False,
-                    tenant_id=payment.tenant_id,
-                    message=error_msg
-                )
-
-            tenant_data = tenant_response.json()
-            logger.debug(f"Raw tenant data: {json.dumps(tenant_data, indent=2)}")
-
-            # Handle both list and single object responses
-            if isinstance(tenant_data, list):
-                if not tenant_data:
-                    error_msg = f"No tenant found with reference {padded_reference}"
-
-                    # Log to pendingPayments if the payment fails
-                    await log_pending_payment(
-                        tenant_id=payment.tenant_id,
-                        payment_date=payment.payment_date,
-                        payment_type=payment.payment_type,
-                        payment_reference=payment.reference,
-                        amount=payment.amount,
-                        narration=error_msg  # Explanation of failure
-                    )
-
-                    logger.error(error_msg)
-                    return PaymentResult(
-                        success=False,
-                        tenant_id=payment.tenant_id,
-                        message=error_msg
-                    )
-                # Find the tenant with matching reference
-                tenant = None
-                for t in tenant_data:
-                    if str(t.get('reference', '')).strip() == padded_reference:
-                        tenant = t
-                        break
-                if not tenant:
-                    error_msg = f"No tenant found with exact reference {padded_reference}"
-
-                    # Log to pendingPayments if the payment fails
-                    await log_pending_payment(
-                        tenant_id=payment.tenant_id,
-                        payment_date=payment.payment_date,
-                        payment_type=payment.payment_type,
-                        payment_reference=payment.reference,
-                        amount=payment.amount,
-                        narration=error_msg  # Explanation of failure
-                    )
-
-                    logger.error(error_msg)
-                    return PaymentResult(
-                        success=False,
-                        tenant_id=payment.tenant_id,
-                        message=error_msg
-                    )
-            else:
-                # Verify the reference matches
-                if str(tenant_data.get('reference', '')).strip() != padded_reference:
-                    error_msg = f"Tenant reference mismatch. Expected {padded_reference}, got {tenant_data.get('reference', '')}"
-
-                    # Log to pendingPayments if the payment fails
-                    await log_pending_payment(
-                        tenant_id=payment.tenant_id,
-                        payment_date=payment.payment_date,
-                        payment_type=payment.payment_type,
-                        payment_reference=payment.reference,
-                        amount=payment.amount,
-                        narration=error_msg  # Explanation of failure
-                    )
-
-                    logger.error(error_msg)
-                    return PaymentResult(
-                        success=False,
-                        tenant_id=payment.tenant_id,
-                        message=error_msg
-                    )
-                tenant = tenant_data
-
-            tenant_id = tenant.get('_id')
-            if not tenant_id:
-                error_msg = f"Tenant data missing _id field for reference {padded_reference}"
-
-                # Log to pendingPayments if the payment fails
-                await log_pending_payment(
-                    tenant_id=payment.tenant_id,
-                    payment_date=payment.payment_date,
-                    payment_type=payment.payment_type,
-                    payment_reference=payment.reference,
-                    amount=payment.amount,
-                    narration=error_msg  # Explanation of failure
-                )
+            # Log to pendingPayments if the payment fails
+            await log_pending_payments(payments, error_msg)
 
-                logger.error(error_msg)
-                return PaymentResult(
-                    success=False,
-                    tenant_id=payment.tenant_id,
-                    message=error_msg
-                )
+            logger.error(error_msg)
+            return failed_results(payments, None, error_msg)
+
+        tenant_id = tenant.id
+        gateway_client = get_gateway_client()
+
+        # Extract realmId from tenant data
+        # realm_id = tenant.get('realmId')
+        # if not realm_id:
+        #     error_msg = f"Tenant data missing realmId field for reference {padded_reference}"
+        #     logger.error(error_msg)
+        #     return PaymentResult(
+        #         success=False,
+        #         tenant_id=payment.tenant_id,
+        #         message=error_msg
+        #     )
+        #
+        # logger.debug(
+        #     f"Successfully found tenant. Reference: {padded_reference}, ID: {tenant_id}, Realm: {realm_id}")
+
+        # Format the new payments, a payment with an invalid date fails on its own
+        results: List[Optional[PaymentResult]] = [None] * len(payments)
+        new_payments = []
+        posted = []
+        for position, payment in enumerate(payments):
+            try:
+                formatted_date = await parse_payment_date(payment.payment_date)
+            except ValueError as e:
+                error_msg = f"Error processing payment: {str(e)}"
+                await log_pending_payments([payment], error_msg)
+                results[position] = PaymentResult(success=False, tenant_id=payment.tenant_id, message=error_msg)
+                continue
+            new_payments.append(payment_entry(payment, formatted_date))
+            posted.append(position)
+
+        if not new_payments:
+            return results
+
+        posted_payments = [payments[position] for position in posted]
+
+        def finish(outcome: List[PaymentResult]) -> List[PaymentResult]:
+            for position, result in zip(posted, outcome):
+                results[position] = result
+            return results
+
+        # The PATCH replaces the whole payments array: always fetch the payments recorded so far
+        # (by the UI, another import or another replica) instead of trusting a cached hasPayments
+        row_logger.debug("Fetching payment history of tenant %s.", tenant_id)
+
+        # Assuming term is in the format 'YYYY.MM'
+        year, month = term.split('.')
+        formatted_term = f"{year}{month.zfill(2)}0100"  # Format to YYYYMMDDHH
+
+        # Fetch existing payments for the tenant
+        get_payments_url = f"{GATEWAY_URL}/api/v2/rents/tenant/{tenant_id}/{formatted_term}"
+
+        with observe_stage('payments_fetch'):
+            payments_response = await gateway_request(gateway_client, 'GET', get_payments_url, headers=headers)
+        row_logger.debug("Payments lookup response status: %s", payments_response.status_code)
+
+        if payments_response.status_code != 200:
+            error_msg = f"Failed to fetch existing payments for tenant {tenant_id}: {payments_response.text}"
 
-            # Extract realmId from tenant data
-            # realm_id = tenant.get('realmId')
-            # if not realm_id:
-            #     error_msg = f"Tenant data missing realmId field for reference {padded_reference}"
-            #     logger.error(error_msg)
-            #     return PaymentResult(
-            #         success=False,
-            #         tenant_id=payment.tenant_id,
-            #         message=error_msg
-            #     )
-            #
-            # logger.debug(
-            #     f"Successfully found tenant. Reference: {padded_reference}, ID: {tenant_id}, Realm: {realm_id}")
-
-            # Check if the tenant has previous payments
-            has_payments = tenant.get("hasPayments", False)
-            if has_payments:
-                logger.debug(f"Tenant {tenant_id} has previous payments. Fetching payment history.")
-
-                # Assuming term is in the format 'YYYY.MM'
-                year, month = term.split('.')
-                formatted_term = f"{year}{month.zfill(2)}0100"  # Format to YYYYMMDDHH
-
-                # Fetch existing payments for the tenant
-                get_payments_url = f"{GATEWAY_URL}/api/v2/rents/tenant/{tenant_id}/{formatted_term}"
-
-                async with httpx.AsyncClient(timeout=30.0) as payments_client:
-                    payments_response = await payments_client.get(get_payments_url, headers=headers)
-                    logger.debug(f"Payments lookup response status: {payments_response.status_code}")
-
-                    if payments_response.status_code != 200:
-                        error_msg = f"Failed to fetch existing payments for tenant {tenant_id}: {payments_response.text}"
-
-                        # Log to pendingPayments if the payment fails
-                        await log_pending_payment(
-                            tenant_id=payment.tenant_id,
-                            payment_date=payment.payment_date,
-                            payment_type=payment.payment_type,
-                            payment_reference=payment.reference,
-                            amount=payment.amount,
-                            narration=error_msg  # Explanation of failure
-                        )
+            # Log to pendingPayments if the payment fails
+            await log_pending_payments(posted_payments, error_msg)
 
-                        logger.error(error_msg)
-                        return PaymentResult(
-                            success=False,
-                            tenant_id=tenant_id,
-                            message=error_msg
-                        )
+            logger.error(error_msg)
+            return finish(failed_results(posted_payments, tenant_id, error_msg))
 
-                    logger.debug(f"Payments response : {payments_response.json()}")
-                    existing_payments = payments_response.json().get('payments', [])
-                    if not existing_payments:
-                        logger.info(f"No existing payments found for tenant {tenant_id} and term {term}")
-                        existing_payments = []  # Initialize as empty list
+        existing_payments = payments_response.json().get('payments', [])
+        if not existing_payments:
+            row_logger.debug("No existing payments found for tenant %s and term %s", tenant_id, term)
+            existing_payments = []  # Initialize as empty list
 
-                    logger.debug(f"Existing payments for tenant {tenant_id}: {json.dumps(existing_payments, indent=2)}")
-            else:
-                logger.debug(f"Tenant {tenant_id} has no previous payments. Proceeding with new payment.")
-                existing_payments = []
-
-        # Format the new payment
-        formatted_date = await parse_payment_date(payment.payment_date)
-        new_payment = {
-            "type": payment.payment_type.lower() if payment.payment_type else "cash",
-            "date": formatted_date,
-            "reference": payment.reference,
-            "amount": float(payment.amount)  # Ensure amount is float
-        }
+        row_logger.debug("Existing payments for tenant %s: %s", tenant_id, LazyJson(existing_payments))
 
-        # Merge existing payments with the new payment
-        updated_payments = existing_payments + [new_payment]
+        # Merge existing payments with the new payments
+        updated_payments = existing_payments + new_payments
 
-        # Build the payment data
+        # Build the payment data, the settlement fields come from the last payment
+        payment = posted_payments[-1]
         payment_data = {
             "_id": tenant_id,  # Include tenant ID in payment data
             "payments": updated_payments,  # Send the entire payments array
-            "description": payment.description or "",  # Ensure empty string if None
-            "promo": float(payment.promo_amount or 0),  # Ensure float and default to 0
-            "notepromo": payment.promo_note if payment.promo_amount and payment.promo_amount > 0 else "",
-            "extracharge": float(payment.extra_charge or 0),  # Ensure float and default to 0
-            "noteextracharge": payment.extra_charge_note if payment.extra_charge and payment.extra_charge > 0 else "",
+            **settlement_fields(payment),
             "term": term  # Add formatted term to payment data
         }
-        logger.debug(f"Payment data for tenant {tenant_id}: {json.dumps(payment_data, indent=2)}")
+        row_logger.debug("Payment data for tenant %s: %s", tenant_id, LazyJson(payment_data))
 
         update_payments_url = f"{GATEWAY_URL}/api/v2/rents/payment/{tenant_id}/{term}"
 
-        # Use a separate client for payment request
-        async with httpx.AsyncClient(timeout=30.0) as payment_client:
-            payment_response = await payment_client.patch(update_payments_url, headers=headers, json=payment_data)
-            logger.info(f"Payment response for tenant {tenant_id} - Status: {payment_response.status_code}")
-            logger.info(f"Payment response body: {payment_response.text}")
-
-            if payment_response.status_code != 200:
-                error_msg = f"Failed to process payment for tenant {tenant_id}: {payment_response.text}"
-
-                # Log to pendingPayments if the payment fails
-                # log_pending_payment(
-                #     tenant_id=payment.tenant_id,
-                #     payment_date=payment.payment_date,
-                #     payment_type=payment.payment_type,
-                #     payment_reference=payment.reference,
-                #     amount=payment.amount,
-                #     narration=error_msg  # Explanation of failure
-                # )
+        with observe_stage('payment_patch'):
+            payment_response = await gateway_request(gateway_client, 'PATCH', update_payments_url, headers=headers,
+                                                      json=payment_data)
+        row_logger.debug("Payment response for tenant %s - Status: %s", tenant_id, payment_response.status_code)
 
-                logger.error(error_msg)
-                return PaymentResult(
-                    success=False,
-                    tenant_id=tenant_id,
-                    message=error_msg
-                )
+        if payment_response.status_code != 200:
+            error_msg = f"Failed to process payment for tenant {tenant_id}: {payment_response.text}"
 
-            logger.info(f"Successfully processed payment for tenant {tenant_id}")
-            return PaymentResult(
+            # The cached tenant may be stale (e.g. deleted tenant), look it up again next time
+            tenant_resolver.invalidate(organization_id, padded_reference)
+
+            # Log to pendingPayments if the payment fails
+            # log_pending_payment(
+            #     tenant_id=payment.tenant_id,
+            #     payment_date=payment.payment_date,
+            #     payment_type=payment.payment_type,
+            #     payment_reference=payment.reference,
+            #     amount=payment.amount,
+            #     narration=error_msg  # Explanation of failure
+            # )
+
+            logger.error(error_msg)
+            return finish(failed_results(posted_payments, tenant_id, error_msg))
+
+        row_logger.debug("Successfully processed %d payment(s) for tenant %s", len(posted_payments), tenant_id)
+        return finish([
+            PaymentResult(
                 success=True,
                 tenant_id=tenant_id,
                 message=f"Successfully processed payment for tenant {tenant_id}"
             )
+            for _ in posted_payments
+        ])
 
     except Exception as e:
         error_msg = f"Error processing payment: {str(e)}"
 
+        # Log to pendingPayments if the payment fails
+        await log_pending_payments(payments, error_msg)
+
+        logger.error(error_msg)
+        return failed_results(payments, None, error_msg)
+
+
+async def process_single_payment(payment: Payment, term: str, organization_id: str,
+                                 auth_token: str = None) -> PaymentResult:
+    """Process a single payment by calling the rent API endpoint."""
+    return (await process_tenant_payments([payment], term, organization_id, auth_token))[0]
+
+
+async def process_row_job(job: RowJob, term: str, organization_id: str,
+                          auth_token: str = None) -> Tuple[PaymentResult, Optional[dict]]:
+    """Process one row, returns the result and the error event to send (if any)"""
+    index, payment = job.index, job.payment
+    try:
+        # Rows rejected by the normalization never reach the network
+        if job.invalid:
+            error_msg = job.invalid
+            logger.error(error_msg)
+
+            await log_pending_payment(
+                tenant_id=job.raw['tenant_id'],
+                payment_date=job.raw['payment_date'],
+                payment_type=job.raw['payment_type'],
+                payment_reference=job.raw['payment_reference'],
+                amount=job.raw['amount'],
+                narration=error_msg  # Explanation of failure
+            )
+
+            return PaymentResult(
+                success=False,
+                tenant_id=job.raw['tenant_id'],
+                message=error_msg
+            ), dict(status='error', message=error_msg)
+
+        # Skip the payment if its reference is already recorded or repeated in the file
+        if job.duplicate:
+            error_msg = job.duplicate
+            logger.error(error_msg)
+
+            await log_pending_payment(
+                tenant_id=payment.tenant_id,
+                payment_date=payment.payment_date,
+                payment_type=payment.payment_type,
+                payment_reference=payment.reference,
+                amount=payment.amount,
+                narration=error_msg  # Explanation of failure
+            )
+
+            return PaymentResult(
+                success=False,
+                tenant_id=payment.tenant_id,
+                message=error_msg
+            ), dict(status='error', message=error_msg)
+
+        # Process the payment
+        return await process_single_payment(payment, term, organization_id, auth_token), None
+
+    except Exception as e:
+        error_msg = f"Error processing payment {index + 1}: {str(e)}"
+
         # Log to pendingPayments if the payment fails
         await log_pending_payment(
             tenant_id=payment.tenant_id,
@@ -464,132 +493,470 @@ async def process_single_payment(payment: Payment, term: str, organization_id: s
         return PaymentResult(
             success=False,
             tenant_id=payment.tenant_id,
-            message=error_msg
-        )
+            message=f"Failed to process payment: {str(e)}",
+            details={"error": str(e)}
+        ), dict(status='error', message=error_msg, error=str(e))
 
 
-@app.post("/process-payments")
-async def process_payments(
-        request: Request,
-        file: UploadFile = File(...),
-        term: str = Form(...)
-):
-    """Process bulk payments from a CSV file with progress tracking"""
+def tenant_batches(jobs: Iterable[RowJob], aggregate: bool = False) -> Iterator[List[RowJob]]:
+    """
+    Group row jobs into batches: one row per batch, or in aggregate mode the valid rows
+    of a tenant, ordered by their first row. Rows are grouped within the jobs given (a chunk
+    of the file): a tenant whose rows span several chunks gets one rent update per chunk.
+    The batches are not in file order, see in_file_order.
+    """
+    if not aggregate:
+        for job in jobs:
+            yield [job]
+        return
+    batches = {}
+    for job in jobs:
+        if job.invalid or job.duplicate:
+            batches[('row', job.index)] = [job]
+        else:
+            batches.setdefault(('tenant', job.tenant_reference), []).append(job)
+    yield from batches.values()
+
+
+async def in_file_order(batches: AsyncGenerator[List[tuple], None], order: Deque[int]) -> AsyncIterator[List[tuple]]:
+    """
+    Yield the (job, result, error event) outcomes of batches in file order.
 
-    async def process_payments_generator():
+    order holds the indexes of the rows in file order, extended as the chunks are prepared
+    (before their batches are processed). Outcomes are held until the rows before them are done.
+    """
+    held = {}
+    try:
+        async for outcomes in batches:
+            for outcome in outcomes:
+                held[outcome[0].index] = outcome
+            ready = []
+            while order and order[0] in held:
+                ready.append(held.pop(order.popleft()))
+            if ready:
+                yield ready
+    finally:
+        # Stops the processing of the batches when the import stops early
+        await batches.aclose()
+
+
+async def process_row_batch(batch: List[RowJob], term: str, organization_id: str,
+                            auth_token: str = None) -> List[Tuple[RowJob, PaymentResult, Optional[dict]]]:
+    """Process a batch of tenant_batches, returns the (job, result, error event) of each of its rows"""
+    if len(batch) == 1:
+        return [(batch[0], *await process_row_job(batch[0], term, organization_id, auth_token))]
+    results = await process_tenant_payments([job.payment for job in batch], term, organization_id, auth_token)
+    return [(job, result, None) for job, result in zip(batch, results)]
+
+
+async def process_queued_task(task: dict) -> List[dict]:
+    """
+    Process the rows of a work queue task (see workqueue), on the replica consuming it.
+
+    Returns the outcome of each row, in order: its result and the error event to send.
+    """
+    context = task['context']
+    organization_id, term = context['organizationId'], context['term']
+    auth_token = context.get('authorization')
+    jobs = [
+        RowJob(index=row['index'], tenant_reference=row['key'], payment=Payment.model_construct(**row['payment']))
+        for row in task['rows']
+    ]
+    recorded = set()
+    if task.get('redelivered'):
+        # The replica that stopped while processing the task may have posted some of its rows
+        # (their references were not recorded yet when the import published them)
+        recorded = await find_existing_references(job.payment.reference for job in jobs)
+
+    pending_writer = PendingPaymentWriter(
+        context=dict(organizationId=organization_id, term=term, importId=context['importId'])
+    )
+    set_pending_writer(pending_writer)
+    try:
+        headers = build_gateway_headers(organization_id, auth_token)
+        references = {job.tenant_reference for job in jobs}
         try:
-            logger.info(f"Starting bulk payment processing for term: {term}")
+            with observe_stage('tenant_bulk_lookup'):
+                await tenant_resolver.resolve_many(organization_id, references, headers)
+        except Exception as e:
+            # Not fatal: each row looks its tenant up again
+            logger.warning(f"Bulk tenant resolution failed, falling back to per-row lookups: {str(e)}")
+
+        async def process_batch(batch: List[RowJob]):
+            return await process_row_batch(batch, term, organization_id, auth_token)
+
+        outcomes = {}
+        for job in jobs:
+            if job.payment.reference in recorded:
+                result = PaymentResult(success=True, tenant_id=job.payment.tenant_id,
+                                       message=f"Payment with reference {job.payment.reference} was already recorded")
+                outcomes[job.index] = dict(result=result.dict(), error_event=None)
+        executor = OrderedExecutor(PAYMENT_CONCURRENCY, PAYMENT_WINDOW)
+        to_process = [job for job in jobs if job.index not in outcomes]
+        async for _, batch_outcomes in executor.map(tenant_batches(to_process, context.get('aggregate', False)),
+                                                    process_batch, lambda batch: batch[0].tenant_reference):
+            for job, result, error_event in batch_outcomes:
+                outcomes[job.index] = dict(result=result.dict(), error_event=error_event)
+        return [outcomes[job.index] for job in jobs]
+    finally:
+        set_pending_writer(None)
+        with anyio.CancelScope(shield=True):
+            await pending_writer.close()
+
+
+# Columns every uploaded CSV file must have
+REQUIRED_COLUMNS = {"tenant_id", "payment_date", "payment_type", "payment_reference", "amount"}
+
+
+def sse_event(event: dict, event_id: Optional[int] = None) -> str:
+    """Format an import event as a server-sent event (with its id when given)"""
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {json.dumps(event)}\n\n"
+    return f"data: {json.dumps(event)}\n\n"
+
+
+async def import_payments(file: UploadFile, term: str, organization_id: str,
+                          auth_token: str = None, aggregate: bool = False,
+                          on_result: Optional[Callable[[int, dict], Awaitable[None]]] = None,
+                          import_id: Optional[str] = None, stream_results: bool = True) -> AsyncIterator[dict]:
+    """
+    Import the payments of an uploaded CSV file and yield the progress events.
 
-            # Read the entire file into memory
-            content = await file.read()
-            total_size = len(content)
-            yield f"data: {json.dumps(dict(status='uploading', progress=100, message='File uploaded successfully'))}\n\n"
+    The file is parsed chunk by chunk while it is read: the duplicate references and
+    the tenants of each chunk are resolved in bulk, then its rows are processed
+    concurrently, in file order for each tenant and term.
 
-            # Process the CSV content
-            yield f"data: {json.dumps(dict(status='processing', progress=0, message='Processing CSV file...'))}\n\n"
+    With aggregate, the valid rows of a chunk are grouped by tenant and posted with
+    one rent update per tenant (see process_tenant_payments) instead of one per row.
+    Results are still reported per row, in file order (see in_file_order).
 
-            # Close the file to release resources
-            await file.close()
+    The result of every row is streamed as a 'result' event (unless stream_results is False)
+    and appended to the report of the import (see reports), the 'complete' event only
+    carries the counts and the import id the report is fetched by. on_result, when given,
+    is called with the row number and the result of every row as soon as the row is
+    processed (the background jobs use it to store the results).
 
-            # Get organization ID from headers
-            organization_id = request.headers.get('organizationid')
-            auth_token = request.headers.get('authorization')
+    The rows posted successfully are checkpointed (see checkpoints): when the same file is
+    imported again for the same term, those rows are skipped and only the rest is processed.
+    Without checkpoints, the file is counted while it is parsed (see ingest.ScannedFile).
+    """
+    # The CSV pipeline (pandas) is loaded by the warm-up, not when the application starts
+    from ingest import ScannedFile, iter_csv_chunks, scan_csv
+    from normalize import prepare_payments
+
+    import_id = import_id or uuid.uuid4().hex
+    # Failed rows are buffered and written to pendingPayments in batches during the import
+    pending_writer = PendingPaymentWriter(context=dict(organizationId=organization_id, term=term, importId=import_id))
+    set_pending_writer(pending_writer)
+    IMPORTS_IN_PROGRESS.inc()
+    checkpoint: Optional[ImportCheckpoint] = None
+    recomputes: Optional[RentRecomputeQueue] = None
+    summary = None
+    report = ReportWriter(import_id, organization_id, term)
+    try:
+        try:
+            logger.info(f"Starting bulk payment processing for term: {term} (import {import_id})")
+            yield dict(status='uploading', progress=100, message='File uploaded successfully', importId=import_id)
 
-            csv_content = content.decode()
-            df = pd.read_csv(StringIO(csv_content))
-            logger.debug(f"DataFrame content:\n{df}")
+            # Process the CSV content
+            yield dict(status='processing', progress=0, message='Processing CSV file...')
 
-            # Clear the file content from memory
-            del content
-            # Clear the decoded CSV content from memory (no longer needed)
-            del csv_content
+            scan = None
+            if IMPORT_CHECKPOINTS:
+                # The checkpoint of the file is keyed by its hash, needed before the first row: the file
+                # is hashed and counted (not loaded) up front
+                total_rows, content_hash = await scan_csv(file)
+            else:
+                # Counted while it is parsed, the progress is based on an estimate until the end is read
+                scan = ScannedFile(file.file)
+                total_rows, content_hash = 0, None
+            chunks = iter_csv_chunks(file, scan=scan)
+            first_chunk = await anext(chunks, None)
 
             # Validate required columns
-            required_columns = {"tenant_id", "payment_date", "payment_type", "payment_reference", "amount"}
-            if not required_columns.issubset(df.columns):
-                error_msg = f"CSV file is missing required columns: {required_columns - set(df.columns)}"
+            if first_chunk is not None and not REQUIRED_COLUMNS.issubset(first_chunk.columns):
+                error_msg = f"CSV file is missing required columns: {REQUIRED_COLUMNS - set(first_chunk.columns)}"
                 logger.error(error_msg)
-                yield f"data: {json.dumps(dict(status='error', message=error_msg))}\n\n"
+                await chunks.aclose()
+                yield dict(status='error', message=error_msg)
                 return
 
-            total_payments = len(df)
-            update_interval = max(1, total_payments // 10)  # Send updates every 10% progress
+            # Rows committed by a previous run of the same file are skipped
+            committed = set()
+            if IMPORT_CHECKPOINTS and first_chunk is not None:
+                checkpoint = ImportCheckpoint(organization_id, term, content_hash)
+                try:
+                    committed = set(await checkpoint.open())
+                except ImportInProgressError as e:
+                    checkpoint = None
+                    logger.error(str(e))
+                    await chunks.aclose()
+                    yield dict(status='error', message=str(e))
+                    return
+            skipped_rows = len(committed)
+            if skipped_rows:
+                count_rows('skipped', skipped_rows)
+                total_rows = max(0, total_rows - skipped_rows)
+                yield dict(status='processing', progress=0, skipped=skipped_rows,
+                           message=f'Resuming import: skipping {skipped_rows} rows already processed by a previous run...')
+
+            headers = build_gateway_headers(organization_id, auth_token)
+            # Direct backend: payments are appended to the occupants collection, the rents recomputed at the end
+            direct = PAYMENT_BACKEND == 'direct'
+            resolver = direct_tenant_resolver if direct else tenant_resolver
+            if direct:
+                recomputes = RentRecomputeQueue(organization_id, term, headers)
+                direct_writer = DirectPaymentWriter(organization_id, term, recomputes)
+            # Rows processed by every replica through the work queue (gateway backend only)
+            queued = work_queue.started and not direct
+            duplicates = DuplicateChecker()
+            # The date format of the file is detected on its first rows
+            date_parser = DateParser()
+            if first_chunk is not None:
+                date_parser.detect(first_chunk['payment_date'])
+            total_payments = 0
             successful_payments = 0
-            results = []
+            update_interval = max(1, total_rows // 10)  # Send updates every 10% progress
+            counts = dict(success=0, failed=0, invalid=0, duplicate=0)
+
+            async def prepare_chunk(df):
+                """Normalize a chunk, then resolve its payment references and tenants in bulk"""
+                with observe_stage('normalization'):
+                    prepared = prepare_payments(df, date_parser)
+
+                # Existing payment references, with a few batched queries
+                await duplicates.load(prepared.payments['reference'])
+                if queued:
+                    # Resolved by the replicas processing the rows
+                    return prepared
 
-            for index, row in df.iterrows():
+                # Tenants, with one gateway call (cached per organization)
                 try:
-                    # Create payment object
-                    payment = Payment(
-                        tenant_id=str(row['tenant_id']).strip(),
-                        payment_date=str(row['payment_date']).strip(),
-                        payment_type=str(row['payment_type']).strip(),
-                        reference=str(row['payment_reference']).strip(),
-                        amount=float(row['amount']),
-                        description=str(row.get('description', '')).strip(),
-                        promo_amount=float(row.get('promo_amount', 0)),
-                        promo_note=str(row.get('promo_note', '')).strip(),
-                        extra_charge=float(row.get('extra_charge', 0)),
-                        extra_charge_note=str(row.get('extra_charge_note', '')).strip()
-                    )
-
-                    # Check if the payment exists in the occupants collection if it exists, skip the payment
-                    if await check_payment_exists(payment.reference):
-                        error_msg = f"Payment with reference {payment.reference} already exists in the database"
-                        logger.error(error_msg)
-                        results.append(PaymentResult(
-                            success=False,
-                            tenant_id=str(row.get('tenant_id', '')),
-                            message=error_msg
-                        ))
-
-                        await log_pending_payment(
-                            tenant_id=payment.tenant_id,
-                            payment_date=payment.payment_date,
-                            payment_type=payment.payment_type,
-                            payment_reference=payment.reference,
-                            amount=payment.amount,
-                            narration=error_msg  # Explanation of failure
+                    with observe_stage('tenant_bulk_lookup'):
+                        await resolver.resolve_many(
+                            organization_id, set(prepared.payments['tenant_reference']), headers
                         )
-
-                        yield f"data: {json.dumps(dict(status='error', message=error_msg))}\n\n"
+                except Exception as e:
+                    # Not fatal: each row looks its tenant up again
+                    logger.warning(f"Bulk tenant resolution failed, falling back to per-row lookups: {str(e)}")
+                return prepared
+
+            def chunk_jobs(df, prepared):
+                """Turn a prepared chunk into row jobs, in file order"""
+                payments = prepared.payments.to_dict('index')
+                invalid = prepared.invalid.to_dict('index')
+                for index in df.index:
+                    record = payments.get(index)
+                    if record is None:
+                        raw = invalid[index]
+                        yield RowJob(index=index, raw=raw, tenant_reference=raw['tenant_id'],
+                                     invalid=f"Invalid row {index + 1}: {raw.pop('error')}")
                         continue
+                    tenant_reference = record.pop('tenant_reference')
+                    # Values were validated column-wise already
+                    payment = Payment.model_construct(**record)
+                    # Checked here, in file order, so the first occurrence of a reference is the one processed
+                    duplicate = duplicates.check(payment.reference, index + 1)
+                    yield RowJob(index=index, payment=payment, tenant_reference=tenant_reference,
+                                 duplicate=duplicate)
+
+            async def prepared_chunks():
+                """Yield the row jobs of each chunk, without the rows committed by a previous run"""
+                df = first_chunk
+                while df is not None:
+                    if committed:
+                        df = df.drop(index=[index for index in df.index if index + 1 in committed])
+                    prepared = await prepare_chunk(df)
+                    yield list(chunk_jobs(df, prepared))
+                    df = await anext(chunks, None)
+
+            # File order of the rows of aggregate mode, whose batches are grouped by tenant (see in_file_order)
+            row_order: Deque[int] = deque()
+
+            async def prepare_batches():
+                """
+                Yield the rows to process as batches (see tenant_batches), in direct mode
+                the rows of a chunk as one batch
+                """
+                async for jobs in prepared_chunks():
+                    if direct:
+                        # The rows of a chunk are recorded together, with one bulk write
+                        if jobs:
+                            yield jobs
+                    else:
+                        if aggregate:
+                            row_order.extend(job.index for job in jobs)
+                        for batch in tenant_batches(jobs, aggregate):
+                            yield batch
+
+            def batch_key(batch: List[RowJob]):
+                if direct:
+                    # Chunks are written one after the other, the next one is prepared meanwhile
+                    return 'direct', term
+                return batch[0].tenant_reference, term
+
+            async def process_direct_batch(batch: List[RowJob]):
+                """Record the valid payments of a chunk with one bulk write, returns the (job, result, error event) of each row"""
+                outcomes = {}
+                tenant_rows: Dict[str, List[Tuple[RowJob, dict]]] = {}
+                for job in batch:
+                    if job.invalid or job.duplicate:
+                        outcomes[job.index] = (job, *await process_row_job(job, term, organization_id, auth_token))
+                        continue
+                    payment = job.payment
+                    try:
+                        with observe_stage('tenant_lookup'):
+                            tenant = await resolver.resolve(organization_id, job.tenant_reference, headers)
+                        if tenant is None:
+                            raise ValueError(f"No tenant found with reference {job.tenant_reference}")
+                        formatted_date = await parse_payment_date(payment.payment_date)
+                    except Exception as e:
+                        error_msg = str(e)
+                        await log_pending_payments([payment], error_msg)
+                        logger.error(error_msg)
+                        outcomes[job.index] = (job, *failed_results([payment], None, error_msg), None)
+                        continue
+                    tenant_rows.setdefault(tenant.id, []).append((job, payment_entry(payment, formatted_date)))
 
-                    # Process the payment
-                    result = await process_single_payment(payment, term, organization_id, auth_token)
-                    if result.success:
-                        successful_payments += 1
-                    results.append(result)
-
-                    # Send progress update
-                    if (index + 1) % update_interval == 0 or (index + 1) == total_payments:
-                        progress = int(((index + 1) / total_payments) * 100)
-                        yield f"data: {json.dumps(dict(status='processing', progress=progress, message=f'Processing payments... {progress}% ({index + 1}/{total_payments})', current_result=result.dict()))}\n\n"
-
+                tenant_ids = list(tenant_rows)
+                try:
+                    errors = await direct_writer.post([
+                        TenantPayments(tenant_id, [entry for _, entry in tenant_rows[tenant_id]],
+                                       settlement_fields(tenant_rows[tenant_id][-1][0].payment))
+                        for tenant_id in tenant_ids
+                    ])
                 except Exception as e:
-                    error_msg = f"Error processing payment {index + 1}: {str(e)}"
-
-                    # Log to pendingPayments if the payment fails
-                    await log_pending_payment(
-                        tenant_id=payment.tenant_id,
-                        payment_date=payment.payment_date,
-                        payment_type=payment.payment_type,
-                        payment_reference=payment.reference,
-                        amount=payment.amount,
-                        narration=error_msg  # Explanation of failure
-                    )
-
-                    logger.error(error_msg)
-                    results.append(PaymentResult(
-                        success=False,
-                        tenant_id=str(row.get('tenant_id', '')),
-                        message=f"Failed to process payment: {str(e)}",
-                        details={"error": str(e)}
-                    ))
-                    yield f"data: {json.dumps(dict(status='error', message=error_msg, error=str(e)))}\n\n"
+                    errors = [f"Error processing payment: {str(e)}"] * len(tenant_ids)
+                for tenant_id, error_msg in zip(tenant_ids, errors):
+                    payments = [job.payment for job, _ in tenant_rows[tenant_id]]
+                    if error_msg is not None:
+                        await log_pending_payments(payments, error_msg)
+                        logger.error(error_msg)
+                        results = failed_results(payments, tenant_id, error_msg)
+                    else:
+                        results = [
+                            PaymentResult(success=True, tenant_id=tenant_id,
+                                          message=f"Successfully recorded payment for tenant {tenant_id}")
+                            for _ in payments
+                        ]
+                    for (job, _), result in zip(tenant_rows[tenant_id], results):
+                        outcomes[job.index] = (job, result, None)
+                return [outcomes[job.index] for job in batch]
+
+            async def process_batch(batch: List[RowJob]):
+                """Process a batch, returns the (job, result, error event) of each of its rows"""
+                if direct:
+                    return await process_direct_batch(batch)
+                return await process_row_batch(batch, term, organization_id, auth_token)
+
+            async def queued_outcomes():
+                """
+                Publish the valid rows of each chunk to the work queue, then yield the (job, result,
+                error event) of the rows of each chunk in file order, the other rows processed here
+                """
+                queued_import = QueuedImport(work_queue, import_id, dict(
+                    organizationId=organization_id, term=term, authorization=auth_token, aggregate=aggregate
+                ))
+
+                async def queued_chunks():
+                    async for jobs in prepared_chunks():
+                        sent = [job for job in jobs if not job.invalid and not job.duplicate]
+                        rows = [dict(index=job.index, key=job.tenant_reference, payment=job.payment.model_dump())
+                                for job in sent]
+                        yield (jobs, sent), rows
+
+                async for (jobs, sent), row_outcomes in queued_import.map(queued_chunks()):
+                    remote = {job.index: outcome for job, outcome in zip(sent, row_outcomes)}
+                    outcomes = []
+                    for job in jobs:
+                        outcome = remote.get(job.index)
+                        if outcome is None:
+                            outcomes.append((job, *await process_row_job(job, term, organization_id, auth_token)))
+                        elif 'error' in outcome:
+                            error_msg = f"Error processing payment: {outcome['error']}"
+                            await log_pending_payments([job.payment], error_msg)
+                            outcomes.append((job, *failed_results([job.payment], None, error_msg), None))
+                        else:
+                            outcomes.append((job, PaymentResult(**outcome['result']), outcome['error_event']))
+                    yield outcomes
+                logger.info(f"Import {import_id}: {queued_import.tasks_sent} tasks processed through the work queue")
+
+            if queued:
+                batches = queued_outcomes()
+            else:
+                # Rows run concurrently (rows of the same tenant and term one after the other),
+                # results come back in file order so the progress events stay ordered
+                executor = OrderedExecutor(PAYMENT_CONCURRENCY, PAYMENT_WINDOW)
+                batches = (outcomes async for _, outcomes in executor.map(prepare_batches(), process_batch, batch_key))
+                if aggregate and not direct:
+                    batches = in_file_order(batches, row_order)
+            try:
+                async for outcomes in batches:
+                    for job, result, error_event in outcomes:
+                        total_payments += 1
+                        row = job.index + 1
+                        result_data = result.dict()
+                        await report.add(row, result_data)
+                        if on_result is not None:
+                            await on_result(row, result_data)
+                        if checkpoint is not None and result.success:
+                            await checkpoint.commit(row)
+                        outcome = ('invalid' if job.invalid else 'duplicate' if job.duplicate
+                                   else 'success' if result.success else 'failed')
+                        counts[outcome] += 1
+                        count_rows(outcome)
+                        if stream_results:
+                            yield dict(status='result', row=row, **result_data)
+
+                        # Report pendingPayments writes that failed since the last row
+                        for message in pending_writer.drain_errors():
+                            yield dict(status='error', message=message)
+
+                        if error_event is not None:
+                            yield error_event
+                            continue
+
+                        if result.success:
+                            successful_payments += 1
+
+                        # Send progress update
+                        if scan is not None:
+                            total_rows = scan.estimate_rows()
+                            update_interval = max(1, total_rows // 10)
+                        if total_payments % update_interval == 0 or total_payments == total_rows:
+                            progress = min(100, int((total_payments / max(total_rows, 1)) * 100))
+                            yield dict(status='processing', progress=progress, message=f'Processing payments... {progress}% ({total_payments}/{total_rows})', current_result=result_data)
+            finally:
+                await batches.aclose()
+                await chunks.aclose()
+
+            if direct:
+                yield dict(status='processing', progress=100, message='Recomputing the rents of the tenants...')
+                sent = await recomputes.send()
+                logger.info(f"Recomputed {sent} rents for term {term}")
+                for message in recomputes.drain_errors():
+                    yield dict(status='error', message=message)
+
+            # Write the remaining pending payments before reporting the outcome
+            await pending_writer.close()
+            for message in pending_writer.drain_errors():
+                yield dict(status='error', message=message)
+
+            logger.info(
+                "Bulk payment processing complete for term %s: %d/%d payments successful, %d rows skipped",
+                term, successful_payments, total_payments, skipped_rows
+            )
+            summary = dict(processed=total_payments, successful=successful_payments, skipped=skipped_rows,
+                           counts=counts, finishedAt=datetime.utcnow())
 
             # Send final results
-            yield f"data: {json.dumps(dict(status='complete', progress=100, message=f'Processing complete. {successful_payments}/{total_payments} payments successful.', results=[result.dict() for result in results]))}\n\n"
+            message = f'Processing complete. {successful_payments}/{total_payments} payments successful.'
+            if skipped_rows:
+                message += f' {skipped_rows} rows were already processed by a previous run.'
+            yield dict(status='complete', progress=100, message=message, importId=import_id,
+                       total=total_payments, successful=successful_payments,
+                       failed=total_payments - successful_payments, skipped=skipped_rows, counts=counts,
+                       report=f'/imports/{import_id}/report')
 
         except Exception as e:
             error_msg = f"Error in bulk payment processing: {str(e)}"
@@ -605,13 +972,410 @@ async def process_payments(
             )
 
             logger.error(error_msg)
-            yield f"data: {json.dumps(dict(status='error', message=error_msg, error=str(e)))}\n\n"
+            yield dict(status='error', message=error_msg, error=str(e))
+    finally:
+        # Write what is still buffered, also when the client disconnected (the stream is cancelled then)
+        with anyio.CancelScope(shield=True):
+            await pending_writer.close()
+            if checkpoint is not None:
+                await checkpoint.close(summary)
+            if recomputes is not None and recomputes.queued:
+                # Stopped before the end (disconnected client, error): the payments appended are in the rents
+                sent = await recomputes.send()
+                logger.info(f"Recomputed {sent} rents for term {term} after the import stopped")
+            await report.close(summary)
+        set_pending_writer(None)
+        IMPORTS_IN_PROGRESS.dec()
+        await file.close()
+
+
+async def plan_payments(file: UploadFile, term: str, organization_id: str,
+                        auth_token: str = None) -> AsyncIterator[dict]:
+    """
+    Dry run of an import: yield the plan of every row ('plan' events, in file order) and the
+    totals by action, with read-only calls only (see plan).
+    """
+    from ingest import ScannedFile, iter_csv_chunks, scan_csv
+    from plan import PLAN_POST, ImportPlanner
+
+    try:
+        logger.info(f"Planning the import of a file for term: {term}")
+        yield dict(status='uploading', progress=100, message='File uploaded successfully', dryRun=True)
+        # Like the import: hashed up front for the checkpoint, else counted while it is parsed
+        scan = None
+        if IMPORT_CHECKPOINTS:
+            total_rows, content_hash = await scan_csv(file)
+        else:
+            scan = ScannedFile(file.file)
+            total_rows, content_hash = 0, None
+        chunks = iter_csv_chunks(file, scan=scan)
+        try:
+            first_chunk = await anext(chunks, None)
+            if first_chunk is not None and not REQUIRED_COLUMNS.issubset(first_chunk.columns):
+                error_msg = f"CSV file is missing required columns: {REQUIRED_COLUMNS - set(first_chunk.columns)}"
+                logger.error(error_msg)
+                yield dict(status='error', message=error_msg)
+                return
+
+            # Rows committed by a previous run of the same file would be skipped (the lease is not taken)
+            committed = set()
+            if IMPORT_CHECKPOINTS and first_chunk is not None:
+                committed = await ImportCheckpoint(organization_id, term, content_hash).load_committed()
+
+            resolver = direct_tenant_resolver if PAYMENT_BACKEND == 'direct' else tenant_resolver
+            planner = ImportPlanner(organization_id, term, build_gateway_headers(organization_id, auth_token),
+                                    resolver, committed)
+            yield dict(status='processing', progress=0, message='Planning the import...')
+
+            async def file_chunks():
+                if first_chunk is not None:
+                    yield first_chunk
+                async for df in chunks:
+                    yield df
+
+            planned_rows = 0
+            update_interval = max(1, total_rows // 10)  # Send updates every 10% progress
+            async for planned in planner.plan(file_chunks()):
+                planned_rows += 1
+                yield dict(status='plan', **asdict(planned))
+                if scan is not None:
+                    total_rows = scan.estimate_rows()
+                    update_interval = max(1, total_rows // 10)
+                if planned_rows % update_interval == 0:
+                    progress = min(100, int((planned_rows / max(total_rows, 1)) * 100))
+                    yield dict(status='processing', progress=progress,
+                               message=f'Planning the import... {progress}% ({planned_rows}/{total_rows})')
+        finally:
+            await chunks.aclose()
+
+        counts = planner.counts
+        logger.info(f"Import plan for term {term}: {counts}")
+        yield dict(status='complete', progress=100, dryRun=True, total=planned_rows, counts=counts,
+                   amount=round(planner.amount, 2),
+                   message=f"Dry run complete. {counts[PLAN_POST]}/{planned_rows} payments would be posted.")
+    except Exception as e:
+        error_msg = f"Error planning the import: {str(e)}"
+        logger.error(error_msg)
+        yield dict(status='error', message=error_msg, error=str(e))
+    finally:
+        await file.close()
+
+
+@app.post("/process-payments")
+async def process_payments(
+        request: Request,
+        file: UploadFile = File(...),
+        term: str = Form(...),
+        aggregate: bool = Form(False),
+        dry_run: bool = Form(False)
+):
+    """
+    Process bulk payments from a CSV file with progress tracking.
+
+    Set aggregate to post the payments of a tenant with one rent update instead of one per row.
+    Set dry_run to get the plan of the import (what would be done with every row) without writing anything.
+    """
+    # Get organization ID from headers
+    organization_id = request.headers.get('organizationid')
+    auth_token = request.headers.get('authorization')
+
+    async def process_payments_generator():
+        if dry_run:
+            events = plan_payments(file, term, organization_id, auth_token)
+        else:
+            events = import_payments(file, term, organization_id, auth_token, aggregate=aggregate)
+        async for event in events:
+            yield sse_event(event)
 
     return StreamingResponse(
         process_payments_generator(),
         media_type="text/event-stream"
     )
 
+async def spool_upload(file: UploadFile) -> UploadFile:
+    """Copy an upload to a temporary file owned by the caller (the request closes its own file)"""
+    spooled = tempfile.TemporaryFile()
+    await anyio.to_thread.run_sync(shutil.copyfileobj, file.file, spooled)
+    spooled.seek(0)
+    await file.close()
+    return UploadFile(file=spooled, filename=file.filename)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_payment_job(
+        request: Request,
+        file: UploadFile = File(...),
+        term: str = Form(...),
+        aggregate: bool = Form(False)
+):
+    """
+    Import bulk payments from a CSV file in the background.
+
+    Returns the job id right away. The import goes on when the client disconnects, its
+    status is served by GET /jobs/{job_id} and its events by GET /jobs/{job_id}/events.
+    """
+    organization_id = request.headers.get('organizationid')
+    if not organization_id:
+        raise HTTPException(status_code=400, detail="Missing organizationid header")
+    auth_token = request.headers.get('authorization')
+    upload = await spool_upload(file)
+
+    def run(job_id, on_result):
+        # The results are served by GET /jobs/{job_id}/results, the report by the job id
+        return import_payments(upload, term, organization_id, auth_token, aggregate=aggregate,
+                               on_result=on_result, import_id=job_id, stream_results=False)
+
+    job = await job_manager.submit(organization_id, term, run, filename=file.filename, aggregate=aggregate)
+    return public_job(job)
+
+
+async def get_job_or_404(job_id: str, organization_id: Optional[str]) -> dict:
+    if not organization_id:
+        raise HTTPException(status_code=400, detail="Missing organizationid header")
+    job = await job_manager.get(job_id, organization_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Import job {job_id} not found")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_payment_job(job_id: str, organizationid: Optional[str] = Header(None)):
+    """Status and progress of an import job"""
+    return public_job(await get_job_or_404(job_id, organizationid))
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_payment_job_events(
+        job_id: str,
+        offset: int = Query(0, ge=0),
+        organizationid: Optional[str] = Header(None),
+        last_event_id: Optional[str] = Header(None)
+):
+    """
+    Stream the events of an import job as server-sent events, from the given offset.
+
+    Every event carries its sequence number as id: a client reconnecting with the
+    Last-Event-ID header (or ?offset=<last id + 1>) resumes right after the last event it got.
+    """
+    await get_job_or_404(job_id, organizationid)
+    if last_event_id is not None and last_event_id.strip().isdigit():
+        offset = max(offset, int(last_event_id) + 1)
+
+    async def job_events_generator():
+        async for seq, event in job_manager.stream(job_id, organizationid, offset):
+            yield sse_event(event, seq)
+
+    return StreamingResponse(
+        job_events_generator(),
+        media_type="text/event-stream"
+    )
+
+
+@app.get("/jobs/{job_id}/results")
+async def get_payment_job_results(
+        job_id: str,
+        skip: int = Query(0, ge=0),
+        limit: int = Query(1000, ge=1, le=10000),
+        organizationid: Optional[str] = Header(None)
+):
+    """Per-row results of an import job, by row number"""
+    await get_job_or_404(job_id, organizationid)
+    return {"results": await job_manager.results(job_id, skip, limit)}
+
+
+@app.get("/imports/{import_id}/report")
+async def get_import_report(
+        import_id: str,
+        format: str = Query('ndjson', pattern='^(ndjson|csv)$'),
+        organizationid: Optional[str] = Header(None)
+):
+    """
+    Per-row results of a finished import, as NDJSON (one JSON object per row) or CSV.
+
+    The import id is sent in the first and the last event of the import.
+    """
+    try:
+        meta = await read_report_meta(import_id)
+    except PyMongoError as e:
+        logger.error(f"Could not read the report of import {import_id}: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"Could not read the report: {str(e)}")
+    if meta is None or meta.get('organizationId') != organizationid:
+        raise HTTPException(status_code=404, detail=f"Report of import {import_id} not found")
+    if format == 'csv':
+        return StreamingResponse(
+            iter_report_csv(import_id),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="import-{import_id}.csv"'}
+        )
+    return StreamingResponse(
+        iter_report_ndjson(import_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="import-{import_id}.ndjson"'}
+    )
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the application is running (the dependencies are checked by /readyz)"""
+    return {"status": "ok", "warmedUp": readiness.warmed_up, "uptime": round(readiness.uptime(), 1)}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: 200 once the warm-up is done and MongoDB, the gateway and Redis (work queue)
+    are reachable, else 503. The report tells the latency or the error of each dependency.
+    """
+    ready, report = await readiness.status()
+    return JSONResponse(report, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    body, content_type = render_metrics()
+    return Response(content=body, headers={'Content-Type': content_type})
+
+
+@app.delete("/tenant-cache")
+async def invalidate_tenant_cache(request: Request, reference: Optional[str] = None):
+    """
+    Drop cached tenant lookups of the calling organization (or a single tenant reference),
+    e.g. after tenants were created or renumbered.
+    """
+    organization_id = request.headers.get('organizationid')
+    if not organization_id:
+        raise HTTPException(status_code=400, detail="Missing organizationid header")
+    if reference is not None:
+        reference = await pad_tenant_id(reference)
+    removed = tenant_resolver.invalidate(organization_id, reference)
+    removed += direct_tenant_resolver.invalidate(organization_id, reference)
+    return {"removed": removed}
+
+
+class PendingReplayRequest(BaseModel):
+    term: str
+    created_from: Optional[datetime] = None  # dateCreated range of the pending payments
+    created_to: Optional[datetime] = None
+    tenant_id: Optional[str] = None
+    narration: Optional[str] = None  # Case-insensitive substring of the narration
+    limit: Optional[int] = None
+    include_legacy: bool = False  # Also replay the documents logged without organization and term
+
+
+async def replay_pending_payments(replay: 'PendingReplay') -> AsyncIterator[dict]:
+    """Replay pending payments and yield the progress events"""
+    try:
+        total = await replay.count()
+        logger.info(f"Replaying {total} pending payments for term {replay.term} (replay {replay.replay_id})")
+        yield dict(status='processing', progress=0, total=total, replayId=replay.replay_id,
+                   message=f'Replaying {total} pending payments...')
+        update_interval = max(1, total // 10)  # Send updates every 10% progress
+        processed = 0
+        async for _, success, narration in replay.run():
+            processed += 1
+            if processed % update_interval == 0:
+                progress = min(100, int((processed / max(total, 1)) * 100))
+                yield dict(status='processing', progress=progress,
+                           message=f'Replaying pending payments... {progress}% ({processed}/{total})')
+        counts = replay.counts
+        logger.info(
+            "Replay %s complete: %d resolved, %d still pending", replay.replay_id, counts['resolved'], counts['pending']
+        )
+        yield dict(status='complete', progress=100, replayId=replay.replay_id, total=processed, **counts,
+                   message=f"Replay complete. {counts['resolved']}/{processed} pending payments resolved.")
+    except Exception as e:
+        error_msg = f"Error replaying pending payments: {str(e)}"
+        logger.error(error_msg)
+        yield dict(status='error', message=error_msg, error=str(e))
+
+
+@app.post("/pending-payments/replay")
+async def replay_pending(request: Request, body: PendingReplayRequest):
+    """
+    Replay the pending payments of the calling organization matching the filter, as a stream
+    of server-sent events. Each payment is marked resolved or left pending with the new failure.
+    """
+    from replay import PendingReplay, ReplayFilter
+
+    organization_id = request.headers.get('organizationid')
+    if not organization_id:
+        raise HTTPException(status_code=400, detail="Missing organizationid header")
+    auth_token = request.headers.get('authorization')
+
+    async def replay_payment(record: dict, term: str):
+        result = await process_single_payment(Payment.model_construct(**record), term, organization_id, auth_token)
+        return result.success, result.message
+
+    selection = ReplayFilter(created_from=body.created_from, created_to=body.created_to,
+                             tenant_id=body.tenant_id, narration=body.narration, limit=body.limit,
+                             include_legacy=body.include_legacy)
+    replay = PendingReplay(organization_id, body.term, selection, replay_payment,
+                           build_gateway_headers(organization_id, auth_token))
+
+    async def replay_generator():
+        async for event in replay_pending_payments(replay):
+            yield sse_event(event)
+
+    return StreamingResponse(replay_generator(), media_type="text/event-stream")
+
+
+@app.post("/reconcile")
+async def reconcile_statement(
+        request: Request,
+        file: UploadFile = File(...),
+        term: str = Form(...),
+):
+    """
+    Reconcile a bank statement (a CSV file in the format of /process-payments) with the payments
+    recorded for the term: matched, amount_mismatch, unmatched and invalid lines, and the recorded
+    payments missing from the statement (see reconcile). Nothing is written.
+    """
+    from ingest import iter_csv_chunks
+    from reconcile import Reconciliation
+
+    organization_id = request.headers.get('organizationid')
+    if not organization_id:
+        raise HTTPException(status_code=400, detail="Missing organizationid header")
+    try:
+        rent_term(term)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid term {term}, expected YYYY.MM")
+
+    try:
+        chunks = iter_csv_chunks(file)
+        try:
+            first_chunk = await anext(chunks, None)
+            if first_chunk is not None and not REQUIRED_COLUMNS.issubset(first_chunk.columns):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"CSV file is missing required columns: {REQUIRED_COLUMNS - set(first_chunk.columns)}"
+                )
+
+            reconciliation = Reconciliation(organization_id, term)
+            try:
+                await reconciliation.load()
+            except PyMongoError as e:
+                logger.error(f"Could not load the recorded payments of term {term}: {str(e)}")
+                raise HTTPException(status_code=503, detail=f"Could not load the recorded payments: {str(e)}")
+
+            async def file_chunks():
+                if first_chunk is not None:
+                    yield first_chunk
+                async for df in chunks:
+                    yield df
+
+            lines = await reconciliation.run(file_chunks())
+        finally:
+            await chunks.aclose()
+    finally:
+        await file.close()
+
+    report = reconciliation.report()
+    logger.info(f"Reconciled {lines} statement lines for term {term}: {report['counts']}")
+    # Plain JSON values only, serialized without FastAPI's encoder (statements have up to hundreds of thousands of lines)
+    return JSONResponse(dict(lines=lines, **report))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,177 @@
+"""
+Prometheus metrics of the payment processor service, served by GET /metrics.
+
+- paymentprocessor_stage_duration_seconds{stage}: duration of the stages of a row
+  (tenant_lookup, payments_fetch, payment_patch, date_parsing), of the chunk-wide
+  stages (normalization, tenant_bulk_lookup) and of the rent recomputes (rent_recompute).
+- paymentprocessor_mongo_duration_seconds{operation}: duration of the MongoDB calls.
+- paymentprocessor_rows_total{outcome}: rows of the imports by outcome (success, failed,
+  invalid, duplicate, skipped).
+- paymentprocessor_pending_replayed_total{outcome}: replayed pending payments by outcome
+  (resolved, pending).
+- paymentprocessor_imports_in_progress: imports currently running.
+- paymentprocessor_gateway_connections{state}: connections of the gateway client pool.
+- paymentprocessor_gateway_retries_total{reason}: retried gateway calls by failure (status
+  code or transport error).
+- paymentprocessor_gateway_breaker_state: gateway circuit breaker, 0 closed, 1 half-open, 2 open.
+- paymentprocessor_gateway_flow_limit, paymentprocessor_gateway_flow_in_flight and
+  paymentprocessor_gateway_flow_waiting: gateway calls allowed in flight by the flow control,
+  in flight and waiting for a slot.
+- paymentprocessor_mongo_connections{state}: connections of the MongoDB client pool.
+- paymentprocessor_work_queue_tasks_total{outcome}: work queue tasks consumed by this replica
+  (processed, failed).
+- paymentprocessor_work_queue_partitions_owned: work queue partitions consumed by this replica.
+- paymentprocessor_ready: 1 when the replica was warmed up and its dependencies reachable at the
+  last /readyz check, else 0.
+"""
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pymongo import monitoring
+
+import http_client
+
+# Gateway calls take tens to hundreds of milliseconds, a slow gateway several seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_DURATION = Histogram(
+    'paymentprocessor_stage_duration_seconds',
+    'Duration of the stages of a payment import',
+    ['stage'],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_DURATION = Histogram(
+    'paymentprocessor_mongo_duration_seconds',
+    'Duration of the MongoDB calls',
+    ['operation'],
+    buckets=LATENCY_BUCKETS,
+)
+ROWS = Counter(
+    'paymentprocessor_rows',
+    'Rows of the imported files by outcome',
+    ['outcome'],
+)
+PENDING_REPLAYED = Counter(
+    'paymentprocessor_pending_replayed',
+    'Replayed pending payments by outcome',
+    ['outcome'],
+)
+IMPORTS_IN_PROGRESS = Gauge(
+    'paymentprocessor_imports_in_progress',
+    'Imports currently running',
+)
+GATEWAY_CONNECTIONS = Gauge(
+    'paymentprocessor_gateway_connections',
+    'Connections of the gateway HTTP client pool',
+    ['state'],
+)
+GATEWAY_RETRIES = Counter(
+    'paymentprocessor_gateway_retries',
+    'Retried gateway calls by failure',
+    ['reason'],
+)
+GATEWAY_BREAKER_STATE = Gauge(
+    'paymentprocessor_gateway_breaker_state',
+    'State of the gateway circuit breaker (0 closed, 1 half-open, 2 open)',
+)
+GATEWAY_FLOW_LIMIT = Gauge(
+    'paymentprocessor_gateway_flow_limit',
+    'Gateway calls allowed in flight by the flow control',
+)
+GATEWAY_FLOW_IN_FLIGHT = Gauge(
+    'paymentprocessor_gateway_flow_in_flight',
+    'Gateway calls in flight',
+)
+GATEWAY_FLOW_WAITING = Gauge(
+    'paymentprocessor_gateway_flow_waiting',
+    'Gateway calls waiting for a flow control slot',
+)
+MONGO_CONNECTIONS = Gauge(
+    'paymentprocessor_mongo_connections',
+    'Connections of the MongoDB client pool',
+    ['state'],
+)
+WORK_QUEUE_TASKS = Counter(
+    'paymentprocessor_work_queue_tasks',
+    'Work queue tasks consumed by this replica by outcome',
+    ['outcome'],
+)
+WORK_QUEUE_PARTITIONS_OWNED = Gauge(
+    'paymentprocessor_work_queue_partitions_owned',
+    'Work queue partitions consumed by this replica',
+)
+READY = Gauge(
+    'paymentprocessor_ready',
+    'Whether this replica is warmed up and its dependencies are reachable (1) or not (0)',
+)
+
+
+def observe_stage(stage: str):
+    """Context manager timing a stage: with observe_stage('payment_patch'): ..."""
+    return STAGE_DURATION.labels(stage).time()
+
+
+def observe_mongo(operation: str):
+    """Context manager timing a MongoDB call: with observe_mongo('find_existing_references'): ..."""
+    return MONGO_DURATION.labels(operation).time()
+
+
+def count_rows(outcome: str, amount: int = 1) -> None:
+    ROWS.labels(outcome).inc(amount)
+
+
+def _gateway_connections(state: str) -> int:
+    """Connections of the shared gateway client, read when the metrics are scraped"""
+    # httpx keeps its httpcore pool on the default transport; nothing to report before the client exists
+    client = http_client._client
+    pool = getattr(getattr(client, '_transport', None), '_pool', None)
+    connections = getattr(pool, 'connections', None) or []
+    if state == 'idle':
+        return sum(1 for connection in connections if connection.is_idle())
+    if state == 'active':
+        return sum(1 for connection in connections if not connection.is_idle())
+    return len(connections)
+
+
+for _state in ('active', 'idle'):
+    GATEWAY_CONNECTIONS.labels(_state).set_function(lambda state=_state: _gateway_connections(state))
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Track the open and checked out connections of the MongoDB pools"""
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_CONNECTIONS.labels('open').inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_CONNECTIONS.labels('open').dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        MONGO_CONNECTIONS.labels('checked_out').inc()
+
+    def connection_checked_in(self, event):
+        MONGO_CONNECTIONS.labels('checked_out').dec()
+
+
+def render_metrics():
+    """Return the body and the content type of the metrics exposition"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,133 @@
+"""
+Column-wise preparation of uploaded payment rows.
+
+Each chunk of CSV rows is normalized on whole columns before any network or
+database call: tenant ids are zero-padded, dates normalized (see dates.DateParser), amounts and
+the promo/extra charge columns coerced to numbers, text trimmed and defaults
+filled. Rows that cannot be normalized are rejected in the same pass with the
+list of their problems, so only clean rows are processed.
+"""
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+from dates import AmbiguousDateError, DateParser
+
+# Columns kept as text (trimmed, empty when missing)
+TEXT_COLUMNS = (
+    'tenant_id', 'payment_date', 'payment_type', 'payment_reference', 'amount',
+    'description', 'promo_amount', 'promo_note', 'extra_charge', 'extra_charge_note',
+)
+
+# Payment type used when the column is empty
+DEFAULT_PAYMENT_TYPE = 'cash'
+
+# Numbers with thousands separators, the only commas accepted in amounts
+THOUSANDS_NUMBER = r'[-+]?\d{1,3}(?:,\d{3})+(?:\.\d+)?'
+
+# Tenant ids are whole numbers under this bound (well within int64, no overflow on the cast)
+MAX_TENANT_ID = 10 ** 15
+
+@dataclass
+class PreparedChunk:
+    """
+    Result of the preparation of a chunk of rows.
+
+    payments: one row per valid input row, with the Payment fields plus the padded
+        tenant_reference, indexed like the input chunk.
+    invalid: one row per rejected input row with its trimmed raw values and an
+        'error' column describing every problem found, indexed like the input chunk.
+    """
+    payments: pd.DataFrame
+    invalid: pd.DataFrame
+
+
+def _text(df: pd.DataFrame, column: str) -> pd.Series:
+    """The column as trimmed strings ('' for missing values or a missing column)"""
+    if column not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    return df[column].fillna('').astype(str).str.strip()
+
+
+def _number(text: pd.Series) -> pd.Series:
+    """
+    Coerce a text column to float, NaN where the value is not a finite number. Commas are only
+    read as thousands separators ('1,500.50'), a decimal comma ('1,5') is not a number.
+    """
+    thousands = text.str.fullmatch(THOUSANDS_NUMBER)
+    numbers = pd.to_numeric(text.mask(thousands, text.str.replace(',', '', regex=False)), errors='coerce')
+    return numbers.where(np.isfinite(numbers))
+
+
+def pad_tenant_ids(text: pd.Series) -> pd.Series:
+    """
+    Zero-pad tenant ids to six digits, like pad_tenant_id. NaN where the id is not a whole
+    number between 0 and MAX_TENANT_ID (e.g. '1e30' or '12.5'), so the row is rejected.
+    """
+    numbers = pd.to_numeric(text, errors='coerce')
+    valid = (numbers >= 0) & (numbers < MAX_TENANT_ID) & (numbers == numbers.round())
+    padded = pd.Series(np.nan, index=text.index, dtype=object)
+    padded[valid] = numbers[valid].astype('int64').astype(str).str.zfill(6)
+    return padded
+
+
+def prepare_payments(df: pd.DataFrame, date_parser: Optional[DateParser] = None) -> PreparedChunk:
+    """
+    Normalize and validate a chunk of CSV rows, see PreparedChunk.
+
+    Dates are parsed with date_parser, pass the parser of the file so its detected
+    format and memoized dates are reused across chunks.
+    """
+    if date_parser is None:
+        date_parser = DateParser()
+        date_parser.detect(_text(df, 'payment_date'))
+    text = {column: _text(df, column) for column in TEXT_COLUMNS}
+    errors = pd.Series('', index=df.index, dtype=object)
+
+    def reject(mask: pd.Series, message: pd.Series) -> None:
+        nonlocal errors
+        errors = errors.mask(mask, errors + message + '; ')
+
+    tenant_reference = pad_tenant_ids(text['tenant_id'])
+    reject(tenant_reference.isna(), "invalid tenant_id '" + text['tenant_id'] + "'")
+
+    payment_date, date_errors = date_parser.parse_series(text['payment_date'])
+    ambiguous = date_errors.map(lambda error: isinstance(error, AmbiguousDateError)).astype(bool)
+    reject(payment_date.isna() & ~ambiguous, "invalid payment_date '" + text['payment_date'] + "'")
+    reject(ambiguous, "ambiguous payment_date '" + text['payment_date'] + "' (day and month could be swapped)")
+
+    amount = _number(text['amount'])
+    # Any sign is accepted, like the float() of the row loop did (e.g. refunds and corrections)
+    reject(amount.isna(), "invalid amount '" + text['amount'] + "'")
+
+    optional_amounts = {}
+    for column in ('promo_amount', 'extra_charge'):
+        values = _number(text[column])
+        reject(values.isna() & (text[column] != ''), f"invalid {column} '" + text[column] + "'")
+        optional_amounts[column] = values.fillna(0.0)
+
+    payment_type = text['payment_type'].str.lower().replace('', DEFAULT_PAYMENT_TYPE)
+
+    valid = errors == ''
+    payments = pd.DataFrame({
+        'tenant_id': text['tenant_id'],
+        'tenant_reference': tenant_reference,
+        'payment_date': payment_date,
+        'payment_type': payment_type,
+        'reference': text['payment_reference'],
+        'amount': amount,
+        'description': text['description'],
+        'promo_amount': optional_amounts['promo_amount'],
+        'promo_note': text['promo_note'],
+        'extra_charge': optional_amounts['extra_charge'],
+        'extra_charge_note': text['extra_charge_note'],
+    }, index=df.index)[valid]
+
+    invalid = pd.DataFrame({
+        column: text[column] for column in ('tenant_id', 'payment_date', 'payment_type', 'payment_reference', 'amount')
+    }, index=df.index)[~valid]
+    invalid['error'] = errors[~valid].str.rstrip('; ')
+
+    return PreparedChunk(payments=payments, invalid=invalid)
+
@@ -0,0 +1,56 @@
+"""
+Buffered bulk writer for the pendingPayments collection.
+
+During an import, failed rows are not inserted one by one: their documents are
+buffered and written with insert_many(ordered=False) when the buffer is full or
+when the flush interval elapses, and whatever is left is flushed when the import
+ends (including when the client disconnects). Write failures are kept so the
+import can report them in its event stream.
+
+The writer of the running import is published through a context variable, so
+log_pending_payment can use it without threading it through every call.
+"""
+from contextvars import ContextVar
+from typing import Optional
+
+from bulk_writer import BulkWriter
+from config import PENDING_PAYMENTS_BATCH_SIZE, PENDING_PAYMENTS_FLUSH_INTERVAL
+from database import PENDING_PAYMENTS_COLLECTION
+
+# Status of a pendingPayments document (documents logged before the replay existed have none: pending)
+PENDING_STATUS = 'pending'
+RESOLVED_STATUS = 'resolved'
+
+_current_writer: ContextVar[Optional["PendingPaymentWriter"]] = ContextVar('pending_payment_writer', default=None)
+
+
+def get_pending_writer() -> Optional["PendingPaymentWriter"]:
+    """Return the writer of the import running in the current context, if any"""
+    return _current_writer.get()
+
+
+def set_pending_writer(writer: Optional["PendingPaymentWriter"]) -> None:
+    """Make the writer the one used by log_pending_payment in the current context (None to stop using it)"""
+    _current_writer.set(writer)
+
+
+class PendingPaymentWriter(BulkWriter):
+    """
+    Buffer pendingPayments documents and write them in batches.
+
+    Args:
+        batch_size (int): Flush as soon as the buffer holds this many documents.
+        flush_interval (float): Flush buffered documents at least this often (seconds).
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+        context (dict): Fields added to every document (organization, term and import of the rows),
+            the replay of the pending payments uses them.
+    """
+
+    def __init__(self, batch_size: int = PENDING_PAYMENTS_BATCH_SIZE,
+                 flush_interval: float = PENDING_PAYMENTS_FLUSH_INTERVAL, db_name: Optional[str] = None,
+                 context: Optional[dict] = None):
+        super().__init__(PENDING_PAYMENTS_COLLECTION, batch_size, flush_interval, db_name, label='pending payments')
+        self.context = context or {}
+
+    async def add(self, document: dict) -> None:
+        await super().add(dict(document, **self.context))
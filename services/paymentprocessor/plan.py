@@ -0,0 +1,145 @@
+"""
+Dry run (plan) of an import.
+
+A dry run goes through the read-only steps of an import: column-wise normalization,
+duplicate detection (against the recorded references and within the file) and batched
+tenant resolution. It then tells what the import would do with every row, without
+posting anything: no rent update, no pendingPayments document, no checkpoint or lease.
+
+Actions:
+- post: the payment would be posted to the resolved tenant
+- duplicate: the reference is already recorded, or repeated earlier in the file
+- unknown_tenant: the organization has no tenant with the reference
+- invalid: the row was rejected by the normalization
+- skip: the row was posted by a previous run of the same file (see checkpoints)
+- unresolved: the tenant lookup failed, the import would retry it
+"""
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, Optional, Set
+
+import pandas as pd
+
+from dates import DateParser
+from duplicates import DuplicateChecker
+from metrics import observe_stage
+from normalize import prepare_payments
+from tenants import TenantResolver, tenant_resolver
+
+logger = logging.getLogger(__name__)
+
+PLAN_POST = 'post'
+PLAN_DUPLICATE = 'duplicate'
+PLAN_UNKNOWN_TENANT = 'unknown_tenant'
+PLAN_INVALID = 'invalid'
+PLAN_SKIP = 'skip'
+PLAN_UNRESOLVED = 'unresolved'
+PLAN_ACTIONS = (PLAN_POST, PLAN_DUPLICATE, PLAN_UNKNOWN_TENANT, PLAN_INVALID, PLAN_SKIP, PLAN_UNRESOLVED)
+
+
+@dataclass
+class PlannedRow:
+    """What the import would do with a row"""
+    row: int
+    action: str
+    tenant_id: str  # As in the file
+    reference: str
+    message: str
+    tenant: Optional[str] = None  # Resolved tenant id, for the rows to post
+    amount: Optional[float] = None
+
+
+class ImportPlanner:
+    """
+    Plan the import of a file, with read-only calls only.
+
+    Args:
+        organization_id (str): Organization importing the file.
+        term (str): Term the payments would be posted to.
+        headers (dict): Gateway headers, for the tenant resolution.
+        resolver (TenantResolver): Tenant resolver of the payment backend.
+        committed (Set[int]): Rows posted by a previous run of the same file.
+    """
+
+    def __init__(self, organization_id: Optional[str], term: str, headers: dict,
+                 resolver: TenantResolver = tenant_resolver, committed: Iterable[int] = ()):
+        self.organization_id = organization_id
+        self.term = term
+        self.headers = headers
+        self.resolver = resolver
+        self.committed: Set[int] = set(committed)
+        self.counts = {action: 0 for action in PLAN_ACTIONS}
+        # Total amount of the payments that would be posted
+        self.amount = 0.0
+        self._duplicates = DuplicateChecker()
+
+    async def _resolve(self, references: Set[str]) -> Dict[str, object]:
+        """Tenant record (or None) of each reference, the exception of the lookup when it failed"""
+        try:
+            with observe_stage('tenant_bulk_lookup'):
+                return await self.resolver.resolve_many(self.organization_id, references, self.headers)
+        except Exception as e:
+            logger.warning(f"Bulk tenant resolution failed, falling back to per-row lookups: {str(e)}")
+        resolved: Dict[str, object] = {}
+        failure: Optional[Exception] = None
+        for reference in references:
+            if failure is not None:
+                # The gateway is failing, the rest is not looked up one by one
+                resolved[reference] = failure
+                continue
+            try:
+                resolved[reference] = await self.resolver.resolve(self.organization_id, reference, self.headers)
+            except Exception as e:
+                resolved[reference] = failure = e
+        return resolved
+
+    async def plan(self, chunks: AsyncIterable[pd.DataFrame]) -> AsyncIterator[PlannedRow]:
+        """Plan the rows of the chunks of a file, yields one PlannedRow per row in file order"""
+        date_parser: Optional[DateParser] = None
+        async for df in chunks:
+            if date_parser is None:
+                # The date format of the file is detected on its first rows, like the import does
+                date_parser = DateParser()
+                date_parser.detect(df['payment_date'])
+            skipped = [index for index in df.index if index + 1 in self.committed]
+            with observe_stage('normalization'):
+                prepared = prepare_payments(df.drop(index=skipped), date_parser)
+            await self._duplicates.load(prepared.payments['reference'])
+            tenants = await self._resolve(set(prepared.payments['tenant_reference']))
+
+            payments = prepared.payments.to_dict('index')
+            invalid = prepared.invalid.to_dict('index')
+            for index in df.index:
+                planned = self._plan_row(index, df, payments, invalid, tenants)
+                self.counts[planned.action] += 1
+                if planned.action == PLAN_POST:
+                    self.amount += planned.amount
+                yield planned
+
+    def _plan_row(self, index: int, df: pd.DataFrame, payments: dict, invalid: dict,
+                  tenants: Dict[str, object]) -> PlannedRow:
+        row = index + 1
+        if row in self.committed:
+            return PlannedRow(row, PLAN_SKIP, str(df.at[index, 'tenant_id']), str(df.at[index, 'payment_reference']),
+                              "Already processed by a previous run of this file")
+        record = payments.get(index)
+        if record is None:
+            raw = invalid[index]
+            return PlannedRow(row, PLAN_INVALID, raw['tenant_id'], raw['payment_reference'],
+                              f"Invalid row {row}: {raw['error']}")
+
+        tenant_id, reference, amount = record['tenant_id'], record['reference'], float(record['amount'])
+        # Checked in file order, the first occurrence of a reference is the one posted
+        duplicate = self._duplicates.check(reference, row)
+        if duplicate:
+            return PlannedRow(row, PLAN_DUPLICATE, tenant_id, reference, duplicate, amount=amount)
+
+        tenant_reference = record['tenant_reference']
+        tenant = tenants.get(tenant_reference)
+        if isinstance(tenant, Exception):
+            return PlannedRow(row, PLAN_UNRESOLVED, tenant_id, reference, str(tenant), amount=amount)
+        if tenant is None:
+            return PlannedRow(row, PLAN_UNKNOWN_TENANT, tenant_id, reference,
+                              f"No tenant found with reference {tenant_reference}", amount=amount)
+        return PlannedRow(row, PLAN_POST, tenant_id, reference,
+                          f"Would post payment of {amount:g} for tenant {tenant.id}", tenant=tenant.id, amount=amount)
@@ -0,0 +1,218 @@
+"""
+Reconciliation of a bank statement against the payments already recorded.
+
+The statement is a CSV file in the format of the imports. The payments recorded for the
+term are loaded with one cursor pass over the occupants of the organization (the rent of
+the term only) and indexed in memory by payment reference, by tenant reference and by
+tenant, amount and date. The statement is then read chunk by chunk and every line is
+classified with lookups in those indexes, without any per-row query:
+
+- matched: a recorded payment has the reference of the line (or, for a line whose reference
+  is not recorded, the same tenant, amount and date), for the same tenant and amount
+- amount_mismatch: the reference is recorded for the tenant with another amount
+- unmatched: no recorded payment corresponds to the line (unknown tenant, reference recorded
+  for another tenant or already matched by an earlier line, or nothing recorded)
+- invalid: the line was rejected by the normalization
+- missing: recorded payments of the term that no line of the statement matched
+
+A recorded payment is matched by one line at most.
+"""
+import logging
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import AsyncIterable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from database import OCCUPANTS_COLLECTION, get_database
+from dates import DateParser, OUTPUT_FORMAT, payment_date_parser
+from direct import rent_term
+from duplicates import is_blank_reference
+from metrics import observe_mongo, observe_stage
+from normalize import prepare_payments
+
+logger = logging.getLogger(__name__)
+
+MATCHED = 'matched'
+AMOUNT_MISMATCH = 'amount_mismatch'
+UNMATCHED = 'unmatched'
+INVALID = 'invalid'
+MISSING = 'missing'
+RECONCILE_SETS = (MATCHED, AMOUNT_MISMATCH, UNMATCHED, INVALID, MISSING)
+
+
+def amount_cents(amount) -> int:
+    """Amounts are compared in cents, float sums of the rents API included"""
+    return round(float(amount) * 100)
+
+
+def recorded_date(value) -> Optional[str]:
+    """Date of a recorded payment as DD/MM/YYYY (None when it cannot be read)"""
+    if isinstance(value, datetime):
+        return value.strftime(OUTPUT_FORMAT)
+    if value is None or value == '':
+        return None
+    try:
+        return payment_date_parser.parse(str(value))
+    except ValueError:
+        return None
+
+
+@dataclass
+class RecordedPayment:
+    """A payment of the rent of the term, as recorded"""
+    tenant: str  # Tenant id
+    tenant_reference: str
+    reference: str
+    amount: float
+    date: Optional[str]
+    type: str
+    matched_row: Optional[int] = None  # Statement line that matched it
+
+
+class Reconciliation:
+    """
+    Reconcile a bank statement with the payments recorded for a term.
+
+    Args:
+        organization_id (str): Organization of the tenants.
+        term (str): Term of the rents, as YYYY.MM.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+    """
+
+    def __init__(self, organization_id: str, term: str, db_name: Optional[str] = None):
+        self.organization_id = organization_id
+        self.term = term
+        self.db_name = db_name
+        self.payments: List[RecordedPayment] = []
+        self.tenants: Dict[str, str] = {}  # Tenant reference -> tenant id
+        self.tenants_with_rent = 0
+        self._by_reference: Dict[str, List[RecordedPayment]] = {}
+        self._by_amount_date: Dict[Tuple[str, int, Optional[str]], List[RecordedPayment]] = {}
+        self.results: Dict[str, List[dict]] = {name: [] for name in RECONCILE_SETS if name != MISSING}
+        self.amount = {name: 0.0 for name in RECONCILE_SETS}
+
+    async def load(self) -> int:
+        """Load and index the tenants and the recorded payments of the term, returns the number of payments"""
+        term = rent_term(self.term)
+        cursor = get_database(self.db_name)[OCCUPANTS_COLLECTION].find(
+            {'realmId': self.organization_id},
+            projection={'_id': 1, 'reference': 1, 'rents': {'$elemMatch': {'term': term}}},
+        )
+        with observe_mongo('reconcile_load'):
+            async for occupant in cursor:
+                tenant_reference = str(occupant.get('reference') or '').strip()
+                tenant = str(occupant['_id'])
+                if tenant_reference:
+                    self.tenants[tenant_reference] = tenant
+                rents = occupant.get('rents') or []
+                if not rents:
+                    continue
+                self.tenants_with_rent += 1
+                for entry in rents[0].get('payments') or []:
+                    self._add(RecordedPayment(
+                        tenant=tenant,
+                        tenant_reference=tenant_reference,
+                        reference=str(entry.get('reference') or '').strip(),
+                        amount=float(entry.get('amount') or 0),
+                        date=recorded_date(entry.get('date')),
+                        type=entry.get('type') or '',
+                    ))
+        logger.info(f"Loaded {len(self.payments)} recorded payments of {self.tenants_with_rent} rents for term {self.term}")
+        return len(self.payments)
+
+    def _add(self, payment: RecordedPayment) -> None:
+        self.payments.append(payment)
+        if not is_blank_reference(payment.reference):
+            self._by_reference.setdefault(payment.reference, []).append(payment)
+        key = (payment.tenant_reference, amount_cents(payment.amount), payment.date)
+        self._by_amount_date.setdefault(key, []).append(payment)
+
+    async def run(self, chunks: AsyncIterable[pd.DataFrame]) -> int:
+        """Classify the lines of the chunks of a statement, returns the number of lines"""
+        date_parser: Optional[DateParser] = None
+        lines = 0
+        async for df in chunks:
+            if date_parser is None:
+                # The date format of the file is detected on its first rows, like the import does
+                date_parser = DateParser()
+                date_parser.detect(df['payment_date'])
+            with observe_stage('normalization'):
+                prepared = prepare_payments(df, date_parser)
+            # Column-wise: building a dict per line costs more than the whole classification.
+            # Valid lines are classified in file order, a recorded payment goes to its first line.
+            payments, invalid = prepared.payments, prepared.invalid
+            for line in zip((payments.index + 1).tolist(), payments['tenant_id'].tolist(),
+                            payments['tenant_reference'].tolist(), payments['reference'].tolist(),
+                            payments['amount'].tolist(), payments['payment_date'].tolist()):
+                self._classify(*line)
+            for row, tenant_id, reference, error in zip((invalid.index + 1).tolist(), invalid['tenant_id'].tolist(),
+                                                        invalid['payment_reference'].tolist(), invalid['error'].tolist()):
+                self._append(INVALID, dict(row=row, tenant_id=tenant_id, reference=reference, message=error))
+            lines += len(df.index)
+        return lines
+
+    def _append(self, name: str, entry: dict, amount: float = 0.0) -> None:
+        self.results[name].append(entry)
+        self.amount[name] += amount
+
+    def _classify(self, row: int, tenant_id: str, tenant_reference: str, reference: str, amount: float,
+                  date: str) -> None:
+        entry = dict(row=row, tenant_id=tenant_id, reference=reference, amount=amount, date=date)
+        tenant = self.tenants.get(tenant_reference)
+        if tenant is None:
+            self._append(UNMATCHED, dict(entry, message=f"No tenant found with reference {tenant_reference}"), amount)
+            return
+
+        if not is_blank_reference(reference) and reference in self._by_reference:
+            candidates = self._by_reference[reference]
+            recorded = next((payment for payment in candidates
+                             if payment.matched_row is None and payment.tenant_reference == tenant_reference), None)
+            if recorded is None:
+                other = candidates[0]
+                if other.tenant_reference != tenant_reference:
+                    message = f"Reference {reference} is recorded for tenant {other.tenant_reference}"
+                else:
+                    message = f"Reference {reference} was already matched by row {other.matched_row}"
+                self._append(UNMATCHED, dict(entry, tenant=tenant, message=message), amount)
+                return
+            recorded.matched_row = row
+            if amount_cents(recorded.amount) == amount_cents(amount):
+                self._append(MATCHED, dict(entry, tenant=tenant, matchedBy='reference', recordedDate=recorded.date),
+                             amount)
+            else:
+                self._append(AMOUNT_MISMATCH, dict(entry, tenant=tenant, recordedAmount=recorded.amount,
+                                                   recordedDate=recorded.date), amount)
+            return
+
+        # Recorded without the reference of the statement (e.g. entered by hand): same tenant, amount and date
+        candidates = self._by_amount_date.get((tenant_reference, amount_cents(amount), date), ())
+        recorded = next((payment for payment in candidates if payment.matched_row is None), None)
+        if recorded is not None:
+            recorded.matched_row = row
+            self._append(MATCHED, dict(entry, tenant=tenant, matchedBy='amount_date',
+                                       recordedReference=recorded.reference), amount)
+            return
+        self._append(UNMATCHED, dict(entry, tenant=tenant, message="No recorded payment matches this line"), amount)
+
+    def missing(self) -> List[dict]:
+        """Recorded payments that no line of the statement matched"""
+        missing = []
+        for payment in self.payments:
+            if payment.matched_row is None:
+                entry = asdict(payment)
+                del entry['matched_row']
+                missing.append(entry)
+        return missing
+
+    def report(self) -> dict:
+        """Counts, amounts and the entries of every set"""
+        sets = dict(self.results, missing=self.missing())
+        self.amount[MISSING] = sum(payment['amount'] for payment in sets[MISSING])
+        return dict(
+            term=self.term,
+            recorded=len(self.payments),
+            counts={name: len(entries) for name, entries in sets.items()},
+            amounts={name: round(amount, 2) for name, amount in self.amount.items()},
+            **{name: sets[name] for name in RECONCILE_SETS},
+        )
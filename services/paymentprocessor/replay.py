@@ -0,0 +1,307 @@
+"""
+Replay of the pendingPayments backlog.
+
+Pending payments matching a filter (creation date range, tenant, narration) are read
+from MongoDB with a cursor, chunk by chunk, and run through the same path as the rows
+of an uploaded file: column-wise normalization, bulk duplicate check and tenant
+resolution, then concurrent processing (the payments of a tenant one after the other).
+
+Each document is then marked resolved (its payment was posted, or its reference is
+already recorded) or left pending with the new failure as narration; dateUpdated is
+updated either way. The updates are written in batches with bulk_write.
+
+A replay claims the documents of a chunk before processing them (replayId and
+replayUntil), so two replays running at the same time never post the same payment.
+A claim left by a stopped instance expires after PENDING_REPLAY_CLAIM_TTL seconds.
+
+Only the documents of the organization and term of the replay are selected. Documents
+logged before the organization and term were recorded (tenant references are reused
+across organizations) are only replayed with the include_legacy opt-in: the replay then
+tags the ones it claims with its organization and term, so no other organization can
+replay them afterwards.
+"""
+import logging
+import re
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import anyio
+import pandas as pd
+from pymongo import ASCENDING, UpdateOne
+
+from bulk_writer import BulkWriter
+from config import (
+    CSV_CHUNK_ROWS,
+    PAYMENT_CONCURRENCY,
+    PAYMENT_WINDOW,
+    PENDING_PAYMENTS_BATCH_SIZE,
+    PENDING_PAYMENTS_FLUSH_INTERVAL,
+    PENDING_REPLAY_CLAIM_TTL,
+)
+from database import PENDING_PAYMENTS_COLLECTION, get_database
+from dates import OUTPUT_FORMAT, DateParser
+from duplicates import DuplicateChecker, is_blank_reference
+from executor import OrderedExecutor
+from metrics import PENDING_REPLAYED, observe_mongo, observe_stage
+from normalize import prepare_payments
+from pending import PENDING_STATUS, RESOLVED_STATUS, PendingPaymentWriter, set_pending_writer
+from tenants import tenant_resolver
+
+logger = logging.getLogger(__name__)
+
+# Processes one normalized payment (Payment fields) for a term, returns (success, message)
+ReplayProcess = Callable[[dict, str], Awaitable[Tuple[bool, str]]]
+
+
+@dataclass
+class ReplayFilter:
+    """Selection of the pending payments to replay, every field is optional"""
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    tenant_id: Optional[str] = None
+    narration: Optional[str] = None  # Case-insensitive substring of the narration
+    limit: Optional[int] = None
+    # Also replay the documents without organization and term, as payments of this organization and term
+    include_legacy: bool = False
+
+
+@dataclass
+class ReplayItem:
+    """A pending payment scheduled for replay"""
+    document_id: object
+    tenant_reference: str
+    payment: Optional[dict] = None
+    # Outcome known without calling the gateway: (success, narration)
+    outcome: Optional[Tuple[bool, str]] = None
+
+
+def replay_query(organization_id: str, term: str, selection: ReplayFilter,
+                 now: Optional[datetime] = None) -> dict:
+    """MongoDB filter of the pending payments of a replay"""
+    query = {
+        'status': {'$ne': RESOLVED_STATUS},
+        # Not claimed by a running replay
+        'replayUntil': {'$not': {'$gt': now or datetime.utcnow()}},
+    }
+    scope = {'organizationId': organization_id, 'term': term}
+    if selection.include_legacy:
+        # Logged before the organization and term were recorded: neither field is set
+        query['$or'] = [scope, {'organizationId': None, 'term': None}]
+    else:
+        query.update(scope)
+    created = {}
+    if selection.created_from:
+        created['$gte'] = selection.created_from
+    if selection.created_to:
+        created['$lt'] = selection.created_to
+    if created:
+        query['dateCreated'] = created
+    if selection.tenant_id:
+        # Tenant ids are logged as they appeared in the file, with or without the padding
+        tenant_id = selection.tenant_id.strip()
+        query['tenantId'] = {'$in': sorted({tenant_id, tenant_id.lstrip('0') or '0', tenant_id.zfill(6)})}
+    if selection.narration:
+        query['narration'] = {'$regex': re.escape(selection.narration), '$options': 'i'}
+    return query
+
+
+class PendingStatusWriter(BulkWriter):
+    """Outcome updates of replayed pending payments, written in batches with bulk_write"""
+
+    def __init__(self, db_name: Optional[str] = None):
+        super().__init__(PENDING_PAYMENTS_COLLECTION, PENDING_PAYMENTS_BATCH_SIZE, PENDING_PAYMENTS_FLUSH_INTERVAL,
+                         db_name, label='pending payment updates')
+
+    async def _write(self, collection, documents: list) -> int:
+        with observe_mongo(f"bulk_write.{self.collection_name}"):
+            result = await collection.bulk_write(documents, ordered=False)
+        return result.matched_count
+
+    async def record(self, document_id, success: bool, narration: str) -> None:
+        now = datetime.utcnow()
+        fields = dict(status=RESOLVED_STATUS if success else PENDING_STATUS, narration=narration,
+                      dateUpdated=now, lastReplayAt=now)
+        if success:
+            fields['resolvedAt'] = now
+        await self.add(UpdateOne(
+            {'_id': document_id},
+            {'$set': fields, '$unset': {'replayId': '', 'replayUntil': ''}, '$inc': {'replayAttempts': 1}},
+        ))
+
+
+class _ReplayPendingWriter(PendingPaymentWriter):
+    """A replayed payment that fails again updates its own document instead of logging a new one"""
+
+    async def add(self, document: dict) -> None:
+        pass
+
+
+class PendingReplay:
+    """
+    Replay the pending payments of an organization for a term.
+
+    Args:
+        organization_id (str): Organization whose pending payments are replayed.
+        term (str): Term the payments are posted to (documents recording their own term must match it).
+        selection (ReplayFilter): Pending payments to replay.
+        process (ReplayProcess): Posts one payment, the processing path of the imported rows.
+        headers (dict): Gateway headers, for the bulk tenant resolution.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+    """
+
+    def __init__(self, organization_id: str, term: str, selection: ReplayFilter,
+                 process: ReplayProcess, headers: dict, db_name: Optional[str] = None,
+                 chunk_size: int = CSV_CHUNK_ROWS, claim_ttl: float = PENDING_REPLAY_CLAIM_TTL):
+        self.organization_id = organization_id
+        self.term = term
+        self.selection = selection
+        self.process = process
+        self.headers = headers
+        self.db_name = db_name
+        self.chunk_size = chunk_size
+        self.claim_ttl = claim_ttl
+        self.replay_id = uuid.uuid4().hex
+        self.started_at = datetime.utcnow()
+        self.counts = dict(resolved=0, pending=0)
+        self._duplicates = DuplicateChecker()
+        # The normalized dates of the logged payments take the fast path, raw ones fall back
+        self._date_parser = DateParser(OUTPUT_FORMAT)
+        # Document of the first pending payment of each reference in this replay
+        self._first_documents: Dict[str, object] = {}
+
+    def _collection(self):
+        return get_database(self.db_name)[PENDING_PAYMENTS_COLLECTION]
+
+    async def count(self) -> int:
+        """Number of pending payments matching the replay, for the progress"""
+        total = await self._collection().count_documents(replay_query(self.organization_id, self.term, self.selection))
+        return min(total, self.selection.limit) if self.selection.limit else total
+
+    async def _claim(self, documents: List[dict]) -> List[dict]:
+        """Claim a chunk of documents, returns the ones this replay got"""
+        now = datetime.utcnow()
+        ids = [document['_id'] for document in documents]
+        with observe_mongo('claim_pending_payments'):
+            await self._collection().update_many(
+                {
+                    '_id': {'$in': ids},
+                    'replayUntil': {'$not': {'$gt': now}},
+                    # Replayed by another replay since the cursor read them
+                    'status': {'$ne': RESOLVED_STATUS},
+                    'lastReplayAt': {'$not': {'$gte': self.started_at}},
+                },
+                {'$set': {'replayId': self.replay_id, 'replayUntil': now + timedelta(seconds=self.claim_ttl)}},
+            )
+            if self.selection.include_legacy:
+                # Legacy documents now belong to this organization and term, whatever the outcome
+                await self._collection().update_many(
+                    {'_id': {'$in': ids}, 'replayId': self.replay_id, 'organizationId': None},
+                    {'$set': {'organizationId': self.organization_id, 'term': self.term}},
+                )
+            claimed = await self._collection().find(
+                {'_id': {'$in': ids}, 'replayId': self.replay_id}, projection={'_id': 1}
+            ).to_list(length=None)
+        claimed_ids = {document['_id'] for document in claimed}
+        return [document for document in documents if document['_id'] in claimed_ids]
+
+    async def _chunks(self) -> AsyncIterator[List[dict]]:
+        """Claimed documents to replay, chunk by chunk"""
+        cursor = self._collection().find(
+            replay_query(self.organization_id, self.term, self.selection),
+            projection={'tenantId': 1, 'paymentDate': 1, 'paymentType': 1, 'paymentReference': 1, 'amount': 1},
+        ).sort('_id', ASCENDING).batch_size(self.chunk_size)
+        if self.selection.limit:
+            cursor = cursor.limit(self.selection.limit)
+        chunk = []
+        async for document in cursor:
+            chunk.append(document)
+            if len(chunk) >= self.chunk_size:
+                yield await self._claim(chunk)
+                chunk = []
+        if chunk:
+            yield await self._claim(chunk)
+
+    async def _prepare(self, documents: List[dict]) -> List[ReplayItem]:
+        """Normalize a chunk of documents like CSV rows, then check their references and tenants in bulk"""
+        def text(value) -> str:
+            return '' if value is None else str(value)
+
+        df = pd.DataFrame({
+            'tenant_id': [text(document.get('tenantId')) for document in documents],
+            'payment_date': [text(document.get('paymentDate')) for document in documents],
+            'payment_type': [text(document.get('paymentType')) for document in documents],
+            'payment_reference': [text(document.get('paymentReference')) for document in documents],
+            'amount': [text(document.get('amount')) for document in documents],
+        })
+        with observe_stage('normalization'):
+            prepared = prepare_payments(df, self._date_parser)
+        await self._duplicates.load(prepared.payments['reference'])
+        try:
+            with observe_stage('tenant_bulk_lookup'):
+                await tenant_resolver.resolve_many(
+                    self.organization_id, set(prepared.payments['tenant_reference']), self.headers
+                )
+        except Exception as e:
+            # Not fatal: each payment looks its tenant up again
+            logger.warning(f"Bulk tenant resolution failed, falling back to per-payment lookups: {str(e)}")
+
+        payments = prepared.payments.to_dict('index')
+        invalid = prepared.invalid.to_dict('index')
+        items = []
+        for index, document in enumerate(documents):
+            document_id = document['_id']
+            record = payments.get(index)
+            if record is None:
+                raw = invalid[index]
+                items.append(ReplayItem(document_id, raw['tenant_id'], outcome=(False, f"Invalid payment: {raw['error']}")))
+                continue
+            tenant_reference = record.pop('tenant_reference')
+            reference = record['reference']
+            item = ReplayItem(document_id, tenant_reference, payment=record)
+            if reference in self._duplicates.existing:
+                # Posted already (e.g. the answer of the rent update was lost)
+                item.outcome = (True, f"Payment with reference {reference} already exists in the database")
+            elif not is_blank_reference(reference):
+                first = self._first_documents.setdefault(reference, document_id)
+                if first != document_id:
+                    item.outcome = (True, f"Duplicate of pending payment {first}")
+            items.append(item)
+        return items
+
+    async def _items(self) -> AsyncIterator[ReplayItem]:
+        async for documents in self._chunks():
+            if documents:
+                for item in await self._prepare(documents):
+                    yield item
+
+    async def _replay(self, item: ReplayItem) -> Tuple[bool, str]:
+        if item.outcome is not None:
+            return item.outcome
+        try:
+            return await self.process(item.payment, self.term)
+        except Exception as e:
+            return False, f"Error processing payment: {str(e)}"
+
+    async def run(self) -> AsyncIterator[Tuple[ReplayItem, bool, str]]:
+        """Replay the pending payments, yields the (item, success, narration) of each of them"""
+        updates = PendingStatusWriter(self.db_name)
+        set_pending_writer(_ReplayPendingWriter())
+
+        def tenant_key(item: ReplayItem):
+            return item.tenant_reference, self.term
+
+        try:
+            executor = OrderedExecutor(PAYMENT_CONCURRENCY, PAYMENT_WINDOW)
+            async for item, (success, narration) in executor.map(self._items(), self._replay, tenant_key):
+                await updates.record(item.document_id, success, narration)
+                outcome = 'resolved' if success else 'pending'
+                self.counts[outcome] += 1
+                PENDING_REPLAYED.labels(outcome).inc()
+                yield item, success, narration
+        finally:
+            set_pending_writer(None)
+            # Shielded so that the outcomes are recorded also when the client disconnects
+            with anyio.CancelScope(shield=True):
+                await updates.close()
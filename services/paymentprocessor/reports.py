@@ -0,0 +1,131 @@
+"""
+Import reports.
+
+The per-row results of an import are not kept in memory: they are written to MongoDB
+while the import runs, in blocks of rows (one document per block, in the
+paymentImportReportRows collection), and served afterwards by import id, as NDJSON or
+CSV. A metadata document (paymentImportReports) records the organization, the term and
+the counts of the import once it is finished.
+
+Reports are stored next to the job results, so any instance of the service can serve
+the report of an import run by another one. They are removed by a TTL index
+IMPORT_REPORT_RETENTION seconds after they were written.
+"""
+import csv
+import io
+import json
+import logging
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from database import IMPORT_REPORT_ROWS_COLLECTION, IMPORT_REPORTS_COLLECTION, get_database
+from metrics import observe_mongo
+
+logger = logging.getLogger(__name__)
+
+REPORT_COLUMNS = ['row', 'success', 'tenant_id', 'message']
+
+
+class ReportWriter:
+    """
+    Write the results of an import to its report, in blocks of rows.
+
+    Args:
+        import_id (str): Id the report is fetched by.
+        organization_id (str): Organization allowed to fetch the report.
+        term (str): Term of the import.
+        batch_size (int): Results per block document.
+        db_name (str): The name of the MongoDB database. Defaults to MONGO_DB_NAME.
+    """
+
+    def __init__(self, import_id: str, organization_id: Optional[str], term: str, batch_size: int = 500,
+                 db_name: Optional[str] = None):
+        self.import_id = import_id
+        self.organization_id = organization_id
+        self.term = term
+        self.batch_size = batch_size
+        self.db_name = db_name
+        self.rows = 0
+        self.blocks = 0
+        self._rows: List[dict] = []
+        self._failed = False
+
+    def _collection(self, name: str):
+        return get_database(self.db_name)[name]
+
+    async def add(self, row: int, result: dict) -> None:
+        """Append the result of a row"""
+        self.rows += 1
+        self._rows.append(dict(row=row, **result))
+        if len(self._rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        document = dict(importId=self.import_id, block=self.blocks, rows=rows, createdAt=datetime.utcnow())
+        self.blocks += 1
+        try:
+            with observe_mongo(f"insert_one.{IMPORT_REPORT_ROWS_COLLECTION}"):
+                await self._collection(IMPORT_REPORT_ROWS_COLLECTION).insert_one(document)
+        except PyMongoError as e:
+            # The import goes on, its report is marked incomplete
+            self._failed = True
+            logger.error(f"Could not write the report of import {self.import_id}: {str(e)}")
+
+    async def close(self, summary: Optional[dict] = None) -> None:
+        """Write the remaining results and the metadata of the report"""
+        await self.flush()
+        meta = dict(
+            _id=self.import_id,
+            organizationId=self.organization_id,
+            term=self.term,
+            rows=self.rows,
+            complete=not self._failed,
+            createdAt=datetime.utcnow(),
+            summary=summary,
+        )
+        try:
+            with observe_mongo(f"replace_one.{IMPORT_REPORTS_COLLECTION}"):
+                await self._collection(IMPORT_REPORTS_COLLECTION).replace_one({'_id': self.import_id}, meta,
+                                                                               upsert=True)
+        except PyMongoError as e:
+            logger.error(f"Could not write the report of import {self.import_id}: {str(e)}")
+
+
+async def read_report_meta(import_id: str, db_name: Optional[str] = None) -> Optional[dict]:
+    """Metadata of a finished report, None when there is none"""
+    with observe_mongo('read_report_meta'):
+        return await get_database(db_name)[IMPORT_REPORTS_COLLECTION].find_one({'_id': import_id})
+
+
+async def iter_report_rows(import_id: str, db_name: Optional[str] = None) -> AsyncIterator[List[dict]]:
+    """The results of an import, block by block, in row order"""
+    cursor = get_database(db_name)[IMPORT_REPORT_ROWS_COLLECTION].find(
+        {'importId': import_id}, projection={'_id': 0, 'rows': 1}
+    ).sort('block', ASCENDING)
+    async for document in cursor:
+        yield document['rows']
+
+
+async def iter_report_ndjson(import_id: str) -> AsyncIterator[str]:
+    """The report of an import as NDJSON (one JSON object per row), produced block by block"""
+    async for rows in iter_report_rows(import_id):
+        yield ''.join(json.dumps(row, default=str) + '\n' for row in rows)
+
+
+async def iter_report_csv(import_id: str) -> AsyncIterator[str]:
+    """The report of an import as CSV, produced block by block"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=REPORT_COLUMNS, extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    async for rows in iter_report_rows(import_id):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
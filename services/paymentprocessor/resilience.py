@@ -0,0 +1,245 @@
+"""
+Retries and circuit breaker for the gateway calls.
+
+Transient failures (connection errors, timeouts, 429/502/503/504 answers) are retried
+with jittered exponential backoff, honoring the Retry-After header of the answer.
+Other answers are returned to the caller as they are.
+
+A circuit breaker shared by every import opens after GATEWAY_BREAKER_FAILURE_THRESHOLD
+consecutive transient failures. While it is open the gateway calls wait instead of
+failing: the imports pause until the breaker lets a probe call through, and resume when
+the probe succeeds. A call that waits longer than GATEWAY_BREAKER_MAX_WAIT fails with
+GatewayUnavailableError.
+
+Each attempt also takes a slot of the service-wide flow control (see flow_control), for
+the organization of the call, after the breaker let it through.
+
+The rent updates send the whole payments array of the term, so retrying a PATCH whose
+answer was lost writes the same state again.
+"""
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+from config import (
+    GATEWAY_BREAKER_FAILURE_THRESHOLD,
+    GATEWAY_BREAKER_MAX_WAIT,
+    GATEWAY_BREAKER_RESET_TIMEOUT,
+    GATEWAY_FLOW_CONTROL,
+    GATEWAY_RETRY_ATTEMPTS,
+    GATEWAY_RETRY_BASE_DELAY,
+    GATEWAY_RETRY_MAX_DELAY,
+)
+from flow_control import FlowController, gateway_flow
+from metrics import GATEWAY_BREAKER_STATE, GATEWAY_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Answers worth retrying: rate limited, or the gateway / upstream service is restarting
+RETRYABLE_STATUS_CODES = frozenset({429, 502, 503, 504})
+# Rate limiting is not a sign of an unhealthy gateway, it does not count for the breaker
+BREAKER_IGNORED_STATUS_CODES = frozenset({429})
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class GatewayUnavailableError(Exception):
+    """The circuit breaker stayed open longer than the maximum wait"""
+
+    def __init__(self, waited: float):
+        self.waited = waited
+        super().__init__(f"Gateway unavailable: circuit breaker open for {waited:.0f}s")
+
+
+def retry_after_delay(response: httpx.Response) -> Optional[float]:
+    """Seconds requested by the Retry-After header (seconds or HTTP date), None without a valid one"""
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, base_delay: float = GATEWAY_RETRY_BASE_DELAY,
+                  max_delay: float = GATEWAY_RETRY_MAX_DELAY) -> float:
+    """Full jitter exponential backoff: a random delay up to base_delay * 2^attempt (capped)"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Consecutive failure circuit breaker whose callers wait while it is open.
+
+    Args:
+        failure_threshold (int): Consecutive failures opening the breaker.
+        reset_timeout (float): Seconds the breaker stays open before a probe call is let through.
+        max_wait (float): Maximum seconds a call waits for the breaker, then GatewayUnavailableError.
+    """
+
+    def __init__(self, failure_threshold: int = GATEWAY_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = GATEWAY_BREAKER_RESET_TIMEOUT,
+                 max_wait: float = GATEWAY_BREAKER_MAX_WAIT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._changed: Optional[asyncio.Event] = None
+        GATEWAY_BREAKER_STATE.set(0)
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"Gateway circuit breaker {self.state} -> {state}")
+        self.state = state
+        GATEWAY_BREAKER_STATE.set({CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[state])
+        # Wake up the waiting calls
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def acquire(self, max_wait: Optional[float] = None) -> None:
+        """Wait until a call may go through, at most max_wait seconds (defaults to the breaker's)"""
+        if self.state == CLOSED:
+            return
+        max_wait = self.max_wait if max_wait is None else max_wait
+        started = time.monotonic()
+        while True:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                # This call is the probe, the others wait for its outcome
+                self._probing = True
+                return
+            waited = now - started
+            if waited >= max_wait:
+                raise GatewayUnavailableError(waited)
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            timeout = max_wait - waited
+            if self.state == OPEN:
+                # Until the next probe is due, unless the state changes before
+                timeout = min(timeout, self.reset_timeout - (now - self._opened_at))
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probing = False
+        self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        probe_failed = self._probing
+        self._probing = False
+        # A failed probe opens the breaker again for a full reset timeout
+        if probe_failed or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self) -> None:
+        """A call ended without telling anything about the gateway health (e.g. a 429)"""
+        if self._probing:
+            self._probing = False
+            if self._changed is not None:
+                self._changed.set()
+                self._changed = None
+
+
+gateway_breaker = CircuitBreaker()
+
+
+async def gateway_request(client: httpx.AsyncClient, method: str, url: str,
+                          attempts: int = GATEWAY_RETRY_ATTEMPTS,
+                          breaker: Optional[CircuitBreaker] = None, flow: Optional[FlowController] = None,
+                          **kwargs) -> httpx.Response:
+    """
+    Send a gateway request, retrying transient failures.
+
+    Waiting for an open breaker does not use up the attempts of the call, the call waits
+    GATEWAY_BREAKER_MAX_WAIT seconds at most in total. Waiting for a flow control slot is not
+    bounded: the calls are slowed down to what the gateway can take, not failed.
+
+    Returns the last answer (a retryable status code when every attempt failed), or raises
+    the last transport error, or GatewayUnavailableError when the breaker stays open.
+    """
+    breaker = breaker or gateway_breaker
+    if flow is None and GATEWAY_FLOW_CONTROL:
+        flow = gateway_flow
+    # Capacity is shared between the organizations the calls are made for (see build_gateway_headers)
+    organization_id = (kwargs.get('headers') or {}).get('organizationId')
+    attempt = 0
+    deadline = time.monotonic() + breaker.max_wait
+    while True:
+        await breaker.acquire(max(0.0, deadline - time.monotonic()))
+        try:
+            started = await flow.acquire(organization_id) if flow is not None else 0.0
+        except BaseException:
+            # Cancelled while waiting for a slot, a probe call lets the next one through
+            breaker.release()
+            raise
+        overloaded: Optional[bool] = None
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            # Connection refused / reset, timeouts: the request may not have reached the service
+            overloaded = True
+            breaker.record_failure()
+            attempt += 1
+            if attempt >= attempts:
+                raise
+            reason = type(e).__name__
+            delay = backoff_delay(attempt - 1)
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            # Rate limited or upstream unavailable: the gateway takes too many calls
+            overloaded = response.status_code in RETRYABLE_STATUS_CODES
+            if not overloaded:
+                breaker.record_success()
+                return response
+            if response.status_code in BREAKER_IGNORED_STATUS_CODES:
+                breaker.release()
+            else:
+                breaker.record_failure()
+            attempt += 1
+            if attempt >= attempts:
+                return response
+            reason = str(response.status_code)
+            delay = retry_after_delay(response)
+            if delay is None:
+                delay = backoff_delay(attempt - 1)
+            else:
+                delay = min(delay, GATEWAY_RETRY_MAX_DELAY)
+            await response.aclose()
+        finally:
+            if flow is not None:
+                flow.release(organization_id, started, overloaded)
+
+        GATEWAY_RETRIES.labels(reason).inc()
+        logger.warning(f"{method} {url} failed ({reason}), retry {attempt}/{attempts - 1} in {delay:.2f}s")
+        await asyncio.sleep(delay)
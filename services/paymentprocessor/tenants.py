@@ -0,0 +1,185 @@
+"""
+Tenant resolution: padded tenant reference -> tenant _id.
+
+The tenants of an organization are loaded from the gateway in bulk and kept in a
+bounded LRU cache with a TTL, keyed by (organizationId, reference). References
+missing from the organization are cached as well (for a shorter time) so rows of
+an unknown tenant fail fast instead of repeating the lookup.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from config import GATEWAY_URL, TENANT_CACHE_MAX_SIZE, TENANT_CACHE_NEGATIVE_TTL, TENANT_CACHE_TTL
+from http_client import get_gateway_client
+from resilience import gateway_request
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class TenantRecord:
+    """The tenant fields needed to post a payment"""
+    id: str
+    reference: str
+
+
+class TenantLookupError(Exception):
+    """The gateway did not answer the tenant lookup with a 200"""
+
+    def __init__(self, reference: Optional[str], status_code: int, text: str):
+        self.reference = reference
+        self.status_code = status_code
+        self.text = text
+        super().__init__(f"Failed to find tenant with reference {reference}: {text}")
+
+
+class TenantResolver:
+    """
+    Resolve padded tenant references to tenant records with a bounded LRU/TTL cache.
+
+    Args:
+        max_size (int): Maximum number of cached references (all organizations).
+        ttl (float): Seconds a found tenant stays cached.
+        negative_ttl (float): Seconds an unknown reference stays cached.
+    """
+
+    def __init__(self, max_size: int = TENANT_CACHE_MAX_SIZE, ttl: float = TENANT_CACHE_TTL,
+                 negative_ttl: float = TENANT_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # (organization_id, reference) -> (expires_at, record or None when the tenant does not exist)
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[float, Optional[TenantRecord]]]" = OrderedDict()
+        # One lock per organization so concurrent rows share a single gateway lookup
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+
+    def _get(self, organization_id: str, reference: str) -> Tuple[bool, Optional[TenantRecord]]:
+        """Return (hit, record) for a cached reference, dropping expired entries"""
+        key = (organization_id, reference)
+        entry = self._cache.get(key)
+        if entry is None:
+            return False, None
+        expires_at, record = entry
+        if expires_at <= time.monotonic():
+            del self._cache[key]
+            return False, None
+        self._cache.move_to_end(key)
+        return True, record
+
+    def _put(self, organization_id: str, reference: str, record: Optional[TenantRecord]) -> None:
+        ttl = self.ttl if record is not None else self.negative_ttl
+        key = (organization_id, reference)
+        self._cache[key] = (time.monotonic() + ttl, record)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def _lock(self, organization_id: str) -> asyncio.Lock:
+        lock = self._locks.get(organization_id)
+        if lock is None:
+            lock = self._locks[organization_id] = asyncio.Lock()
+        return lock
+
+    async def _fetch(self, organization_id: str, headers: dict, reference: Optional[str] = None) -> Dict[str, TenantRecord]:
+        """Fetch tenants from the gateway (all tenants of the organization, or by reference)"""
+        tenant_url = f"{GATEWAY_URL}/api/v2/tenants"
+        params = {"reference": reference} if reference else None
+        response = await gateway_request(get_gateway_client(), 'GET', tenant_url, headers=headers, params=params)
+        logger.debug(f"Tenant lookup response status: {response.status_code}")
+        if response.status_code != 200:
+            raise TenantLookupError(reference, response.status_code, response.text)
+
+        tenant_data = response.json()
+        # Handle both list and single object responses
+        if isinstance(tenant_data, dict):
+            tenant_data = [tenant_data]
+
+        records: Dict[str, TenantRecord] = {}
+        for tenant in tenant_data or []:
+            tenant_reference = str(tenant.get('reference', '')).strip()
+            tenant_id = tenant.get('_id')
+            if not tenant_reference or not tenant_id:
+                continue
+            records[tenant_reference] = TenantRecord(id=str(tenant_id), reference=tenant_reference)
+        return records
+
+    async def _load(self, organization_id: str, references: Iterable[str], headers: dict,
+                    single: bool = False) -> None:
+        """Fetch the missing references and cache the result, including the unknown ones"""
+        references = list(references)
+        records = await self._fetch(organization_id, headers, reference=references[0] if single else None)
+        for record in records.values():
+            self._put(organization_id, record.reference, record)
+        for reference in references:
+            if reference not in records:
+                self._put(organization_id, reference, None)
+        logger.debug(f"Loaded {len(records)} tenants for organization {organization_id}")
+
+    async def resolve_many(self, organization_id: str, references: Iterable[str],
+                           headers: dict) -> Dict[str, Optional[TenantRecord]]:
+        """
+        Resolve a set of padded references with at most one gateway call.
+
+        Returns a mapping of reference -> TenantRecord, or None when the organization
+        has no tenant with that reference. Raises TenantLookupError when the gateway fails.
+        """
+        wanted = set(references)
+        resolved: Dict[str, Optional[TenantRecord]] = {}
+
+        def collect():
+            missing = []
+            for reference in wanted:
+                hit, record = self._get(organization_id, reference)
+                if hit:
+                    resolved[reference] = record
+                else:
+                    missing.append(reference)
+            return missing
+
+        missing = collect()
+        if missing:
+            async with self._lock(organization_id):
+                # Another row may have loaded the organization while we were waiting
+                missing = collect()
+                if missing:
+                    # The tenant listing returns every tenant of the organization
+                    await self._load(organization_id, missing, headers)
+                    collect()
+        return resolved
+
+    async def resolve(self, organization_id: str, reference: str, headers: dict) -> Optional[TenantRecord]:
+        """Resolve one padded reference, from the cache when possible"""
+        hit, record = self._get(organization_id, reference)
+        if hit:
+            return record
+        async with self._lock(organization_id):
+            hit, record = self._get(organization_id, reference)
+            if hit:
+                return record
+            await self._load(organization_id, [reference], headers, single=True)
+            return self._get(organization_id, reference)[1]
+
+    def invalidate(self, organization_id: Optional[str] = None, reference: Optional[str] = None) -> int:
+        """
+        Drop cached entries: one reference, one organization, or everything.
+
+        Returns the number of entries removed.
+        """
+        if organization_id is None:
+            count = len(self._cache)
+            self._cache.clear()
+            return count
+        if reference is not None:
+            return 1 if self._cache.pop((organization_id, reference), None) is not None else 0
+        keys = [key for key in self._cache if key[0] == organization_id]
+        for key in keys:
+            del self._cache[key]
+        return len(keys)
+
+
+# Process-wide resolver shared by all imports
+tenant_resolver = TenantResolver()
@@ -0,0 +1,68 @@
+"""
+The service modules are flat (imported by name from the service directory, like in the
+Docker image), the tests import them the same way.
+
+The mongo and gateway fixtures replace MongoDB with mongomock-motor and the gateway with
+the fake of the benchmarks (bench.fake_gateway), for the tests of the import path.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """In-memory MongoDB used by the service, returns its database"""
+    from mongomock_motor import AsyncMongoMockClient
+
+    import database
+
+    client = AsyncMongoMockClient()
+    monkeypatch.setattr(database, '_client', client)
+    return client[database.MONGO_DB_NAME]
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Fake gateway with tenants 1..50 (references 000001..000050) used by the service"""
+    import httpx
+
+    import http_client
+    from bench.fake_gateway import FakeGateway
+    from tenants import tenant_resolver
+
+    fake = FakeGateway(tenants=50)
+    monkeypatch.setattr(http_client, '_client', httpx.AsyncClient(transport=fake.transport()))
+    tenant_resolver.invalidate()
+    yield fake
+    tenant_resolver.invalidate()
+
+
+def make_csv(rows: int, tenants: int = 10) -> bytes:
+    """Payment file of rows rows spread over tenants 1..tenants, references REF0..REF<rows - 1>"""
+    lines = ['tenant_id,payment_date,payment_type,payment_reference,amount']
+    for index in range(rows):
+        lines.append(f'{index % tenants + 1},0{index % 9 + 1}/01/2024,cash,REF{index},{100 + index}')
+    return '\n'.join(lines).encode()
+
+
+@pytest.fixture
+def post_import(mongo, gateway):
+    """Upload a file to POST /process-payments (organization org1, term 2024.01), returns its events"""
+    import json
+
+    import httpx
+
+    import main
+
+    async def post(data: bytes, path: str = '/process-payments', **form) -> list:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test', timeout=None) as client:
+            response = await client.post(path, files={'file': ('payments.csv', data, 'text/csv')},
+                                         data={'term': '2024.01', **form}, headers={'organizationid': 'org1'})
+        return [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith('data: ')]
+
+    return post
@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from checkpoints import ImportCheckpoint, ImportInProgressError
+from conftest import make_csv
+
+
+def test_lease_is_held_until_closed(mongo):
+    async def run():
+        first = ImportCheckpoint('org1', '2024.01', 'hash')
+        await first.open()
+        with pytest.raises(ImportInProgressError):
+            await ImportCheckpoint('org1', '2024.01', 'hash').open()
+        # Another file, term or organization is another import
+        other = ImportCheckpoint('org2', '2024.01', 'hash')
+        await other.open()
+        await other.close()
+        await first.close()
+        again = ImportCheckpoint('org1', '2024.01', 'hash')
+        await again.open()
+        await again.close()
+
+    asyncio.run(run())
+
+
+def test_expired_lease_of_a_stopped_import_is_taken_over(mongo):
+    async def run():
+        stopped = ImportCheckpoint('org1', '2024.01', 'hash', lease_ttl=0.05)
+        await stopped.open()
+        stopped._renewal.cancel()
+        await asyncio.sleep(0.1)
+        successor = ImportCheckpoint('org1', '2024.01', 'hash')
+        await successor.open()
+        # The stopped import does not release the lease of its successor
+        await stopped.close()
+        with pytest.raises(ImportInProgressError):
+            await ImportCheckpoint('org1', '2024.01', 'hash').open()
+        await successor.close()
+
+    asyncio.run(run())
+
+
+def test_committed_rows_are_loaded_by_the_next_run(mongo):
+    async def run():
+        checkpoint = ImportCheckpoint('org1', '2024.01', 'hash')
+        await checkpoint.open()
+        for row in (1, 2, 2, 5):
+            await checkpoint.commit(row)
+        await checkpoint.close(dict(processed=3))
+        return await ImportCheckpoint('org1', '2024.01', 'hash').open()
+
+    assert asyncio.run(run()) == {1, 2, 5}
+
+
+def test_import_resumes_after_the_committed_rows(post_import, gateway):
+    data = make_csv(20)
+
+    async def run():
+        checkpoint = ImportCheckpoint('org1', '2024.01', hashlib.sha256(data).hexdigest())
+        await checkpoint.open()
+        for row in range(1, 6):
+            await checkpoint.commit(row)
+        await checkpoint.close()
+        return await post_import(data)
+
+    events = asyncio.run(run())
+    complete = events[-1]
+    assert complete['skipped'] == 5 and complete['total'] == 15 and complete['successful'] == 15
+    assert [event['row'] for event in events if event['status'] == 'result'] == list(range(6, 21))
+    # Uploaded again, every row is skipped
+    assert asyncio.run(post_import(data))[-1]['skipped'] == 20
+    assert gateway.calls[('PATCH', 'api/v2/rents/payment')] == 15
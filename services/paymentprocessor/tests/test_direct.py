@@ -0,0 +1,99 @@
+import asyncio
+import io
+
+import pytest
+from bson import ObjectId
+from starlette.datastructures import UploadFile
+
+from conftest import make_csv
+from database import OCCUPANTS_COLLECTION, RENT_RECOMPUTES_COLLECTION
+from direct import DirectPaymentWriter, RentRecomputeQueue, TenantPayments, direct_tenant_resolver
+
+
+@pytest.fixture
+def occupants(mongo, gateway, monkeypatch):
+    """Occupants with references 000001..000010 and a rent for 2024.01, the direct backend on"""
+    import main
+
+    monkeypatch.setattr(main, 'PAYMENT_BACKEND', 'direct')
+    ids = [ObjectId() for _ in range(10)]
+    asyncio.run(mongo[OCCUPANTS_COLLECTION].insert_many([
+        {'_id': _id, 'realmId': 'org1', 'reference': str(i).zfill(6), 'rents': [{'term': 2024010100, 'payments': []}]}
+        for i, _id in enumerate(ids, start=1)
+    ]))
+    direct_tenant_resolver.invalidate()
+    yield [str(_id) for _id in ids]
+    direct_tenant_resolver.invalidate()
+
+
+def test_stopped_import_recomputes_the_rents_of_its_payments(occupants, mongo, gateway):
+    import main
+
+    async def run():
+        file = UploadFile(io.BytesIO(make_csv(30)), filename='payments.csv')
+        events = main.import_payments(file, '2024.01', 'org1')
+        async for event in events:
+            if event['status'] == 'result':
+                # The client disconnects once the payments of the chunk are appended
+                break
+        await events.aclose()
+        return await mongo[RENT_RECOMPUTES_COLLECTION].count_documents({})
+
+    assert asyncio.run(run()) == 0
+    assert gateway.calls[('PATCH', 'api/v2/rents/payment')] == 10
+    assert all(len(gateway.payments[(tenant_id, '2024.01')]) == 3 for tenant_id in occupants)
+
+
+def test_direct_import_appends_the_payments_and_recomputes_each_rent_once(occupants, post_import, mongo, gateway):
+    events = asyncio.run(post_import(make_csv(30)))
+    assert events[-1]['status'] == 'complete' and events[-1]['successful'] == 30
+    occupant = asyncio.run(mongo[OCCUPANTS_COLLECTION].find_one({'_id': ObjectId(occupants[0])}))
+    assert [payment['reference'] for payment in occupant['rents'][0]['payments']] == ['REF0', 'REF10', 'REF20']
+    assert gateway.calls[('PATCH', 'api/v2/rents/payment')] == 10
+    assert asyncio.run(mongo[RENT_RECOMPUTES_COLLECTION].count_documents({})) == 0
+
+
+def test_rent_locked_by_another_import_is_written_once_released(occupants, mongo):
+    async def run():
+        holder = RentRecomputeQueue('org1', '2024.01', {})
+        queue = RentRecomputeQueue('org1', '2024.01', {})
+        assert await holder.lock(occupants[:1]) == occupants[:1]
+        # Only the rents nobody holds are locked
+        assert await queue.lock(occupants[:2]) == occupants[1:2]
+        await queue.unlock(occupants[1:2])
+
+        writer = DirectPaymentWriter('org1', '2024.01', queue)
+        post = asyncio.ensure_future(writer.post([TenantPayments(occupants[0], [dict(reference='REF1')], {})]))
+        await asyncio.sleep(0.2)
+        waiting = not post.done()
+        await holder.unlock(occupants[:1])
+        errors = await asyncio.wait_for(post, 5)
+        occupant = await mongo[OCCUPANTS_COLLECTION].find_one({'_id': ObjectId(occupants[0])})
+        return waiting, errors, occupant['rents'][0]['payments'], queue.queued
+
+    waiting, errors, payments, queued = asyncio.run(run())
+    assert waiting and errors == [None]
+    assert payments == [dict(reference='REF1')] and queued == 1
+
+
+def test_recompute_queued_again_while_it_was_sent_is_sent_again(occupants, mongo, gateway):
+    handle = gateway.handle
+
+    async def queued_again_during_the_first_patch(method, path, body=b''):
+        if method == 'PATCH' and gateway.calls[('PATCH', 'api/v2/rents/payment')] == 0:
+            # Another import whose lock expired meanwhile queues the rent again
+            await RentRecomputeQueue('org1', '2024.01', {}).add([TenantPayments(occupants[0], [], {})])
+        return await handle(method, path, body)
+
+    gateway.handle = queued_again_during_the_first_patch
+
+    async def run():
+        queue = RentRecomputeQueue('org1', '2024.01', {})
+        await queue.lock(occupants[:1])
+        await queue.add([TenantPayments(occupants[0], [], {})])
+        await queue.unlock(occupants[:1])
+        sent = await queue.send()
+        return sent, await mongo[RENT_RECOMPUTES_COLLECTION].count_documents({})
+
+    assert asyncio.run(run()) == (2, 0)
+    assert gateway.calls[('PATCH', 'api/v2/rents/payment')] == 2
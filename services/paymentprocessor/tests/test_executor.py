@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from executor import OrderedExecutor
+
+
+async def collect(executor, items, worker, key):
+    return [pair async for pair in executor.map(items, worker, key)]
+
+
+def test_results_in_input_order():
+    async def worker(item):
+        # Later items finish first
+        await asyncio.sleep(0.001 * (10 - item))
+        return item * 2
+
+    pairs = asyncio.run(collect(OrderedExecutor(concurrency=5), range(10), worker, key=lambda item: item))
+    assert pairs == [(item, item * 2) for item in range(10)]
+
+
+def test_async_iterable_input():
+    async def items():
+        for item in range(5):
+            yield item
+
+    async def worker(item):
+        return -item
+
+    pairs = asyncio.run(collect(OrderedExecutor(concurrency=2), items(), worker, key=lambda item: item))
+    assert pairs == [(item, -item) for item in range(5)]
+
+
+def test_same_key_runs_one_after_another_in_order():
+    running = {}
+    overlaps = []
+    started = []
+
+    async def worker(item):
+        key, position = item
+        if running.get(key):
+            overlaps.append(item)
+        running[key] = True
+        started.append(item)
+        await asyncio.sleep(0.002 if position % 2 else 0.001)
+        running[key] = False
+        return item
+
+    items = [(key, position) for position in range(5) for key in ('a', 'b')]
+    asyncio.run(collect(OrderedExecutor(concurrency=8), items, worker, key=lambda item: item[0]))
+    assert overlaps == []
+    for key in ('a', 'b'):
+        assert [position for item_key, position in started if item_key == key] == list(range(5))
+
+
+def test_different_keys_run_concurrently_up_to_the_limit():
+    running = 0
+    peak = 0
+
+    async def worker(item):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return item
+
+    async def run():
+        started = asyncio.get_running_loop().time()
+        await collect(OrderedExecutor(concurrency=4), range(8), worker, key=lambda item: item)
+        return asyncio.get_running_loop().time() - started
+
+    elapsed = asyncio.run(run())
+    assert peak == 4
+    # Two rounds of four, not eight sleeps in a row
+    assert elapsed < 0.06
+
+
+def test_window_bounds_the_scheduled_items():
+    scheduled = []
+
+    async def items():
+        for item in range(20):
+            scheduled.append(item)
+            yield item
+
+    async def worker(item):
+        return item
+
+    async def run():
+        seen = []
+        async for item, _ in OrderedExecutor(concurrency=2, window=4).map(items(), worker, key=lambda item: item):
+            seen.append((item, len(scheduled)))
+        return seen
+
+    for item, count in asyncio.run(run()):
+        # An item is yielded before more than a window of items past it is read
+        assert count - item <= 4
+
+
+def test_worker_error_is_raised_in_order_and_the_rest_cancelled():
+    finished = []
+
+    async def worker(item):
+        if item == 2:
+            raise ValueError('row 2')
+        await asyncio.sleep(0.05 if item > 2 else 0)
+        finished.append(item)
+        return item
+
+    async def run():
+        seen = []
+        with pytest.raises(ValueError, match='row 2'):
+            async for item, _ in OrderedExecutor(concurrency=4).map(range(6), worker, key=lambda item: item):
+                seen.append(item)
+        return seen
+
+    assert asyncio.run(run()) == [0, 1]
+    assert all(item < 2 for item in finished)
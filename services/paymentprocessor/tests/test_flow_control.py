@@ -0,0 +1,154 @@
+import asyncio
+
+import pytest
+
+import flow_control
+from flow_control import FlowController
+
+
+def controller(**kwargs) -> FlowController:
+    options = dict(initial_limit=2, min_limit=1, max_limit=10, latency_target=10.0, latency_tolerance=2.0,
+                   decrease=0.5)
+    options.update(kwargs)
+    return FlowController(**options)
+
+
+def test_limit_bounds_the_calls_in_flight():
+    flow = controller()
+
+    async def run():
+        first = await flow.acquire('a')
+        await flow.acquire('a')
+        waiting = asyncio.ensure_future(flow.acquire('a'))
+        await asyncio.sleep(0)
+        assert not waiting.done() and flow.waiting == 1
+        flow.release('a', first, None)
+        await asyncio.wait_for(waiting, 1)
+        assert flow.in_flight == 2 and flow.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_freed_slot_goes_to_the_organization_with_the_fewest_calls_in_flight():
+    flow = controller()
+
+    async def run():
+        started = await flow.acquire('big')
+        await flow.acquire('big')
+        granted = []
+
+        async def call(key):
+            await flow.acquire(key)
+            granted.append(key)
+
+        # The big import queued first, the small one still gets the next slot
+        tasks = [asyncio.ensure_future(call('big')) for _ in range(3)]
+        tasks.append(asyncio.ensure_future(call('small')))
+        await asyncio.sleep(0)
+        flow.release('big', started, None)
+        await asyncio.sleep(0)
+        assert granted == ['small']
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_additive_increase_while_the_limit_holds_calls_back():
+    flow = controller(initial_limit=4)
+
+    async def run():
+        started = [await flow.acquire('a') for _ in range(4)]
+        flow.release('a', started[0], False)
+        assert flow.limit == pytest.approx(4.25)
+
+    asyncio.run(run())
+
+
+def test_no_increase_while_idle():
+    flow = controller(initial_limit=4)
+
+    async def run():
+        started = await flow.acquire('a')
+        flow.release('a', started, False)
+
+    asyncio.run(run())
+    assert flow.limit == 4
+
+
+def test_multiplicative_decrease_once_per_round_trip():
+    flow = controller(initial_limit=8)
+
+    async def run():
+        started = [await flow.acquire('a') for _ in range(3)]
+        flow.release('a', started[0], True)
+        assert flow.limit == 4
+        # Sent before the decrease: same overload, no second decrease
+        flow.release('a', started[1], True)
+        assert flow.limit == 4
+        later = await flow.acquire('a')
+        flow.release('a', later, True)
+        assert flow.limit == 2
+        flow.release('a', started[2], None)
+
+    asyncio.run(run())
+
+
+def test_latency_above_the_tolerance_decreases_the_limit():
+    flow = controller(initial_limit=8, latency_target=0.0)
+    flow._observe(0.01, 0.0)
+    assert flow.limit == 8
+    flow._observe(1.0, flow_control.time.monotonic())
+    assert flow.limit == 4
+
+
+def test_latency_under_the_target_is_not_an_overload():
+    flow = controller(initial_limit=8, latency_target=5.0)
+    flow._observe(0.01, 0.0)
+    flow._observe(1.0, flow_control.time.monotonic())
+    assert flow.limit == 8
+
+
+def test_limit_stays_between_the_bounds():
+    flow = controller(initial_limit=50, min_limit=2, max_limit=3)
+    assert flow.limit == 3
+    flow._set_limit(flow.limit + 1)
+    assert flow.limit == 3
+    for _ in range(5):
+        flow._reduce(flow_control.time.monotonic() + 1, 'test')
+    assert flow.limit == 2
+
+
+def test_cancelled_waiting_call_leaves_the_queue():
+    flow = controller(initial_limit=1)
+
+    async def run():
+        started = await flow.acquire('a')
+        waiting = asyncio.ensure_future(flow.acquire('b'))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert flow.waiting == 0 and not flow._queues
+        flow.release('a', started, None)
+        assert flow.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_call_cancelled_once_granted_gives_its_slot_back():
+    flow = controller(initial_limit=1)
+
+    async def run():
+        started = await flow.acquire('a')
+        first = asyncio.ensure_future(flow.acquire('b'))
+        second = asyncio.ensure_future(flow.acquire('c'))
+        await asyncio.sleep(0)
+        # The slot is granted to the first call, which is cancelled before it resumes
+        flow.release('a', started, None)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.wait_for(second, 1)
+        assert flow.in_flight == 1 and flow._active == {'c': 1}
+
+    asyncio.run(run())
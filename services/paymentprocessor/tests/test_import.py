@@ -0,0 +1,30 @@
+import asyncio
+
+from conftest import make_csv
+from reports import iter_report_rows
+
+
+def report_rows(import_id):
+    async def read():
+        return [row['row'] async for rows in iter_report_rows(import_id) for row in rows]
+
+    return asyncio.run(read())
+
+
+def test_import_reports_every_row_in_file_order(post_import):
+    events = asyncio.run(post_import(make_csv(120, tenants=50)))
+    complete = events[-1]
+    assert complete['status'] == 'complete' and complete['successful'] == 120
+    assert [event['row'] for event in events if event['status'] == 'result'] == list(range(1, 121))
+    assert report_rows(complete['importId']) == list(range(1, 121))
+
+
+def test_aggregate_mode_reports_in_file_order_with_one_update_per_tenant(post_import, gateway):
+    events = asyncio.run(post_import(make_csv(120, tenants=50), aggregate='true'))
+    complete = events[-1]
+    assert complete['successful'] == 120
+    # The rows of a tenant are posted together, their results still come in file order
+    assert [event['row'] for event in events if event['status'] == 'result'] == list(range(1, 121))
+    assert report_rows(complete['importId']) == list(range(1, 121))
+    assert gateway.calls[('PATCH', 'api/v2/rents/payment')] == 50
+    assert len(gateway.payments[('tenant1', '2024.01')]) == 3
@@ -0,0 +1,44 @@
+import asyncio
+import io
+
+from starlette.datastructures import UploadFile
+
+from conftest import make_csv
+from ingest import ScannedFile, iter_csv_chunks, scan_csv
+
+
+def test_file_is_counted_and_hashed_while_it_is_parsed():
+    data = make_csv(5000) + b'\n'
+
+    async def run():
+        file = UploadFile(io.BytesIO(data), filename='payments.csv')
+        expected = await scan_csv(file)
+        scan = ScannedFile(file.file)
+        estimates, rows = [], 0
+        async for df in iter_csv_chunks(file, chunk_rows=1000, scan=scan):
+            rows += len(df.index)
+            estimates.append(scan.estimate_rows())
+        return expected, (scan.rows, scan.content_hash), estimates, rows
+
+    expected, scanned, estimates, rows = asyncio.run(run())
+    assert expected == scanned == (5000, expected[1])
+    assert rows == 5000 and estimates[-1] == 5000
+
+
+def test_estimate_extrapolates_the_rows_read_so_far():
+    scan = ScannedFile(io.BytesIO(b'header\n' + b'row\n' * 99))
+    assert scan.estimate_rows() == 0
+    scan.read(200)
+    assert scan.rows is None and abs(scan.estimate_rows() - 99) <= 1
+    scan.read()
+    assert scan.rows == 99
+
+
+def test_import_without_checkpoints_reports_the_total_once_known(post_import, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, 'IMPORT_CHECKPOINTS', False)
+    events = asyncio.run(post_import(make_csv(120, tenants=50)))
+    progress = [event for event in events if event['status'] == 'processing' and 'current_result' in event]
+    assert events[-1]['successful'] == 120
+    assert progress[-1]['progress'] == 100 and progress[-1]['message'].endswith('(120/120)')
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from jobs import JOB_COMPLETE, JOB_INTERRUPTED, JOB_RUNNING, JobManager, job_status
+
+
+async def finished(manager, job_id):
+    while manager._tasks.get(job_id):
+        await asyncio.sleep(0.01)
+    return await manager.get(job_id, 'org1')
+
+
+def test_job_records_its_events_results_and_state(mongo):
+    async def run(job_id, on_result):
+        yield dict(status='processing', progress=0, message='Processing CSV file...')
+        for row in (2, 1, 3):
+            await on_result(row, dict(success=row != 3))
+        yield dict(status='complete', progress=100, message='Processing complete.')
+
+    async def scenario():
+        manager = JobManager()
+        job = await manager.submit('org1', '2024.01', run, filename='payments.csv')
+        document = await finished(manager, job['_id'])
+        events = [item async for item in manager.stream(job['_id'], 'org1')]
+        # Attached again from an offset
+        tail = [item async for item in manager.stream(job['_id'], 'org1', offset=1)]
+        results = await manager.results(job['_id'])
+        other = await manager.get(job['_id'], 'org2')
+        return document, events, tail, results, other
+
+    document, events, tail, results, other = asyncio.run(scenario())
+    assert document['status'] == JOB_COMPLETE and document['eventCount'] == 2
+    assert (document['processed'], document['successful']) == (3, 2)
+    assert [seq for seq, _ in events] == [0, 1] and events[1][1]['status'] == 'complete'
+    assert tail == events[1:]
+    assert [result['row'] for result in results] == [1, 2, 3]
+    assert other is None
+
+
+def test_stream_follows_a_running_job(mongo, monkeypatch):
+    import jobs
+
+    monkeypatch.setattr(jobs, 'IMPORT_JOB_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(jobs, 'IMPORT_JOB_FLUSH_INTERVAL', 0.01)
+
+    async def scenario():
+        go = asyncio.Event()
+
+        async def run(job_id, on_result):
+            yield dict(status='processing', progress=0, message='started')
+            await go.wait()
+            yield dict(status='complete', progress=100, message='done')
+
+        manager = JobManager()
+        job = await manager.submit('org1', '2024.01', run)
+        stream = manager.stream(job['_id'], 'org1')
+        first = await asyncio.wait_for(anext(stream), 5)
+        running = await manager.get(job['_id'], 'org1')
+        go.set()
+        rest = [item async for item in stream]
+        return first, running, rest
+
+    first, running, rest = asyncio.run(scenario())
+    assert first == (0, dict(status='processing', progress=0, message='started'))
+    assert running['status'] == JOB_RUNNING
+    assert [event['status'] for _, event in rest] == ['complete']
+
+
+def test_shutdown_records_the_running_jobs_as_interrupted(mongo):
+    async def run(job_id, on_result):
+        yield dict(status='processing', progress=0, message='started')
+        await asyncio.sleep(60)
+        yield dict(status='complete', progress=100, message='done')
+
+    async def scenario():
+        manager = JobManager()
+        job = await manager.submit('org1', '2024.01', run)
+        await asyncio.sleep(0.05)
+        await manager.shutdown()
+        document = await manager.get(job['_id'], 'org1')
+        events = [item async for item in manager.stream(job['_id'], 'org1')]
+        return document, events
+
+    document, events = asyncio.run(scenario())
+    assert document['status'] == JOB_INTERRUPTED
+    assert events[0][0] == 0 and events[-1] == (None, dict(status='error', message='Import interrupted'))
+
+
+def test_job_without_a_recent_heartbeat_is_interrupted():
+    now = datetime.utcnow()
+    job = dict(status=JOB_RUNNING, createdAt=now - timedelta(hours=1), heartbeatAt=now - timedelta(hours=1))
+    assert job_status(job, now) == JOB_INTERRUPTED
+    assert job_status(dict(job, heartbeatAt=now), now) == JOB_RUNNING
+    assert job_status(dict(job, status=JOB_COMPLETE), now) == JOB_COMPLETE
@@ -0,0 +1,57 @@
+import pandas as pd
+
+from normalize import pad_tenant_ids, prepare_payments
+
+
+def test_pad_tenant_ids():
+    padded = pad_tenant_ids(pd.Series(['12', '000012', '12.0', '1e3', '0']))
+    assert padded.tolist() == ['000012', '000012', '000012', '001000', '000000']
+
+
+def test_pad_tenant_ids_rejects_ids_that_are_not_whole_numbers_in_range():
+    values = ['1e30', '99999999999999999999', '-1', '12.5', 'inf', 'nan', 'abc', '']
+    assert pad_tenant_ids(pd.Series(values)).isna().all()
+
+
+def test_out_of_range_tenant_ids_are_invalid_rows():
+    df = pd.DataFrame({
+        'tenant_id': ['12', '1e30', '12.5'],
+        'payment_date': ['01/02/2024'] * 3,
+        'payment_type': ['cash'] * 3,
+        'payment_reference': ['A', 'B', 'C'],
+        'amount': ['100'] * 3,
+    })
+    prepared = prepare_payments(df)
+    assert prepared.payments['tenant_reference'].tolist() == ['000012']
+    assert prepared.invalid['error'].tolist() == ["invalid tenant_id '1e30'", "invalid tenant_id '12.5'"]
+
+
+def chunk(amounts):
+    count = len(amounts)
+    return pd.DataFrame({
+        'tenant_id': ['12'] * count,
+        'payment_date': ['01/02/2024'] * count,
+        'payment_type': ['cash'] * count,
+        'payment_reference': [f'R{i}' for i in range(count)],
+        'amount': amounts,
+    })
+
+
+def test_amounts_with_thousands_separators():
+    prepared = prepare_payments(chunk(['1,500.50', '1,234,567', '100', '-1,000']))
+    assert prepared.payments['amount'].tolist() == [1500.5, 1234567.0, 100.0, -1000.0]
+
+
+def test_decimal_comma_amounts_are_invalid_rows():
+    prepared = prepare_payments(chunk(['1,5', '12,34', '1,0000', 'abc', 'inf']))
+    assert prepared.payments.empty
+    assert prepared.invalid['error'].tolist() == [
+        "invalid amount '1,5'", "invalid amount '12,34'", "invalid amount '1,0000'", "invalid amount 'abc'",
+        "invalid amount 'inf'",
+    ]
+
+
+def test_zero_and_negative_amounts_are_accepted():
+    prepared = prepare_payments(chunk(['0', '-25.5']))
+    assert prepared.payments['amount'].tolist() == [0.0, -25.5]
+    assert prepared.invalid.empty
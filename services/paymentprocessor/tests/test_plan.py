@@ -0,0 +1,41 @@
+import asyncio
+import hashlib
+
+from checkpoints import ImportCheckpoint
+from database import OCCUPANTS_COLLECTION
+
+FILE = '\n'.join([
+    'tenant_id,payment_date,payment_type,payment_reference,amount',
+    '1,01/01/2024,cash,REF1,100',
+    '2,02/01/2024,cash,OLD1,200',
+    '3,03/01/2024,cash,REF1,300',
+    '99,04/01/2024,cash,REF4,400',
+    '5,05/01/2024,cash,REF5,abc',
+    '6,06/01/2024,cash,REF6,600',
+    '7,07/01/2024,cash,REF7,700',
+]).encode()
+
+
+def test_dry_run_plans_every_row_without_writing(post_import, mongo, gateway):
+    async def run():
+        # A recorded payment reference, and the last row posted by a previous run of the file
+        await mongo[OCCUPANTS_COLLECTION].insert_one({'rents': [{'payments': [{'reference': 'OLD1'}]}]})
+        checkpoint = ImportCheckpoint('org1', '2024.01', hashlib.sha256(FILE).hexdigest())
+        await checkpoint.open()
+        await checkpoint.commit(7)
+        await checkpoint.close()
+        before = {name: await mongo[name].count_documents({}) for name in await mongo.list_collection_names()}
+        events = await post_import(FILE, dry_run='true')
+        after = {name: await mongo[name].count_documents({}) for name in await mongo.list_collection_names()}
+        return events, before, after
+
+    events, before, after = asyncio.run(run())
+    planned = [(event['row'], event['action']) for event in events if event['status'] == 'plan']
+    assert planned == [(1, 'post'), (2, 'duplicate'), (3, 'duplicate'), (4, 'unknown_tenant'), (5, 'invalid'),
+                       (6, 'post'), (7, 'skip')]
+    complete = events[-1]
+    assert complete['dryRun'] and complete['total'] == 7 and complete['amount'] == 700
+    assert complete['counts'] == dict(post=2, duplicate=2, unknown_tenant=1, invalid=1, skip=1, unresolved=0)
+    # Read-only: no rent update and no document written
+    assert not gateway.calls[('PATCH', 'api/v2/rents/payment')]
+    assert after == before
@@ -0,0 +1,63 @@
+import asyncio
+import io
+from datetime import datetime
+
+import pandas as pd
+
+from database import OCCUPANTS_COLLECTION
+from reconcile import Reconciliation
+
+STATEMENT = '\n'.join([
+    'tenant_id,payment_date,payment_type,payment_reference,amount',
+    '1,01/01/2024,bank,REF1,100',
+    '1,02/01/2024,bank,REF2,250',
+    '1,03/01/2024,bank,BANK9,300',
+    '1,04/01/2024,bank,REF3,50',
+    '99,05/01/2024,bank,REF5,10',
+    '1,01/01/2024,bank,REF1,100',
+    '2,06/01/2024,bank,REF7,abc',
+]).encode()
+
+
+def payment(reference, amount, day):
+    return dict(reference=reference, amount=amount, date=datetime(2024, 1, day), type='bank')
+
+
+async def statement_chunks():
+    yield pd.read_csv(io.BytesIO(STATEMENT), dtype=str, keep_default_na=False)
+
+
+def test_statement_lines_are_classified_against_the_recorded_payments(mongo):
+    async def run():
+        await mongo[OCCUPANTS_COLLECTION].insert_many([
+            {'_id': 'tenant1', 'realmId': 'org1', 'reference': '000001', 'rents': [
+                {'term': 2023120100, 'payments': [payment('OLD', 100, 1)]},
+                # CASH was entered by hand, without the reference of the statement
+                {'term': 2024010100, 'payments': [payment('REF1', 100, 1), payment('REF2', 200, 2),
+                                                  payment('CASH', 300, 3)]},
+            ]},
+            {'_id': 'tenant2', 'realmId': 'org1', 'reference': '000002', 'rents': [
+                {'term': 2024010100, 'payments': [payment('REF3', 50, 4)]},
+            ]},
+            {'_id': 'other', 'realmId': 'org2', 'reference': '000001', 'rents': [
+                {'term': 2024010100, 'payments': [payment('REF9', 10, 1)]},
+            ]},
+        ])
+        reconciliation = Reconciliation('org1', '2024.01')
+        recorded = await reconciliation.load()
+        lines = await reconciliation.run(statement_chunks())
+        return recorded, lines, reconciliation.report()
+
+    recorded, lines, report = asyncio.run(run())
+    assert (recorded, lines) == (4, 7)
+    assert [(entry['row'], entry['matchedBy']) for entry in report['matched']] == [(1, 'reference'), (3, 'amount_date')]
+    assert [(entry['row'], entry['recordedAmount']) for entry in report['amount_mismatch']] == [(2, 200)]
+    assert [(entry['row'], entry['message']) for entry in report['unmatched']] == [
+        (4, 'Reference REF3 is recorded for tenant 000002'),
+        (5, 'No tenant found with reference 000099'),
+        (6, 'Reference REF1 was already matched by row 1'),
+    ]
+    assert [entry['row'] for entry in report['invalid']] == [7]
+    assert [entry['reference'] for entry in report['missing']] == ['REF3']
+    assert report['counts'] == dict(matched=2, amount_mismatch=1, unmatched=3, invalid=1, missing=1)
+    assert report['amounts']['matched'] == 400 and report['amounts']['missing'] == 50
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from replay import ReplayFilter, replay_query
+
+NOW = datetime(2024, 2, 1)
+
+
+def test_replay_selects_the_organization_and_term_only():
+    query = replay_query('org1', '2024.02', ReplayFilter(), now=NOW)
+    assert query['organizationId'] == 'org1'
+    assert query['term'] == '2024.02'
+    assert '$or' not in query
+
+
+def test_legacy_documents_need_the_opt_in():
+    query = replay_query('org1', '2024.02', ReplayFilter(include_legacy=True), now=NOW)
+    assert 'organizationId' not in query and 'term' not in query
+    assert query['$or'] == [
+        {'organizationId': 'org1', 'term': '2024.02'},
+        # Documents of another organization or term never match
+        {'organizationId': None, 'term': None},
+    ]
+
+
+def test_filters():
+    selection = ReplayFilter(created_from=datetime(2024, 1, 1), created_to=NOW, tenant_id='0012', narration='a.b')
+    query = replay_query('org1', '2024.02', selection, now=NOW)
+    assert query['dateCreated'] == {'$gte': datetime(2024, 1, 1), '$lt': NOW}
+    assert query['tenantId'] == {'$in': ['000012', '0012', '12']}
+    assert query['narration'] == {'$regex': r'a\.b', '$options': 'i'}
+    assert query['replayUntil'] == {'$not': {'$gt': NOW}}
@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+import httpx
+
+from conftest import make_csv
+from database import IMPORT_REPORT_ROWS_COLLECTION
+from reports import ReportWriter, iter_report_csv, iter_report_ndjson, read_report_meta
+
+
+def test_results_are_stored_in_blocks_of_rows(mongo):
+    async def run():
+        report = ReportWriter('import1', 'org1', '2024.01', batch_size=2)
+        for row in range(1, 6):
+            await report.add(row, dict(success=row % 2 == 1, tenant_id=f'{row:06d}', message='ok'))
+        await report.close(dict(processed=5))
+        blocks = await mongo[IMPORT_REPORT_ROWS_COLLECTION].find({'importId': 'import1'}).sort('block', 1).to_list(None)
+        ndjson = ''.join([text async for text in iter_report_ndjson('import1')])
+        csv = ''.join([text async for text in iter_report_csv('import1')])
+        return blocks, await read_report_meta('import1'), ndjson, csv
+
+    blocks, meta, ndjson, csv = asyncio.run(run())
+    assert [[row['row'] for row in block['rows']] for block in blocks] == [[1, 2], [3, 4], [5]]
+    assert meta['organizationId'] == 'org1' and meta['rows'] == 5 and meta['complete']
+    assert meta['summary'] == dict(processed=5)
+    assert [json.loads(line)['row'] for line in ndjson.splitlines()] == [1, 2, 3, 4, 5]
+    lines = csv.splitlines()
+    assert lines[0] == 'row,success,tenant_id,message' and lines[2] == '2,False,000002,ok' and len(lines) == 6
+
+
+def test_report_is_served_to_its_organization_only(post_import):
+    import main
+
+    async def run():
+        events = await post_import(make_csv(12))
+        report_url = events[-1]['report']
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            csv = await client.get(report_url, params={'format': 'csv'}, headers={'organizationid': 'org1'})
+            other = await client.get(report_url, headers={'organizationid': 'org2'})
+        return csv, other
+
+    csv, other = asyncio.run(run())
+    assert csv.status_code == 200 and len(csv.text.splitlines()) == 13
+    assert other.status_code == 404
@@ -0,0 +1,131 @@
+import asyncio
+
+import httpx
+import pytest
+
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, GatewayUnavailableError, gateway_request
+
+
+def open_breaker(**kwargs) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=2, **kwargs)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, max_wait=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_open_breaker_fails_calls_after_the_maximum_wait():
+    breaker = open_breaker(reset_timeout=10, max_wait=0.05)
+
+    with pytest.raises(GatewayUnavailableError):
+        asyncio.run(breaker.acquire())
+
+
+def test_single_probe_then_waiting_calls_resume_on_success():
+    breaker = open_breaker(reset_timeout=0.02, max_wait=5)
+
+    async def run():
+        await breaker.acquire()  # The probe, once the reset timeout is over
+        assert breaker.state == HALF_OPEN
+        waiting = asyncio.ensure_future(breaker.acquire())
+        await asyncio.sleep(0.05)
+        # The other calls wait for the outcome of the probe
+        assert not waiting.done()
+        breaker.record_success()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+    assert breaker.state == CLOSED
+
+
+def test_failed_probe_opens_the_breaker_again():
+    breaker = open_breaker(reset_timeout=0.02, max_wait=5)
+
+    async def run():
+        await breaker.acquire()
+        breaker.record_failure()
+        assert breaker.state == OPEN
+        started = asyncio.get_running_loop().time()
+        await breaker.acquire()
+        # A full reset timeout before the next probe
+        return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(run()) >= 0.015
+    assert breaker.state == HALF_OPEN
+
+
+def test_released_probe_lets_the_next_call_probe():
+    breaker = open_breaker(reset_timeout=0.01, max_wait=5)
+
+    async def run():
+        await breaker.acquire()
+        waiting = asyncio.ensure_future(breaker.acquire())
+        await asyncio.sleep(0.02)
+        assert not waiting.done()
+        # e.g. the probe was rate limited: no outcome, another call probes
+        breaker.release()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+    assert breaker.state == HALF_OPEN
+
+
+def mock_client(statuses):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(statuses[min(len(calls), len(statuses)) - 1])
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), calls
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, 'backoff_delay', lambda attempt: 0)
+
+
+def test_gateway_request_retries_transient_failures():
+    client, calls = mock_client([503, 502, 200])
+    breaker = CircuitBreaker(failure_threshold=10)
+
+    response = asyncio.run(gateway_request(client, 'GET', 'http://gateway/x', attempts=4, breaker=breaker))
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert breaker.state == CLOSED and breaker.failures == 0
+
+
+def test_gateway_request_returns_other_answers_and_the_last_failure():
+    client, calls = mock_client([404])
+    response = asyncio.run(gateway_request(client, 'GET', 'http://gateway/x', breaker=CircuitBreaker()))
+    assert response.status_code == 404 and len(calls) == 1
+
+    client, calls = mock_client([503])
+    response = asyncio.run(gateway_request(client, 'GET', 'http://gateway/x', attempts=3,
+                                           breaker=CircuitBreaker(failure_threshold=10)))
+    assert response.status_code == 503 and len(calls) == 3
+
+
+def test_rate_limiting_does_not_open_the_breaker():
+    client, _ = mock_client([429])
+    breaker = CircuitBreaker(failure_threshold=1)
+    asyncio.run(gateway_request(client, 'GET', 'http://gateway/x', attempts=3, breaker=breaker))
+    assert breaker.state == CLOSED
+
+
+def test_retry_after_delay():
+    assert resilience.retry_after_delay(httpx.Response(429, headers={'Retry-After': '3'})) == 3.0
+    assert resilience.retry_after_delay(httpx.Response(429, headers={'Retry-After': 'soon'})) is None
+    assert resilience.retry_after_delay(httpx.Response(429)) is None
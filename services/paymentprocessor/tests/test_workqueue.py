@@ -0,0 +1,101 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+import workqueue
+from workqueue import GROUP, QueuedImport, WorkQueue
+
+
+async def rows_of(chunks):
+    for item, rows in chunks:
+        yield item, rows
+
+
+async def echo(task):
+    return [dict(key=row['key'], redelivered=task['redelivered']) for row in task['rows']]
+
+
+async def started(server, handler=echo, supervise=True, **kwargs) -> WorkQueue:
+    queue = WorkQueue(partitions=1, **kwargs)
+    await queue.start(handler, client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+    if not supervise:
+        queue._supervisor.cancel()
+    return queue
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(workqueue, 'WORK_QUEUE_POLL_INTERVAL', 0.05)
+    return fakeredis.FakeServer()
+
+
+def test_tasks_no_worker_took_are_withdrawn_after_the_timeout(server):
+    async def run():
+        queue = await started(server, supervise=False)
+        imported = QueuedImport(queue, 'import1', {}, result_timeout=0.1)
+        results = [outcomes async for _, outcomes in imported.map(rows_of([(0, [dict(key='000001')])]))]
+        # Withdrawn: a worker starting later does not post the row
+        remaining = await queue.client().xlen(queue.task_stream(0))
+        await queue.close()
+        return results, remaining
+
+    results, remaining = asyncio.run(run())
+    assert results == [[dict(error='No worker processed the row within 0.1 seconds')]]
+    assert remaining == 0
+
+
+def test_task_taken_by_a_worker_is_waited_for_and_handed_over(server):
+    async def run():
+        queue = await started(server, supervise=False, lease_ttl=0.5)
+        client = queue.client()
+        stream = queue.task_stream(0)
+        imported = QueuedImport(queue, 'import1', {}, result_timeout=0.1)
+        results = imported.map(rows_of([(0, [dict(key='000001')])]))
+        first = asyncio.ensure_future(anext(results))
+        await asyncio.sleep(0.05)
+        # A replica takes the partition and reads the task, then stops without acknowledging it
+        await client.set(queue._lease(0), 'stopped', px=500)
+        await client.xreadgroup(GROUP, 'partition-0', {stream: '>'}, count=1)
+        await asyncio.sleep(0.3)
+        # The timeout went by while the lease was live: the task is still in the stream and waited for
+        assert not first.done() and await client.xlen(stream) == 1
+        # Once the lease expired, another replica takes the partition over and processes the task again
+        worker = await started(server, lease_ttl=0.5)
+        item, outcomes = await asyncio.wait_for(first, 5)
+        await results.aclose()
+        await worker.close()
+        await queue.close()
+        return item, outcomes
+
+    assert asyncio.run(run()) == (0, [dict(key='000001', redelivered=True)])
+
+
+def test_rows_are_processed_by_the_replicas_and_returned_in_order(server):
+    processed = {}
+
+    async def record(task):
+        for row in task['rows']:
+            processed.setdefault(row['key'], []).append(row['position'])
+        await asyncio.sleep(0.01)
+        return [dict(position=row['position']) for row in task['rows']]
+
+    async def run():
+        workers = []
+        for _ in range(2):
+            queue = WorkQueue(partitions=4, max_owned=2, lease_ttl=1)
+            await queue.start(record, client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+            workers.append(queue)
+        chunks = [(chunk, [dict(key=f'{position % 6:06d}', position=position)
+                           for position in range(chunk * 10, chunk * 10 + 10)]) for chunk in range(5)]
+        imported = QueuedImport(workers[0], 'import1', {}, window=2, result_timeout=5)
+        results = [(item, outcomes) async for item, outcomes in imported.map(rows_of(chunks))]
+        for queue in workers:
+            await queue.close()
+        return results
+
+    results = asyncio.run(run())
+    assert [item for item, _ in results] == list(range(5))
+    assert [outcome['position'] for _, outcomes in results for outcome in outcomes] == list(range(50))
+    # A partition is consumed by one replica at a time: the rows of a tenant are processed in file order
+    assert all(positions == sorted(positions) for positions in processed.values())
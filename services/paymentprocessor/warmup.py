@@ -0,0 +1,182 @@
+"""
+Startup warm-up and readiness of the payment processor.
+
+The application starts listening as soon as its clients are created: main does not
+import pandas and the CSV pipeline modules, and no connection is opened on startup.
+The warm-up then runs in the background:
+
+- imports the pipeline modules (ingest, normalize, plan, reconcile, replay) and normalizes a small
+  sample file, so that the first upload does not pay for the imports and the lazy
+  initialization of pandas,
+- waits for MongoDB and creates its indexes (MONGO_ENSURE_INDEXES),
+- opens WARMUP_CONNECTIONS connections to the gateway and to MongoDB, kept in the pools
+  for the first import.
+
+GET /healthz (liveness) answers as soon as the application runs. GET /readyz answers 503
+until the warm-up is done and while MongoDB, the gateway or Redis (when the work queue is
+started) cannot be reached, so that uploads are only routed to warmed-up instances.
+"""
+import asyncio
+import importlib
+import io
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import anyio
+
+from config import (
+    GATEWAY_HEALTH_PATH,
+    GATEWAY_MAX_KEEPALIVE_CONNECTIONS,
+    GATEWAY_URL,
+    HEALTH_CHECK_TIMEOUT,
+    MONGO_ENSURE_INDEXES,
+    MONGO_MAX_POOL_SIZE,
+    WARMUP_CONNECTIONS,
+)
+from database import ensure_indexes, get_database
+from http_client import get_gateway_client
+from metrics import READY
+from workqueue import work_queue
+
+logger = logging.getLogger(__name__)
+
+# Modules of the CSV pipeline, loaded by the warm-up (main imports them on first use)
+PIPELINE_MODULES = ('ingest', 'normalize', 'plan', 'reconcile', 'replay')
+
+# Normalized by the warm-up: valid rows, another date format and an invalid row
+SAMPLE_CSV = (
+    "tenant_id,payment_date,payment_type,payment_reference,amount\n"
+    "1,01/02/2024,cash,WARMUP-1,1000\n"
+    "2,2024-02-01,transfer,WARMUP-2,\"1,500.50\"\n"
+    "x,31/31/2024,,,abc\n"
+)
+
+
+def load_pipeline() -> None:
+    """Import the CSV pipeline and normalize the sample file (blocking, run in a worker thread)"""
+    for name in PIPELINE_MODULES:
+        importlib.import_module(name)
+    import pandas as pd
+    from normalize import prepare_payments
+
+    # Same options as the ingestion (see ingest.iter_csv_chunks)
+    prepare_payments(pd.read_csv(io.StringIO(SAMPLE_CSV), dtype=str, keep_default_na=False))
+
+
+class Readiness:
+    """
+    Warm-up state of the instance and dependency checks of /readyz.
+
+    Args:
+        connections (int): Connections opened to the gateway and to MongoDB by the warm-up.
+        timeout (float): Timeout of each dependency check, in seconds.
+    """
+
+    def __init__(self, connections: int = WARMUP_CONNECTIONS, timeout: float = HEALTH_CHECK_TIMEOUT):
+        self.connections = connections
+        self.timeout = timeout
+        self.warmed_up = False
+        self.started_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the warm-up in the background (called from the application lifespan)"""
+        self.started_at = time.monotonic()
+        self._task = asyncio.create_task(self.warm_up())
+
+    async def stop(self) -> None:
+        """Report the instance as not ready (shutdown) and cancel an unfinished warm-up"""
+        self.warmed_up = False
+        READY.set(0)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def warm_up(self) -> None:
+        """Load the pipeline, create the indexes and prime the connection pools"""
+        try:
+            await anyio.to_thread.run_sync(load_pipeline)
+        except Exception as e:
+            # Not ready: the imports cannot run on this instance
+            logger.error(f"Warm-up failed, could not load the CSV pipeline: {str(e)}")
+            return
+        # Not warmed up without the indexes: wait for MongoDB when it is not reachable yet
+        await self._wait_for('MongoDB', self._check_mongo)
+        if MONGO_ENSURE_INDEXES:
+            await ensure_indexes()
+        await asyncio.gather(
+            self._prime('gateway', self._check_gateway, min(self.connections, GATEWAY_MAX_KEEPALIVE_CONNECTIONS)),
+            self._prime('MongoDB', self._check_mongo, min(self.connections, MONGO_MAX_POOL_SIZE)),
+        )
+        self.warmed_up = True
+        logger.info(f"Warm-up done in {time.monotonic() - self.started_at:.2f}s")
+
+    async def _wait_for(self, name: str, check: Callable[[], Awaitable[None]]) -> None:
+        while True:
+            try:
+                return await check()
+            except Exception as e:
+                logger.warning(f"Warm-up waiting for {name}: {str(e) or type(e).__name__}")
+            await asyncio.sleep(self.timeout)
+
+    async def _prime(self, name: str, check: Callable[[], Awaitable[None]], count: int) -> None:
+        """Run count checks at the same time, each one opens (and leaves in the pool) its own connection"""
+        if count <= 0:
+            return
+        results = await asyncio.gather(*(check() for _ in range(count)), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            # Not fatal: the connections are opened by the first import instead, /readyz tells if it can run
+            logger.warning(f"Could not open {len(failures)}/{count} {name} connections: {str(failures[0]) or type(failures[0]).__name__}")
+        else:
+            logger.info(f"Opened {count} {name} connections")
+
+    async def _check_gateway(self) -> None:
+        # Any answer but a server error tells that the gateway (and the API behind it) can be reached
+        response = await get_gateway_client().get(f"{GATEWAY_URL}{GATEWAY_HEALTH_PATH}", timeout=self.timeout)
+        if response.status_code >= 500:
+            raise RuntimeError(f"status {response.status_code}")
+
+    async def _check_mongo(self) -> None:
+        await asyncio.wait_for(get_database().command('ping'), self.timeout)
+
+    async def _check_redis(self) -> None:
+        await asyncio.wait_for(work_queue.client().ping(), self.timeout)
+
+    async def check(self) -> Dict[str, dict]:
+        """Check the dependencies at the same time: whether each one is reachable, and its latency"""
+        checks = {'mongo': self._check_mongo, 'gateway': self._check_gateway}
+        if work_queue.started:
+            checks['redis'] = self._check_redis
+
+        async def run(check: Callable[[], Awaitable[None]]) -> dict:
+            started = time.perf_counter()
+            try:
+                await check()
+            except Exception as e:
+                return dict(reachable=False, error=str(e) or type(e).__name__)
+            return dict(reachable=True, latencyMs=round((time.perf_counter() - started) * 1000, 1))
+
+        results = await asyncio.gather(*(run(check) for check in checks.values()))
+        return dict(zip(checks, results))
+
+    async def status(self) -> Tuple[bool, dict]:
+        """Readiness of the instance: whether it can take uploads, and the report of /readyz"""
+        checks = await self.check()
+        ready = self.warmed_up and all(check['reachable'] for check in checks.values())
+        READY.set(1 if ready else 0)
+        if ready:
+            status = 'ready'
+        elif not self.warmed_up:
+            status = 'warming_up'
+        else:
+            status = 'unavailable'
+        return ready, dict(status=status, warmedUp=self.warmed_up, checks=checks)
+
+    def uptime(self) -> float:
+        return time.monotonic() - self.started_at
+
+
+readiness = Readiness()
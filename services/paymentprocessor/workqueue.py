@@ -0,0 +1,400 @@
+"""
+Redis work queue spreading the rows of an import over the replicas of the service.
+
+With WORK_QUEUE enabled, the instance receiving an upload still parses the file, checks
+the duplicate references and reports the progress, but the valid rows of each chunk are
+published to Redis instead of being processed locally. Every replica, the receiving one
+included, consumes them:
+
+- rows are partitioned by tenant: the rows of a tenant always land on the same partition
+  (one Redis stream per partition), and a partition is consumed by one replica at a time,
+  task after task, so the payments of a tenant are still posted one after the other, in
+  file order;
+- a replica holds a lease on each partition it consumes (renewed while it works) and lets
+  the partition go once it is idle, so the partitions spread over the replicas as work
+  comes in. The partition of a stopped replica is taken over when its lease expires, and
+  the task it was processing is delivered again;
+- the outcomes of a task are sent back on a stream of the import, read by the receiving
+  instance, which reports them chunk by chunk, in file order.
+
+Tasks carry the authorization header of the upload (the workers call the gateway with it),
+Redis must only be reachable from inside the cluster.
+"""
+import asyncio
+import json
+import logging
+import random
+import uuid
+import zlib
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError, ResponseError
+
+from config import (
+    REDIS_PASSWORD,
+    REDIS_URL,
+    WORK_QUEUE_IDLE_TIMEOUT,
+    WORK_QUEUE_LEASE_TTL,
+    WORK_QUEUE_PARTITIONS,
+    WORK_QUEUE_POLL_INTERVAL,
+    WORK_QUEUE_PREFIX,
+    WORK_QUEUE_RESULT_TIMEOUT,
+    WORK_QUEUE_WINDOW,
+    WORK_QUEUE_WORKER_PARTITIONS,
+)
+from metrics import WORK_QUEUE_PARTITIONS_OWNED, WORK_QUEUE_TASKS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Processes the rows of a task (on the replica consuming it), returns one outcome per row, in order
+TaskHandler = Callable[[dict], Awaitable[List[dict]]]
+
+# Consumer group of the partition streams
+GROUP = 'workers'
+
+# Lease operations, only applied by the owner of the lease
+_RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+_RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+# Delete a task no worker has read yet (not pending in the consumer group), atomically with the check
+_WITHDRAW_SCRIPT = ("if #redis.call('xpending', KEYS[1], ARGV[1], ARGV[2], ARGV[2], 1) > 0 then return 0 end "
+                    "return redis.call('xdel', KEYS[1], ARGV[2])")
+
+
+def partition_of(key: str, partitions: int) -> int:
+    """Partition of a tenant reference, the same on every replica"""
+    return zlib.crc32(key.encode()) % partitions
+
+
+class WorkQueue:
+    """
+    Partitioned task streams in Redis, and the consumer of the partitions taken by this replica.
+
+    Usage:
+        await work_queue.start(handler)  # application startup
+        ...
+        await work_queue.close()  # application shutdown
+
+    Args:
+        url (str): Redis URL.
+        password (str): Redis password, when the URL does not hold it.
+        partitions (int): Number of partitions, must be the same on every replica.
+        max_owned (int): Partitions this replica consumes at the same time.
+        lease_ttl (float): Seconds after which the lease of a stopped replica on a partition expires.
+        idle_timeout (float): Seconds without tasks after which a partition is let go.
+        prefix (str): Prefix of the Redis keys.
+    """
+
+    def __init__(self, url: str = REDIS_URL, password: str = REDIS_PASSWORD,
+                 partitions: int = WORK_QUEUE_PARTITIONS, max_owned: int = WORK_QUEUE_WORKER_PARTITIONS,
+                 lease_ttl: float = WORK_QUEUE_LEASE_TTL, idle_timeout: float = WORK_QUEUE_IDLE_TIMEOUT,
+                 prefix: str = WORK_QUEUE_PREFIX):
+        self.url = url
+        self.password = password
+        self.partitions = max(1, partitions)
+        self.max_owned = max(1, max_owned)
+        self.lease_ttl = lease_ttl
+        self.idle_timeout = idle_timeout
+        self.prefix = prefix
+        self.worker_id = uuid.uuid4().hex
+        self._redis: Optional[redis.Redis] = None
+        self._handler: Optional[TaskHandler] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        # Consumer task of each partition owned by this replica
+        self._consumers: Dict[int, asyncio.Task] = {}
+
+    @property
+    def started(self) -> bool:
+        return self._redis is not None
+
+    def task_stream(self, partition: int) -> str:
+        return f"{self.prefix}:tasks:{partition}"
+
+    def result_stream(self, import_id: str) -> str:
+        return f"{self.prefix}:results:{import_id}"
+
+    def _lease(self, partition: int) -> str:
+        return f"{self.prefix}:lease:{partition}"
+
+    def client(self) -> redis.Redis:
+        if self._redis is None:
+            raise RuntimeError("The work queue is not started")
+        return self._redis
+
+    async def start(self, handler: TaskHandler, client: Optional[redis.Redis] = None) -> None:
+        """Connect to Redis and start consuming partitions (called from the application lifespan)"""
+        client = client or redis.Redis.from_url(self.url, password=self.password or None, decode_responses=True)
+        for partition in range(self.partitions):
+            try:
+                await client.xgroup_create(self.task_stream(partition), GROUP, id='0', mkstream=True)
+            except ResponseError as e:
+                # Created by another replica
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        self._renew = client.register_script(_RENEW_SCRIPT)
+        self._release = client.register_script(_RELEASE_SCRIPT)
+        self._withdraw = client.register_script(_WITHDRAW_SCRIPT)
+        self._redis = client
+        self._handler = handler
+        self._supervisor = asyncio.ensure_future(self._supervise())
+        logger.info(f"Work queue started (worker {self.worker_id}, {self.partitions} partitions, "
+                    f"up to {self.max_owned} consumed by this replica)")
+
+    async def close(self) -> None:
+        """Stop consuming, the leases of the owned partitions are released"""
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+        consumers = list(self._consumers.values())
+        for consumer in consumers:
+            consumer.cancel()
+        if consumers:
+            await asyncio.gather(*consumers, return_exceptions=True)
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+            logger.info("Work queue closed")
+
+    async def withdraw(self, stream: str, message_id: str) -> bool:
+        """
+        Withdraw a task no worker has read yet. Returns False when a worker read it (it is processed
+        under the lease of its partition, or delivered again to the next owner) or it is done.
+        """
+        return bool(await self._withdraw(keys=[stream], args=[GROUP, message_id]))
+
+    async def _supervise(self) -> None:
+        """Take the free partitions that have tasks, up to max_owned"""
+        while True:
+            try:
+                partitions = list(range(self.partitions))
+                # Replicas polling at the same time do not all go for the same partitions
+                random.shuffle(partitions)
+                for partition in partitions:
+                    if len(self._consumers) >= self.max_owned:
+                        break
+                    if partition in self._consumers or not await self._redis.xlen(self.task_stream(partition)):
+                        continue
+                    if await self._redis.set(self._lease(partition), self.worker_id, nx=True,
+                                             px=int(self.lease_ttl * 1000)):
+                        consumer = asyncio.ensure_future(self._consume(partition))
+                        self._consumers[partition] = consumer
+                        consumer.add_done_callback(lambda done, partition=partition: self._release_consumer(partition, done))
+            except RedisError as e:
+                logger.warning(f"Work queue unavailable: {str(e)}")
+            await asyncio.sleep(WORK_QUEUE_POLL_INTERVAL)
+
+    def _release_consumer(self, partition: int, consumer: asyncio.Task) -> None:
+        if self._consumers.get(partition) is consumer:
+            del self._consumers[partition]
+
+    async def _renew_lease(self, partition: int, consumer: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                renewed = await self._renew(keys=[self._lease(partition)],
+                                            args=[self.worker_id, int(self.lease_ttl * 1000)])
+            except RedisError as e:
+                logger.warning(f"Could not renew the lease of partition {partition}: {str(e)}")
+                continue
+            if not renewed:
+                # Taken over by another replica: stop, the task in progress is delivered to the new owner
+                logger.error(f"Lost the lease of partition {partition}, stopping its consumer")
+                consumer.cancel()
+                return
+
+    async def _consume(self, partition: int) -> None:
+        """Process the tasks of an owned partition one after the other, until it is idle"""
+        stream = self.task_stream(partition)
+        # One consumer name per partition: a new owner gets the tasks left unacknowledged by the previous one
+        consumer = f"partition-{partition}"
+        renewal = asyncio.ensure_future(self._renew_lease(partition, asyncio.current_task()))
+        WORK_QUEUE_PARTITIONS_OWNED.inc()
+        loop = asyncio.get_running_loop()
+        try:
+            backlog = True
+            idle_since = loop.time()
+            while True:
+                if backlog:
+                    entries = await self._redis.xreadgroup(GROUP, consumer, {stream: '0'}, count=1)
+                else:
+                    entries = await self._redis.xreadgroup(GROUP, consumer, {stream: '>'}, count=1, block=1000)
+                messages = entries[0][1] if entries else []
+                if not messages:
+                    if backlog:
+                        backlog = False
+                    elif loop.time() - idle_since >= self.idle_timeout:
+                        return
+                    continue
+                for message_id, fields in messages:
+                    await self._process(stream, message_id, fields, redelivered=backlog)
+                idle_since = loop.time()
+        except RedisError as e:
+            logger.warning(f"Stopped consuming partition {partition}: {str(e)}")
+        finally:
+            renewal.cancel()
+            WORK_QUEUE_PARTITIONS_OWNED.dec()
+            try:
+                await asyncio.shield(self._release(keys=[self._lease(partition)], args=[self.worker_id]))
+            except (RedisError, asyncio.CancelledError):
+                pass
+
+    async def _process(self, stream: str, message_id: str, fields: Optional[dict], redelivered: bool) -> None:
+        """Process one task, send its outcomes to the import and acknowledge it"""
+        if fields and 'task' in fields:
+            task = json.loads(fields['task'])
+            task['redelivered'] = redelivered
+            try:
+                reply = dict(task=task['id'], outcomes=await self._handler(task))
+                WORK_QUEUE_TASKS.labels('processed').inc()
+            except Exception as e:
+                logger.exception(f"Work queue task {task['id']} failed")
+                reply = dict(task=task['id'], error=str(e))
+                WORK_QUEUE_TASKS.labels('failed').inc()
+            results = self.result_stream(task['importId'])
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.xadd(results, {'reply': json.dumps(reply)})
+                # Left behind when the importing instance stopped
+                pipe.expire(results, int(WORK_QUEUE_RESULT_TIMEOUT * 2))
+                pipe.xack(stream, GROUP, message_id)
+                pipe.xdel(stream, message_id)
+                await pipe.execute()
+        else:
+            # Deleted by an import that was cancelled
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.xack(stream, GROUP, message_id)
+                pipe.xdel(stream, message_id)
+                await pipe.execute()
+
+
+class QueuedImport:
+    """
+    The rows of one import sent to the work queue, and their outcomes read back in order.
+
+    Args:
+        queue (WorkQueue): The started work queue.
+        import_id (str): Id of the import, its outcomes stream is named after it.
+        context (dict): Sent with every task (organization, term, credentials, ...).
+        window (int): Chunks published ahead of the oldest chunk still waiting for outcomes.
+        result_timeout (float): Seconds without any outcome after which the rows no worker took are given up.
+    """
+
+    def __init__(self, queue: WorkQueue, import_id: str, context: dict, window: int = WORK_QUEUE_WINDOW,
+                 result_timeout: float = WORK_QUEUE_RESULT_TIMEOUT):
+        self.queue = queue
+        self.import_id = import_id
+        self.context = dict(context, importId=import_id)
+        self.window = max(1, window)
+        self.result_timeout = result_timeout
+        self.tasks_sent = 0
+        self._last_id = '0'
+        # Task id -> (outcomes of its chunk, positions of its rows, tasks of the chunk still out)
+        self._tasks: Dict[str, Tuple[List[Optional[dict]], List[int], Set[str]]] = {}
+        # Task id -> (stream, message id) of the tasks without outcome, withdrawn when the import ends
+        self._messages: Dict[str, Tuple[str, str]] = {}
+
+    async def _publish(self, rows: List[dict]) -> Tuple[List[Optional[dict]], Set[str]]:
+        """Publish the rows of a chunk, one task per partition"""
+        outcomes: List[Optional[dict]] = [None] * len(rows)
+        out: Set[str] = set()
+        positions_of: Dict[int, List[int]] = {}
+        for position, row in enumerate(rows):
+            positions_of.setdefault(partition_of(row['key'], self.queue.partitions), []).append(position)
+        client = self.queue.client()
+        for partition, positions in positions_of.items():
+            task_id = uuid.uuid4().hex
+            task = dict(id=task_id, importId=self.import_id, context=self.context,
+                        rows=[rows[position] for position in positions])
+            stream = self.queue.task_stream(partition)
+            message_id = await client.xadd(stream, {'task': json.dumps(task)})
+            self._tasks[task_id] = (outcomes, positions, out)
+            self._messages[task_id] = (stream, message_id)
+            out.add(task_id)
+            self.tasks_sent += 1
+        return outcomes, out
+
+    async def _receive(self) -> None:
+        """Wait for the outcomes of the next tasks, give up on the tasks still queued after result_timeout"""
+        entries = await self.queue.client().xread({self.queue.result_stream(self.import_id): self._last_id},
+                                                  count=100, block=int(self.result_timeout * 1000))
+        messages = entries[0][1] if entries else []
+        if not messages:
+            await self._withdraw_queued()
+            return
+        for message_id, fields in messages:
+            self._last_id = message_id
+            reply = json.loads(fields['reply'])
+            self._messages.pop(reply['task'], None)
+            self._fill(reply['task'], reply.get('outcomes'), reply.get('error'))
+
+    async def _withdraw_queued(self) -> None:
+        """
+        Fail the tasks that no worker took, withdrawn first so they are never processed. The
+        tasks a worker took are still waited for: they are processed under the lease of their
+        partition, or delivered again to the replica taking it over.
+        """
+        error = f"No worker processed the row within {self.result_timeout:g} seconds"
+        withdrawn = 0
+        for task_id in list(self._tasks):
+            stream, message_id = self._messages[task_id]
+            if await self.queue.withdraw(stream, message_id):
+                del self._messages[task_id]
+                self._fill(task_id, None, error)
+                withdrawn += 1
+        logger.error(f"No outcome received for import {self.import_id} in {self.result_timeout} seconds, "
+                     f"gave up on {withdrawn} tasks still queued, waiting for {len(self._tasks)} tasks taken by a worker")
+
+    def _fill(self, task_id: str, outcomes: Optional[List[dict]], error: Optional[str]) -> None:
+        entry = self._tasks.pop(task_id, None)
+        if entry is None:
+            return
+        chunk_outcomes, positions, out = entry
+        for index, position in enumerate(positions):
+            chunk_outcomes[position] = outcomes[index] if outcomes is not None else dict(error=error)
+        out.discard(task_id)
+
+    async def map(self, chunks: AsyncIterable[Tuple[T, List[dict]]]) -> AsyncIterator[Tuple[T, List[dict]]]:
+        """
+        Publish the rows of each (item, rows) chunk and yield (item, outcomes) in chunk order.
+
+        Every row carries its partition key (the tenant reference) as 'key'. The outcomes are
+        aligned with the rows; the outcome of a row whose task failed or timed out is {'error': message}.
+        """
+        pending: Deque[Tuple[T, List[Optional[dict]], Set[str]]] = deque()
+        try:
+            async for item, rows in chunks:
+                outcomes, out = await self._publish(rows)
+                pending.append((item, outcomes, out))
+                while pending and (len(pending) >= self.window or not pending[0][2]):
+                    if pending[0][2]:
+                        await self._receive()
+                        continue
+                    head, outcomes, _ = pending.popleft()
+                    yield head, outcomes
+            while pending:
+                if pending[0][2]:
+                    await self._receive()
+                    continue
+                head, outcomes, _ = pending.popleft()
+                yield head, outcomes
+        finally:
+            await asyncio.shield(self._cleanup())
+
+    async def _cleanup(self) -> None:
+        """Withdraw the tasks not processed yet (cancelled import, timeout) and drop the outcomes stream"""
+        client = self.queue.client()
+        try:
+            for stream, message_id in self._messages.values():
+                await client.xdel(stream, message_id)
+            await client.delete(self.queue.result_stream(self.import_id))
+        except RedisError as e:
+            logger.warning(f"Could not clean up the work queue of import {self.import_id}: {str(e)}")
+        self._messages.clear()
+        self._tasks.clear()
+
+
+# Process-wide work queue, started by the application lifespan when WORK_QUEUE is enabled
+work_queue = WorkQueue()